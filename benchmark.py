@@ -0,0 +1,568 @@
+#!/usr/bin/env python3
+import os
+import sys
+sys.path.insert(0, 'build/lib.linux-x86_64-3.5')
+import time
+import json
+import socket
+import argparse
+import threading
+import multiprocessing
+import numpy as np
+import cpp
+
+# (bench, case, seconds) of every measurement, for --json and --baseline
+RESULTS = []
+
+def record (bench, case, seconds):
+    RESULTS.append({'bench': bench, 'case': case, 'seconds': seconds})
+    pass
+
+def random_boxes (rs, n, width, height, min_size=8, max_size=40):
+    # n * 4 boxes (x1, y1, x2, y2) fully inside the image
+    w = rs.uniform(min_size, max_size, n)
+    h = rs.uniform(min_size, max_size, n)
+    x1 = rs.uniform(0, width - w - 1)
+    y1 = rs.uniform(0, height - h - 1)
+    return np.stack([x1, y1, x1 + w, y1 + h], axis=1).astype(np.float32)
+
+def jitter_boxes (rs, boxes, scale=0.15):
+    w = boxes[:, 2] - boxes[:, 0]
+    h = boxes[:, 3] - boxes[:, 1]
+    d = rs.uniform(-scale, scale, boxes.shape) * np.stack([w, h, w, h], axis=1)
+    return (boxes + d).astype(np.float32)
+
+def matcher_inputs (rs, batch, ng, nb, size=1024):
+    # ng gt boxes and nb proposals per image
+    # about half the proposals are near a gt box, the rest are noise
+    gt_boxes, boxes, box_ind = [], [], []
+    for i in range(batch):
+        gt = random_boxes(rs, ng, size, size)
+        nn = nb // 2 if ng > 0 else 0
+        near = jitter_boxes(rs, gt[rs.randint(0, max(ng, 1), nn)])
+        noise = random_boxes(rs, nb - nn, size, size)
+        b = np.concatenate([near, noise])
+        b = b[rs.permutation(nb)]
+        g = np.zeros((ng, 7), dtype=np.float32)
+        g[:, 0] = i
+        g[:, 2] = np.arange(1, ng + 1)
+        g[:, 3:] = gt
+        gt_boxes.append(g)
+        boxes.append(b)
+        box_ind.append(np.full(nb, i, dtype=np.int32))
+    return np.concatenate(boxes), np.concatenate(box_ind), np.concatenate(gt_boxes)
+
+def timeit (fn, repeat):
+    fn()    # warm up
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        fn()
+        t = time.time() - start
+        if best is None or t < best:
+            best = t
+    return best
+
+def timeit_threads (fn, threads, repeat):
+    # wall time per call with threads threads each making repeat calls
+    if threads == 1:
+        return timeit(fn, repeat)
+    fn()    # warm up
+    def run ():
+        for _ in range(repeat):
+            fn()
+        pass
+    workers = [threading.Thread(target=run) for _ in range(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return (time.time() - start) / (threads * repeat)
+
+def bench_threads (name, case, fn, args):
+    # calls per second of fn at each of --threads, relative to the first
+    print('    %8s %12s %10s %8s' % ('threads', 'per call', 'calls/s', 'scaling'))
+    base = None
+    for threads in args.threads:
+        t = timeit_threads(fn, threads, args.repeat)
+        record(name, '%s threads=%d' % (case, threads), t)
+        if base is None:
+            base = t
+        print('    %8d %10.3fms %10.1f %7.2fx' % (threads, t * 1000, 1.0 / t, base / t))
+    pass
+
+def bench_matcher (args):
+    rs = np.random.RandomState(args.seed)
+    matcher = cpp.GTMatcher(args.match_th)
+    # images without gt boxes, no boxes at all
+    for ng, nb in [(0, 100), (0, 0), (10, 0)]:
+        boxes, box_ind, gt_boxes = matcher_inputs(np.random.RandomState(args.seed), args.batch, ng, nb)
+        for r in [matcher.apply_reference(boxes, box_ind, gt_boxes), matcher.apply(boxes, box_ind, gt_boxes)]:
+            assert r[0].shape[0] == 0 and r[1].shape[0] == 0, 'matches without gt boxes or boxes'
+    print('%8s %8s %12s %12s %8s' % ('gt', 'boxes', 'reference', 'indexed', 'speedup'))
+    for ng in args.gt:
+        nb = ng * args.ratio
+        boxes, box_ind, gt_boxes = matcher_inputs(rs, args.batch, ng, nb)
+        r1 = matcher.apply_reference(boxes, box_ind, gt_boxes)
+        r2 = matcher.apply(boxes, box_ind, gt_boxes)
+        assert np.array_equal(r1[0], r2[0]) and np.array_equal(r1[1], r2[1]), 'matchers disagree'
+        t1 = timeit(lambda: matcher.apply_reference(boxes, box_ind, gt_boxes), args.repeat)
+        t2 = timeit(lambda: matcher.apply(boxes, box_ind, gt_boxes), args.repeat)
+        print('%8d %8d %10.3fms %10.3fms %7.1fx' % (ng, nb, t1 * 1000, t2 * 1000, t1 / t2))
+        case = 'gt=%d boxes=%d' % (ng, nb)
+        record('matcher', case + ' reference', t1)
+        record('matcher', case, t2)
+        if args.threads != [1]:
+            bench_threads('matcher', case, lambda: matcher.apply(boxes, box_ind, gt_boxes), args)
+    pass
+
+def iou_numpy (a, b):
+    # plain numpy broadcasting, for reference
+    iw = np.minimum(a[:, None, 2], b[None, :, 2]) - np.maximum(a[:, None, 0], b[None, :, 0])
+    ih = np.minimum(a[:, None, 3], b[None, :, 3]) - np.maximum(a[:, None, 1], b[None, :, 1])
+    ia = iw * ih
+    aa = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    ab = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    iou = ia / (aa[:, None] + ab[None, :] - ia + 1.0)
+    return np.where((iw > 0) & (ih > 0), iou, 0).astype(np.float32)
+
+def bench_iou (args):
+    rs = np.random.RandomState(args.seed)
+    for na, nb in [(0, 10), (10, 0), (0, 0)]:
+        r = cpp.iou_matrix(random_boxes(rs, na, 1024, 1024), random_boxes(rs, nb, 1024, 1024))
+        assert r.shape == (na, nb), 'iou_matrix of empty boxes'
+    print('%8s %8s %12s %12s %8s' % ('a', 'b', 'numpy', 'iou_matrix', 'speedup'))
+    for n in args.gt:
+        a = random_boxes(rs, n, 1024, 1024)
+        b = jitter_boxes(rs, random_boxes(rs, n * args.ratio, 1024, 1024))
+        out = np.empty((a.shape[0], b.shape[0]), dtype=np.float32)
+        r = cpp.iou_matrix(a, b, out=out)
+        assert r is out or np.shares_memory(r, out)
+        assert np.allclose(out, iou_numpy(a, b), atol=1e-6), 'iou_matrix disagrees with numpy'
+        t1 = timeit(lambda: iou_numpy(a, b), args.repeat)
+        t2 = timeit(lambda: cpp.iou_matrix(a, b, out=out), args.repeat)
+        print('%8d %8d %10.3fms %10.3fms %7.1fx' % (a.shape[0], b.shape[0], t1 * 1000, t2 * 1000, t1 / t2))
+        record('iou', 'a=%d b=%d' % (a.shape[0], b.shape[0]), t2)
+    pass
+
+def label_image (rs, batch, size, boxes_per_image):
+    # B * H * W * 1 label image with boxes painted in as tags 1, 2, ...
+    # returns the image and gt_boxes (index, 0, tag, x1, y1, x2, y2)
+    images = np.zeros((batch, size, size, 1), dtype=np.int32)
+    gt_boxes = []
+    for i in range(batch):
+        boxes = random_boxes(rs, boxes_per_image, size, size)
+        for k, (x1, y1, x2, y2) in enumerate(np.round(boxes).astype(np.int32)):
+            images[i, y1:y2+1, x1:x2+1, 0] = k + 1
+            gt_boxes.append([i, 0, k + 1, x1, y1, x2, y2])
+    return images, np.array(gt_boxes, dtype=np.float32)
+
+def bench_mask (args):
+    rs = np.random.RandomState(args.seed)
+    extractor = cpp.MaskExtractor(args.mask_size, args.mask_size)
+    images = np.zeros((args.batch, 64, 64, 1), dtype=np.int32)
+    empty = extractor.apply(images, np.zeros((0, 7), dtype=np.float32), np.zeros((0, 4), dtype=np.float32))
+    assert empty.shape == (0, args.mask_size, args.mask_size, 1), 'masks of no boxes'
+    print('%8s %12s %12s' % ('boxes', 'allocate', 'reuse'))
+    for n in args.gt:
+        images, gt_boxes = label_image(rs, args.batch, 1024, n)
+        boxes = jitter_boxes(rs, gt_boxes[:, 3:], 0.05)
+        boxes = np.clip(np.round(boxes), 0, 1023)
+        masks = np.zeros((boxes.shape[0], args.mask_size, args.mask_size, 1), dtype=np.float32)
+        t1 = timeit(lambda: extractor.apply(images, gt_boxes, boxes), args.repeat)
+        t2 = timeit(lambda: extractor.apply(images, gt_boxes, boxes, masks), args.repeat)
+        print('%8d %10.3fms %10.3fms' % (boxes.shape[0], t1 * 1000, t2 * 1000))
+        case = 'boxes=%d' % boxes.shape[0]
+        record('mask', case + ' allocate', t1)
+        record('mask', case, t2)
+        if args.threads != [1]:
+            # each thread needs its own output buffer
+            local = threading.local()
+            def apply ():
+                if not hasattr(local, 'masks'):
+                    local.masks = np.zeros_like(masks)
+                extractor.apply(images, gt_boxes, boxes, local.masks)
+                pass
+            bench_threads('mask', case, apply, args)
+    pass
+
+def nms_numpy (prob, boxes, box_ind, anchor_th, nms_th, max_boxes):
+    # threshold and greedy NMS image by image, for reference
+    sel = []
+    for i in np.unique(box_ind):
+        cand = np.nonzero((box_ind == i) & (prob >= anchor_th))[0]
+        cand = cand[np.argsort(-prob[cand], kind='stable')]
+        b = boxes[cand]
+        area = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+        alive = np.ones(len(cand), dtype=bool)
+        keep = []
+        for k in range(len(cand)):
+            if not alive[k]:
+                continue
+            keep.append(cand[k])
+            if len(keep) >= max_boxes:
+                break
+            iw = np.minimum(b[k, 2], b[:, 2]) - np.maximum(b[k, 0], b[:, 0])
+            ih = np.minimum(b[k, 3], b[:, 3]) - np.maximum(b[k, 1], b[:, 1])
+            ia = np.where((iw > 0) & (ih > 0), iw * ih, 0)
+            iou = ia / (area[k] + area - ia)
+            alive &= ~(iou > nms_th)
+        sel.extend(keep)
+    return np.array(sel, dtype=np.int32)
+
+def bench_nms (args):
+    rs = np.random.RandomState(args.seed)
+    nms = cpp.NMS(args.max_boxes, args.match_th)
+    # no gt boxes, no boxes, no boxes above anchor_th
+    for ng, nb, p in [(0, 100, 1), (10, 0, 1), (10, 100, 0)]:
+        er = np.random.RandomState(args.seed)
+        boxes, box_ind, gt_boxes = matcher_inputs(er, args.batch, ng, nb)
+        prob = (er.uniform(0, 1, boxes.shape[0]) * p).astype(np.float32)
+        sel, index, gt_index = nms.apply(prob, boxes, box_ind, args.anchor_th, args.nms_th, gt_boxes)
+        assert index.shape[0] == 0 and gt_index.shape[0] == 0, 'NMS matches without gt boxes or boxes'
+        assert np.array_equal(sel, nms_numpy(prob, boxes, box_ind, args.anchor_th, args.nms_th, args.max_boxes)), 'NMS disagrees with numpy'
+    print('%8s %8s %12s %12s %8s' % ('batch', 'boxes', 'numpy', 'NMS', 'speedup'))
+    for ng in args.gt:
+        nb = ng * args.ratio
+        boxes, box_ind, gt_boxes = matcher_inputs(rs, args.batch, ng, nb)
+        prob = rs.uniform(0, 1, boxes.shape[0]).astype(np.float32)
+        sel, index, gt_index = nms.apply(prob, boxes, box_ind, args.anchor_th, args.nms_th, gt_boxes)
+        assert np.array_equal(sel, nms_numpy(prob, boxes, box_ind, args.anchor_th, args.nms_th, args.max_boxes)), 'NMS disagrees with numpy'
+        t1 = timeit(lambda: nms_numpy(prob, boxes, box_ind, args.anchor_th, args.nms_th, args.max_boxes), 1)
+        t2 = timeit(lambda: nms.apply(prob, boxes, box_ind, args.anchor_th, args.nms_th, gt_boxes), args.repeat)
+        print('%8d %8d %10.3fms %10.3fms %7.1fx' % (args.batch, boxes.shape[0], t1 * 1000, t2 * 1000, t1 / t2))
+        record('nms', 'batch=%d boxes=%d' % (args.batch, boxes.shape[0]), t2)
+    pass
+
+def ap_numpy (boxes, scores, box_ind, gt_boxes, th):
+    # boxes matched in descending score order, each to the unmatched gt
+    # box of its image with highest IoU > th; returns the AP
+    order = np.argsort(-scores, kind='mergesort')
+    iou = iou_numpy(boxes, gt_boxes[:, 3:7])
+    iou[box_ind[:, None] != gt_boxes[None, :, 0].astype(np.int32)] = 0
+    used = np.zeros(gt_boxes.shape[0], dtype=bool)
+    tp = np.zeros(boxes.shape[0])
+    for j in order:
+        row = np.where(used, 0, iou[j])
+        best = np.argmax(row) if len(row) else 0
+        if len(row) and row[best] > th:
+            used[best] = True
+            tp[j] = 1
+    tp = np.cumsum(tp[order])
+    precision = np.maximum.accumulate((tp / np.arange(1, len(tp) + 1))[::-1])[::-1]
+    recall = tp / gt_boxes.shape[0]
+    return float(np.sum(np.diff(np.concatenate([[0], recall])) * precision))
+
+def bench_ap (args):
+    rs = np.random.RandomState(args.seed)
+    ths = [0.5, 0.75]
+    er = np.random.RandomState(args.seed)
+    for ng, nb in [(0, 100), (10, 0), (0, 0)]:
+        boxes, box_ind, gt_boxes = matcher_inputs(er, args.batch, ng, nb)
+        acc = cpp.APAccumulator(ths, 1000)
+        acc.add(boxes, er.uniform(0, 1, boxes.shape[0]).astype(np.float32), box_ind, gt_boxes)
+        assert np.all(acc.ap() == 0), 'AP without gt boxes or boxes'
+    # adds from several threads count the same as serial adds
+    boxes, box_ind, gt_boxes = matcher_inputs(er, args.batch, 10, 100)
+    scores = er.uniform(0, 1, boxes.shape[0]).astype(np.float32)
+    serial, parallel = cpp.APAccumulator(ths, 1000), cpp.APAccumulator(ths, 1000)
+    for _ in range(8):
+        serial.add(boxes, scores, box_ind, gt_boxes)
+    threads = [threading.Thread(target=lambda: [parallel.add(boxes, scores, box_ind, gt_boxes) for _ in range(2)])
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert np.array_equal(serial.ap(), parallel.ap()), 'concurrent adds disagree'
+    print('%8s %8s %12s %10s %10s' % ('gt', 'boxes', 'add', 'ap50', 'numpy'))
+    for ng in args.gt:
+        nb = ng * args.ratio
+        boxes, box_ind, gt_boxes = matcher_inputs(rs, args.batch, ng, nb)
+        scores = rs.uniform(0, 1, nb * args.batch).astype(np.float32)
+        acc = cpp.APAccumulator(ths, 100000)
+        acc.add(boxes, scores, box_ind, gt_boxes)
+        ap = acc.ap()
+        ref = float('nan')
+        if nb * ng * args.batch <= 4000000:
+            ref = ap_numpy(boxes, scores, box_ind, gt_boxes, ths[0])
+            # boxes sharing a score bin lose their order, hence the tolerance
+            assert abs(ap[0] - ref) < 1e-3, 'APAccumulator disagrees with numpy'
+        t = timeit(lambda: acc.add(boxes, scores, box_ind, gt_boxes), args.repeat)
+        record('ap', 'gt=%d boxes=%d' % (ng, nb), t)
+        print('%8d %8d %10.3fms %10.4f %10.4f' % (ng, nb, t * 1000, ap[0], ref))
+    pass
+
+def python_progress (fn, seconds):
+    # iterations per second that a pure Python loop in another thread
+    # makes while this thread is inside fn; 0 if fn holds the GIL
+    count = [0]
+    stop = threading.Event()
+    def spin ():
+        while not stop.is_set():
+            count[0] += 1
+        pass
+    thread = threading.Thread(target=spin)
+    # short switch interval, so waiting for the GIL to come back does not
+    # dominate the time around short calls
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-4)
+    thread.start()
+    iterations, busy = 0, 0.0
+    start = time.time()
+    while time.time() - start < seconds:
+        c0, t0 = count[0], time.time()
+        fn()
+        iterations += count[0] - c0
+        busy += time.time() - t0
+    stop.set()
+    thread.join()
+    sys.setswitchinterval(interval)
+    return iterations / max(busy, 1e-9)
+
+def concurrent (fn, threads, repeat):
+    # wall time of threads * repeat calls from threads threads, the
+    # results checked against a serial call
+    expected = fn()
+    errors = []
+    def run ():
+        for _ in range(repeat):
+            r = fn()
+            if not all(np.array_equal(a, b) for a, b in zip(r, expected)):
+                errors.append(r)
+        pass
+    workers = [threading.Thread(target=run) for _ in range(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert not errors, 'concurrent results differ'
+    return time.time() - start
+
+def bench_gil (args):
+    # the cpp calls release the GIL: Python threads run while a call is
+    # in progress (progress 0 if the GIL were held, near 1 with a spare
+    # core) and calls from several threads run in parallel
+    rs = np.random.RandomState(args.seed)
+    ng = args.gt[-1]
+    boxes, box_ind, gt_boxes = matcher_inputs(rs, args.batch, ng, ng * args.ratio)
+    prob = rs.uniform(0, 1, boxes.shape[0]).astype(np.float32)
+    images, mask_gt = label_image(rs, args.batch, 1024, ng)
+    mask_boxes = np.clip(np.round(jitter_boxes(rs, mask_gt[:, 3:], 0.05)), 0, 1023)
+    matcher = cpp.GTMatcher(args.match_th)
+    nms = cpp.NMS(args.max_boxes, args.match_th)
+    extractor = cpp.MaskExtractor(args.mask_size, args.mask_size)
+    kernels = [('matcher', lambda: matcher.apply(boxes, box_ind, gt_boxes)),
+               ('nms', lambda: nms.apply(prob, boxes, box_ind, args.anchor_th, args.nms_th, gt_boxes)),
+               ('mask', lambda: [extractor.apply(images, mask_gt, mask_boxes)]),
+               ('iou', lambda: [cpp.iou_matrix(boxes[:1000], boxes)])]
+    threads = max(2, max(args.threads))
+    idle = python_progress(lambda: time.sleep(0.001), args.gil_seconds)
+    print('%8s %10s %8s %12s %12s %8s' % ('kernel', 'progress', 'threads', 'serial', 'concurrent', 'speedup'))
+    for name, fn in kernels:
+        progress = python_progress(fn, args.gil_seconds) / idle
+        t1 = timeit(fn, args.repeat) * threads * args.repeat
+        t2 = concurrent(fn, threads, args.repeat)
+        record('gil', '%s threads=%d' % (name, threads), t2 / (threads * args.repeat))
+        print('%8s %10.2f %8d %10.3fms %10.3fms %7.2fx' % (name, progress, threads, t1 * 1000, t2 * 1000, t1 / t2))
+    pass
+
+def anchor_targets (rs, batch, size, stride, boxes_per_image):
+    # a picpac training sample (meta, images, gt_masks, gt_anchors,
+    # gt_anchors_weight, gt_params, gt_params_weight, gt_boxes) with one
+    # prior: cells whose center is inside a box are positive, params are
+    # dx, dy, w, h as decoded by train.anchors2boxes: the box center
+    # relative to the cell center, and the box size
+    gt_masks, gt_boxes = label_image(rs, batch, size, boxes_per_image)
+    images = rs.uniform(0, 255, (batch, size, size, 3)).astype(np.float32)
+    H = W = size // stride
+    gt_anchors = np.zeros((batch, H, W, 1), dtype=np.int32)
+    gt_params = np.zeros((batch, H, W, 4), dtype=np.float32)
+    gt_params_weight = np.zeros((batch, H, W, 1), dtype=np.float32)
+    # cell centers as train.anchor_centers
+    cy, cx = np.meshgrid(np.arange(H) * stride, np.arange(W) * stride, indexing='ij')
+    for i, _, _, x1, y1, x2, y2 in gt_boxes:
+        inside = (cx >= x1) & (cx <= x2) & (cy >= y1) & (cy <= y2)
+        i = int(i)
+        gt_anchors[i, inside, 0] = 1
+        gt_params_weight[i, inside, 0] = 1
+        bx, by = (x1 + x2) / 2, (y1 + y2) / 2
+        w, h = x2 - x1, y2 - y1
+        gt_params[i, inside] = np.stack([bx - cx, by - cy, np.full_like(cx, w), np.full_like(cy, h)], axis=-1)[inside]
+    gt_anchors_weight = np.ones((batch, H, W, 1), dtype=np.float32)
+    return (None, images, gt_masks, gt_anchors, gt_anchors_weight, gt_params, gt_params_weight, gt_boxes)
+
+def tiny_backbone (net, global_pool=False, output_stride=16):
+    # four stride 2 convolutions in place of a resnet
+    import tensorflow.contrib.slim as slim
+    assert output_stride == 16
+    for filters in [16, 32, 64, 64]:
+        net = slim.conv2d(net, filters, 3, 2)
+    return net, {}
+
+def build_step (args):
+    # train.create_model with tiny_backbone and a plain SGD step, on CPU
+    # returns tensorflow, train, inputs and the train op
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+    import tensorflow as tf
+    import tensorflow.contrib.slim as slim
+    import train
+    train.FLAGS([sys.argv[0]])     # defaults of train.py
+    train.FLAGS.sparse_targets = args.sparse_targets
+    train.FLAGS.max_boxes = args.max_boxes
+    inputs = train.Inputs()
+    with slim.arg_scope([slim.conv2d, slim.conv2d_transpose, slim.max_pool2d], padding='SAME'):
+        loss, _ = train.create_model(inputs, tiny_backbone)
+    train_op = tf.train.GradientDescentOptimizer(0.001).minimize(loss)
+    return tf, train, inputs, train_op
+
+def bench_step (args):
+    # forward and backward of build_step
+    tf, train, inputs, train_op = build_step(args)
+    rs = np.random.RandomState(args.seed)
+    print('%8s %8s %8s %12s %10s' % ('size', 'batch', 'threads', 'step', 'samples/s'))
+    for size in args.step_size:
+        sample = anchor_targets(rs, args.batch, size, train.FLAGS.anchor_stride, args.step_boxes)
+        feed_dict = inputs.feed_dict(sample, True)
+        for threads in args.threads:
+            # per-session pools, the first session would size the
+            # global pools of every thread count
+            config = tf.ConfigProto(intra_op_parallelism_threads=threads, inter_op_parallelism_threads=threads,
+                                    use_per_session_threads=True)
+            with tf.Session(config=config) as sess:
+                sess.run(tf.global_variables_initializer())
+                t = timeit(lambda: sess.run(train_op, feed_dict=feed_dict), args.repeat)
+            record('step', 'size=%d batch=%d threads=%d%s' % (size, args.batch, threads, ' sparse' if args.sparse_targets else ''), t)
+            print('%8d %8d %8d %10.3fms %10.1f' % (size, args.batch, threads, t * 1000, args.batch / t))
+    pass
+
+def bench_budget (args):
+    # training steps while decoder threads keep the cores busy, as
+    # picpac does, with every pool at its default (as many decoders as
+    # cores) and with a ThreadBudget of --cores
+    from threads import ThreadBudget, available_cores
+    tf, train, inputs, train_op = build_step(args)
+    rs = np.random.RandomState(args.seed)
+    cores = args.cores or len(available_cores())
+    sample = anchor_targets(rs, args.batch, args.step_size[0], train.FLAGS.anchor_stride, args.step_boxes)
+    feed_dict = inputs.feed_dict(sample, True)
+    # decoding stand-in: cpp mask extraction (OpenMP, without the GIL)
+    images, mask_gt = label_image(rs, 1, 1024, 100)
+    mask_boxes = np.clip(np.round(jitter_boxes(rs, mask_gt[:, 3:], 0.05)), 0, 1023)
+    extractor = cpp.MaskExtractor(args.mask_size, args.mask_size)
+    budget = ThreadBudget(cores, args.pin)
+    print(budget)
+    print('%8s %8s %12s %10s %10s' % ('config', 'decoders', 'step', 'samples/s', 'decodes/s'))
+    for name, budget, decoders in [('default', ThreadBudget(), cores), ('budget', budget, budget.decode)]:
+        budget.apply()
+        cpp.set_num_threads(budget.omp)     # 0: back to the default
+        stop = threading.Event()
+        decoded = [0]
+        def decode ():
+            while not stop.is_set():
+                extractor.apply(images, mask_gt, mask_boxes)
+                decoded[0] += 1
+            pass
+        # per-session pools, the first session would size the global
+        # pools of both configs
+        config = budget.configure(tf.ConfigProto(use_per_session_threads=True))
+        with tf.Session(config=config) as sess:
+            sess.run(tf.global_variables_initializer())
+            workers = [threading.Thread(target=decode) for _ in range(decoders)]
+            for worker in workers:
+                worker.start()
+            start = time.time()
+            steps = 0
+            while steps < args.repeat or time.time() - start < args.budget_seconds:
+                sess.run(train_op, feed_dict=feed_dict)
+                steps += 1
+            elapsed = time.time() - start
+            stop.set()
+            for worker in workers:
+                worker.join()
+        t = elapsed / steps
+        record('budget', '%s cores=%d size=%d batch=%d' % (name, cores, args.step_size[0], args.batch), t)
+        print('%8s %8d %10.3fms %10.1f %10.1f' % (name, decoders, t * 1000, args.batch / t, decoded[0] / elapsed))
+    pass
+
+BENCHMARKS = {'matcher': bench_matcher,
+              'iou': bench_iou,
+              'mask': bench_mask,
+              'nms': bench_nms,
+              'ap': bench_ap,
+              'step': bench_step,
+              'gil': bench_gil,
+              'budget': bench_budget,
+             }
+
+def compare (results, baseline, tolerance):
+    # prints every case in both, returns the number of regressions,
+    # i.e. cases more than tolerance slower than the baseline
+    base = {(r['bench'], r['case']): r['seconds'] for r in baseline['results']}
+    regressions = 0
+    print('%-8s %-36s %12s %12s %8s' % ('bench', 'case', 'baseline', 'now', 'ratio'))
+    for r in results:
+        key = (r['bench'], r['case'])
+        if not key in base:
+            continue
+        ratio = r['seconds'] / max(base[key], 1e-12)
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = 'REGRESSION'
+            regressions += 1
+        elif ratio < 1 - tolerance:
+            flag = 'faster'
+        print('%-8s %-36s %10.3fms %10.3fms %7.2fx %s' % (r['bench'], r['case'], base[key] * 1000, r['seconds'] * 1000, ratio, flag))
+    return regressions
+
+def main ():
+    parser = argparse.ArgumentParser(description='benchmark the cpp extension')
+    parser.add_argument('bench', nargs='*', default=sorted(set(BENCHMARKS.keys()) - set(['step', 'budget'])), help='benchmarks to run, step and budget need tensorflow')
+    parser.add_argument('--seed', type=int, default=2018)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--batch', type=int, default=1)
+    parser.add_argument('--match_th', type=float, default=0.5)
+    parser.add_argument('--anchor_th', type=float, default=0.5)
+    parser.add_argument('--nms_th', type=float, default=0.5)
+    parser.add_argument('--max_boxes', type=int, default=10000)
+    parser.add_argument('--gt', type=int, nargs='+', default=[10, 100, 1000, 3000])
+    parser.add_argument('--ratio', type=int, default=4, help='proposals per gt box')
+    parser.add_argument('--mask_size', type=int, default=128)
+    parser.add_argument('--threads', type=int, nargs='+', default=[1], help='thread counts of matcher, mask and step')
+    parser.add_argument('--cores', type=int, default=0, help='budget: cores to split, 0 for all available')
+    parser.add_argument('--pin', action='store_true', help='budget: pin to the cores')
+    parser.add_argument('--budget_seconds', type=float, default=10.0, help='budget: duration of each run')
+    parser.add_argument('--gil_seconds', type=float, default=1.0, help='duration of each gil measurement')
+    parser.add_argument('--step_size', type=int, nargs='+', default=[256, 512], help='image sizes of step')
+    parser.add_argument('--step_boxes', type=int, default=20, help='boxes per image of step')
+    parser.add_argument('--sparse_targets', action='store_true', help='step with sparse params targets')
+    parser.add_argument('--json', default=None, help='write results to this file')
+    parser.add_argument('--baseline', default=None, help='compare with results written by --json')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='slowdown over baseline reported as regression')
+    args = parser.parse_args()
+    for name in args.bench:
+        print('== %s' % name)
+        BENCHMARKS[name](args)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'time': time.time(),
+                       'host': socket.gethostname(),
+                       'cpus': multiprocessing.cpu_count(),
+                       'numpy': np.__version__,
+                       'args': vars(args),
+                       'results': RESULTS}, f, indent=1)
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        print('== compare with %s' % args.baseline)
+        regressions = compare(RESULTS, baseline, args.tolerance)
+        if regressions > 0:
+            print('%d regressions' % regressions)
+            sys.exit(1)
+    pass
+
+if __name__ == '__main__':
+    main()
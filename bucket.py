@@ -0,0 +1,126 @@
+import collections
+import numpy as np
+
+def parse_sizes (text, stride):
+    # "512,768,1024" -> [512, 768, 1024]
+    sizes = sorted(int(x) for x in text.split(',') if x.strip())
+    for size in sizes:
+        assert size % stride == 0, 'bucket size %d is not a multiple of %d' % (size, stride)
+    return sizes
+
+class BucketBatcher:
+    """Batches of variable-size picpac samples.
+
+    stream must produce samples of one image (picpac batch 1).  Height
+    and width are each rounded up to the smallest of sizes, samples are
+    collected per bucket, and once a bucket has batch samples they are
+    zero-padded to the bucket and stacked.  An image with a side larger
+    than all sizes is passed on as a batch of its own, unpadded, rather
+    than waiting in a bucket of its exact shape.  Padding has zero anchor and params weights so it adds
+    nothing to the losses.  Arrays of 4 dimensions are padded in
+    proportion to their size relative to the image (gt_masks at full,
+    anchors and params at anchor_stride resolution); arrays of 2
+    dimensions are boxes whose column 0 is the image index, renumbered
+    to the position in the batch.  When a non-looping stream ends, the
+    remaining partial batches are produced.  meta of the batches is None.
+
+    waste() is the fraction of produced image pixels that are padding.
+    """
+    def __init__ (self, stream, batch, sizes):
+        assert batch >= 1
+        self.stream = stream
+        self.batch = batch
+        self.sizes = sorted(sizes)
+        self.pending = collections.defaultdict(list)
+        self.ready = collections.deque()
+        self.pixels = 0     # of the images
+        self.padded = 0     # of the batches
+        pass
+
+    def round (self, x):
+        # None if x is larger than all sizes
+        for size in self.sizes:
+            if x <= size:
+                return size
+        return None
+
+    def next (self):
+        while not self.ready:
+            try:
+                sample = self.stream.next()
+            except StopIteration:
+                if not self.pending:
+                    raise
+                for key in sorted(self.pending.keys()):
+                    self.ready.append(self.assemble(key, self.pending[key]))
+                self.pending.clear()
+                break
+            images = sample[1]
+            assert images.shape[0] == 1, 'bucketing needs picpac batch 1'
+            key = (self.round(images.shape[1]), self.round(images.shape[2]))
+            if None in key:
+                self.ready.append(self.assemble(images.shape[1:3], [sample]))
+                continue
+            samples = self.pending[key]
+            samples.append(sample)
+            if len(samples) >= self.batch:
+                del self.pending[key]
+                self.ready.append(self.assemble(key, samples))
+        return self.ready.popleft()
+
+    def assemble (self, key, samples):
+        BH, BW = key
+        batch = [None]
+        for field in range(1, len(samples[0])):
+            arrays = [sample[field] for sample in samples]
+            if arrays[0].ndim == 4:
+                H, W = samples[0][1].shape[1:3]
+                _, h, w, C = arrays[0].shape
+                out = np.zeros((len(arrays), BH * h // H, BW * w // W, C), dtype=arrays[0].dtype)
+                for i, (sample, array) in enumerate(zip(samples, arrays)):
+                    H, W = sample[1].shape[1:3]
+                    _, h, w, _ = array.shape
+                    assert BH * h % H == 0 and BW * w % W == 0
+                    out[i, :h, :w, :] = array[0]
+            else:
+                assert arrays[0].ndim == 2
+                boxes = []
+                for i, array in enumerate(arrays):
+                    array = np.array(array)
+                    array[:, 0] = i
+                    boxes.append(array)
+                out = np.concatenate(boxes)
+            batch.append(out)
+        for sample in samples:
+            self.pixels += sample[1].shape[1] * sample[1].shape[2]
+        self.padded += len(samples) * BH * BW
+        return tuple(batch)
+
+    def waste (self):
+        return padding_waste([self])
+
+    def size (self):
+        return self.stream.size()
+
+    def reset (self):
+        self.stream.reset()
+        self.pending.clear()
+        self.ready.clear()
+        pass
+
+    def __iter__ (self):
+        while True:
+            try:
+                sample = self.next()
+            except StopIteration:
+                return
+            yield sample
+    pass
+
+def padding_waste (streams):
+    # fraction of the produced image pixels that are padding, over the
+    # BucketBatcher streams among streams
+    batchers = [stream for stream in streams if isinstance(stream, BucketBatcher)]
+    pixels = sum(stream.pixels for stream in batchers)
+    padded = sum(stream.padded for stream in batchers)
+    return 1.0 - float(pixels) / padded if padded else 0.0
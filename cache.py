@@ -0,0 +1,140 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+
+def sha1 (text, n):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:n]
+
+def cache_key (db_path, config):
+    # <basename>-<path hash>-<hash>, the last part changes with the db
+    # file and with any part of the stream config; caches of the same
+    # db share all but that part
+    path = os.path.abspath(db_path)
+    st = os.stat(db_path)
+    key = json.dumps({'db': path,
+                      'size': st.st_size,
+                      'mtime': st.st_mtime,
+                      'config': config}, sort_keys=True)
+    return '%s-%s-%s' % (os.path.basename(db_path), sha1(path, 8), sha1(key, 16))
+
+class CachedStream:
+    """A non-looping picpac stream whose batches are kept on disk.
+
+    The first pass reads batches from create_stream() and, while
+    yielding them, appends every array of every batch to one file per
+    tuple position under <dir>/<key>; when the pass completes the
+    directory is renamed into place with an index of offsets and shapes.
+    Later passes memory map those files and yield views into them, with
+    no decoding or transforms.  key (see cache_key) covers the db and the
+    stream config; caches of the same db with other keys are removed.
+
+    Samples have the same layout as the stream's, except that meta is
+    None.
+    """
+    def __init__ (self, dir, key, create_stream):
+        self.dir = dir
+        self.key = key
+        self.path = os.path.join(dir, key)
+        self.create_stream = create_stream
+        self.stream = None
+        self.index = None
+        try:
+            os.makedirs(dir)
+        except OSError:
+            pass
+        self.load()
+        pass
+
+    def load (self):
+        index = os.path.join(self.path, 'index.json')
+        if not os.path.exists(index):
+            return
+        with open(index, 'r') as f:
+            self.index = json.load(f)
+        self.arrays = []
+        for i in range(self.index['fields']):
+            path = os.path.join(self.path, '%d.bin' % i)
+            if os.path.getsize(path) == 0:     # can not map empty files
+                self.arrays.append(np.zeros(0, dtype=np.uint8))
+            else:
+                self.arrays.append(np.memmap(path, dtype=np.uint8, mode='r'))
+        pass
+
+    def size (self):
+        if self.index:
+            return self.index['size']
+        if self.stream is None:
+            self.stream = self.create_stream()
+        return self.stream.size()
+
+    def reset (self):
+        if self.stream:
+            self.stream.reset()
+        pass
+
+    def __iter__ (self):
+        if self.index:
+            return self.read()
+        return self.write()
+
+    def read (self):
+        for batch in self.index['batches']:
+            sample = [None]
+            for array, (offset, dtype, shape) in zip(self.arrays, batch):
+                n = int(np.prod(shape)) * np.dtype(dtype).itemsize
+                sample.append(array[offset:offset+n].view(dtype).reshape(shape))
+            yield tuple(sample)
+        pass
+
+    def write (self):
+        if self.stream is None:
+            self.stream = self.create_stream()
+        # another process (trainer and evaluator) may be filling the
+        # same cache, each writes its own temporary directory
+        tmp = '%s.%d.tmp' % (self.path, os.getpid())
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        files = []
+        batches = []
+        size = 0
+        try:
+            self.stream.reset()
+            for sample in self.stream:
+                if not files:
+                    files = [open(os.path.join(tmp, '%d.bin' % i), 'wb') for i in range(len(sample) - 1)]
+                batch = []
+                for f, v in zip(files, sample[1:]):
+                    v = np.ascontiguousarray(v)
+                    batch.append((f.tell(), v.dtype.str, list(v.shape)))
+                    f.write(v.tobytes())
+                batches.append(batch)
+                size += sample[1].shape[0]
+                yield sample
+        except BaseException:
+            # incomplete pass, e.g. the consumer stopped early
+            for f in files:
+                f.close()
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        for f in files:
+            f.close()
+        with open(os.path.join(tmp, 'index.json'), 'w') as f:
+            json.dump({'size': size, 'fields': len(files), 'batches': batches}, f)
+        # caches of this db with other keys are stale; the prefix
+        # includes the path hash, dbs of the same name elsewhere are
+        # left alone
+        prefix = self.key.rsplit('-', 1)[0] + '-'
+        for name in os.listdir(self.dir):
+            if name.startswith(prefix) and name != self.key and not name.endswith('.tmp'):
+                shutil.rmtree(os.path.join(self.dir, name), ignore_errors=True)
+        try:
+            os.rename(tmp, self.path)
+        except OSError:
+            # someone else completed it first
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.stream = None
+        self.load()
+        pass
+    pass
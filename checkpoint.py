@@ -0,0 +1,111 @@
+import os
+import glob
+import time
+import shutil
+import threading
+import tensorflow as tf
+
+class AsyncSaver:
+    """Writes checkpoints in a background thread.
+
+    save() copies the variables to host memory with one sess.run and
+    returns; the copy is written by a tf.train.Saver in a separate graph
+    whose variables are initialized from it.  At most one write is
+    pending: save() first waits for the previous one.  Files are written
+    to a temporary directory and renamed into place, the .index last, so
+    a checkpoint that can be found is complete.  A copy of the training
+    graph's meta graph, exported once, is written next to each
+    checkpoint like saver.save does.
+
+    The most recent max_to_keep checkpoints are kept (all if 0), plus
+    one every keep_every_hours; the others are deleted and the directory's
+    checkpoint state file is updated after every write.
+    """
+    def __init__ (self, saver, max_to_keep=5, keep_every_hours=10000.0, var_list=None):
+        self.variables = var_list or tf.global_variables()
+        self.meta_graph = tf.train.export_meta_graph(saver_def=saver.saver_def).SerializeToString()
+        self.max_to_keep = max_to_keep
+        self.keep_every = keep_every_hours * 3600
+        self.last_kept = time.time()
+        self.checkpoints = []       # (path, time), oldest first
+        self.thread = None
+        self.error = None
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.inputs = []
+            shadows = {}
+            for var in self.variables:
+                value = tf.placeholder(var.dtype.base_dtype, shape=var.shape)
+                shadow = tf.Variable(value, trainable=False, collections=[])
+                self.inputs.append(value)
+                shadows[var.op.name] = shadow
+            self.init = tf.group(*[shadow.initializer for shadow in shadows.values()])
+            self.saver = tf.train.Saver(shadows, max_to_keep=None)
+        # own small thread pools: the first session of a process sizes
+        # the global pools, which belong to the training session
+        config = tf.ConfigProto(device_count={'GPU': 0},
+                                use_per_session_threads=True,
+                                intra_op_parallelism_threads=1,
+                                inter_op_parallelism_threads=1)
+        self.sess = tf.Session(graph=self.graph, config=config)
+        pass
+
+    def save (self, sess, path):
+        self.wait()
+        values = sess.run(self.variables)
+        self.thread = threading.Thread(target=self.run, args=(values, path))
+        self.thread.start()
+        pass
+
+    def wait (self):
+        # blocks until the pending write is done, raising its error if any
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        if self.error:
+            error, self.error = self.error, None
+            raise error
+        pass
+
+    def run (self, values, path):
+        try:
+            self.write(values, path)
+            self.retain(path)
+        except Exception as e:
+            self.error = e
+        pass
+
+    def write (self, values, path):
+        dirname, basename = os.path.split(os.path.abspath(path))
+        tmp = os.path.join(dirname, '.%s.tmp' % basename)
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        self.sess.run(self.init, feed_dict=dict(zip(self.inputs, values)))
+        self.saver.save(self.sess, os.path.join(tmp, basename), write_meta_graph=False, write_state=False)
+        with open(os.path.join(tmp, basename + '.meta'), 'wb') as f:
+            f.write(self.meta_graph)
+        index = basename + '.index'
+        for name in sorted(os.listdir(tmp), key=lambda name: name == index):
+            os.rename(os.path.join(tmp, name), os.path.join(dirname, name))
+        os.rmdir(tmp)
+        pass
+
+    def retain (self, path):
+        now = time.time()
+        self.checkpoints.append((path, now))
+        while self.max_to_keep and len(self.checkpoints) > self.max_to_keep:
+            old, saved = self.checkpoints.pop(0)
+            if saved - self.last_kept >= self.keep_every:
+                self.last_kept = saved
+                continue
+            for name in glob.glob(glob.escape(old) + '.*'):
+                os.remove(name)
+        tf.train.update_checkpoint_state(os.path.dirname(os.path.abspath(path)), path,
+                    all_model_checkpoint_paths=[p for p, _ in self.checkpoints])
+        pass
+
+    def close (self):
+        self.wait()
+        self.sess.close()
+        pass
+    pass
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# Evaluates checkpoints written by train.py in a separate process:
+#
+#   ./evaluate.py --model model --val_db val.db [--poll 60] [--once]
+#
+# Watches --model for new checkpoints, restores each into an inference
+# graph built with the same flags as train.py, runs --val_db once and
+# appends metrics, box precision, recall and AP to --results.
+import os
+import time
+import glob
+import json
+import numpy as np
+import tensorflow as tf
+import train
+from streaming import JsonLog
+
+flags = tf.app.flags
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer('poll', 60, 'seconds between looking for new checkpoints')
+flags.DEFINE_boolean('once', False, 'evaluate the checkpoints found and exit')
+flags.DEFINE_string('results', None, 'JSONL results, default is eval.jsonl in the model directory')
+flags.DEFINE_integer('eval_threads', 0, 'intra-op threads, 0 for all cores')
+
+def list_checkpoints (model):
+    # complete checkpoints, oldest first; the .index file is written last
+    paths = glob.glob(os.path.join(model, '*.index'))
+    paths.sort(key=lambda path: os.path.getmtime(path))
+    return [path[:-len('.index')] for path in paths]
+
+def evaluated (path):
+    # checkpoints already in the results log
+    done = set()
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            for l in f:
+                done.add(json.loads(l)['checkpoint'])
+    return done
+
+def main (_):
+    assert FLAGS.model and FLAGS.val_db
+    results = FLAGS.results or os.path.join(FLAGS.model, 'eval.jsonl')
+    done = evaluated(results)
+    jsonl = JsonLog(results)
+
+    # --cores, --pin_cores and --core_offset as in train.py
+    train.BUDGET = train.ThreadBudget(FLAGS.cores, FLAGS.pin_cores, FLAGS.core_offset)
+    train.BUDGET.apply()
+    inputs = train.Inputs()
+    loss, metrics = train.build_model(inputs)
+    metric_names = [x.name[:-2] for x in metrics]
+    saver = tf.train.Saver(tf.global_variables())
+    stream = train.create_val_stream(FLAGS.val_db)
+
+    config = tf.ConfigProto()
+    config.gpu_options.allow_growth=True
+    config.intra_op_parallelism_threads = FLAGS.eval_threads
+    train.BUDGET.configure(config)
+    with tf.Session(config=config) as sess:
+        while True:
+            for ckpt in list_checkpoints(FLAGS.model):
+                if ckpt in done:
+                    continue
+                try:
+                    saver.restore(sess, ckpt)
+                except tf.errors.NotFoundError:
+                    # removed by the retention policy in the meantime
+                    continue
+                start_time = time.time()
+                avg, precision, recall, ap, aps = train.validate(sess, inputs, stream, metrics)
+                record = dict(zip(metric_names, [float(x) for x in avg]))
+                record.update(aps)
+                jsonl.write(checkpoint=ckpt, time=time.time(), precision=precision, recall=recall, ap=ap, **record)
+                done.add(ckpt)
+                print('%s precision=%.3f recall=%.3f ap=%.3f %.1fs' % (ckpt, precision, recall, ap, time.time() - start_time))
+            if FLAGS.once:
+                break
+            time.sleep(FLAGS.poll)
+    pass
+
+if __name__ == '__main__':
+    try:
+        tf.app.run()
+    except KeyboardInterrupt:
+        pass
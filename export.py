@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# Freezes a checkpoint into an inference graph for predict-anchors.py:
+#
+#   ./export.py --model model/100 [--output model/100.pb]
+#
+# The graph is cut to images -> logits, params, with is_training fixed
+# to False, variables turned into constants, the batch norm branch for
+# training removed, constants folded and batch norms folded into the
+# preceding convolutions.  inference.Model loads .pb files directly.
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+import time
+import collections
+import numpy as np
+import tensorflow as tf
+from tensorflow.core.framework import attr_value_pb2
+from tensorflow.python.grappler import tf_optimizer
+from tensorflow.tools.graph_transforms import TransformGraph
+from inference import Model, session_config
+
+flags = tf.app.flags
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('model', None, 'checkpoint')
+flags.DEFINE_string('output', None, 'frozen graph, default is <model>.pb')
+flags.DEFINE_string('outputs', 'logits,params', '')
+flags.DEFINE_boolean('optimize', True, 'fold constants and batch norms')
+flags.DEFINE_integer('check_size', 512, 'compare with the checkpoint on a random image of this size, 0 to skip')
+
+INPUT = 'images'
+
+def fix_inputs (graph_def):
+    # images becomes a plain placeholder (it may be a placeholder_with_default
+    # over the training input pipeline), is_training a constant False
+    for node in graph_def.node:
+        if node.name == INPUT and node.op == 'PlaceholderWithDefault':
+            node.op = 'Placeholder'
+            del node.input[:]
+        elif node.name == 'is_training':
+            node.op = 'Const'
+            del node.input[:]
+            node.attr.pop('shape', None)
+            node.attr['value'].CopyFrom(attr_value_pb2.AttrValue(tensor=tf.make_tensor_proto(False)))
+    return graph_def
+
+def freeze (ckpt, outputs):
+    graph = tf.Graph()
+    with graph.as_default():
+        saver = tf.train.import_meta_graph(ckpt + '.meta', clear_devices=True)
+        with tf.Session(graph=graph) as sess:
+            saver.restore(sess, ckpt)
+            graph_def = fix_inputs(graph.as_graph_def())
+            return tf.graph_util.convert_variables_to_constants(sess, graph_def, outputs)
+
+def optimize (graph_def, outputs):
+    # grappler resolves the batch norm conds on the constant is_training
+    # and folds constants; graph_transforms then folds the inference
+    # batch norms into conv weights
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(graph_def, name='')
+        for name in outputs:
+            graph.add_to_collection('train_op', graph.get_operation_by_name(name))
+        meta_graph = tf.train.export_meta_graph(graph=graph)
+    config = tf.ConfigProto()
+    config.graph_options.rewrite_options.optimizers.extend(['constfold', 'loop', 'dependency', 'arithmetic', 'constfold'])
+    graph_def = tf_optimizer.OptimizeGraph(config, meta_graph)
+    return TransformGraph(graph_def, [INPUT], outputs, [
+                'strip_unused_nodes',
+                'remove_nodes(op=Identity, op=CheckNumerics)',
+                'fold_constants(ignore_errors=true)',
+                'fold_batch_norms',
+                'fold_old_batch_norms',
+                'sort_by_execution_order'])
+
+def count_ops (graph_def):
+    return collections.Counter(node.op for node in graph_def.node)
+
+def check (ckpt, path, size):
+    # max abs difference of the outputs of checkpoint and frozen graph
+    image = np.random.RandomState(0).uniform(0, 255, (1, size, size, 3)).astype(np.float32)
+    outputs = []
+    for p in [ckpt, path]:
+        graph = tf.Graph()
+        with graph.as_default():
+            X = tf.placeholder(tf.float32, shape=(None, None, None, 3), name="images")
+            is_training = tf.placeholder(tf.bool, name="is_training")
+            model = Model(X, is_training, p, 'xxx')
+            with tf.Session(graph=graph, config=session_config()) as sess:
+                start_time = time.time()
+                model.loader(sess)
+                feed_dict = {X: image, is_training: False}
+                outputs.append(sess.run([model.logits, model.params], feed_dict=feed_dict))
+                first = time.time() - start_time
+                start_time = time.time()
+                for _ in range(5):
+                    sess.run([model.logits, model.params], feed_dict=feed_dict)
+                print('%s: load+first=%.3fs run=%.3fs' % (p, first, (time.time() - start_time) / 5))
+    return max(float(np.max(np.abs(a - b))) for a, b in zip(*outputs))
+
+def main (_):
+    assert FLAGS.model
+    output = FLAGS.output or FLAGS.model + '.pb'
+    outputs = FLAGS.outputs.split(',')
+    graph_def = freeze(FLAGS.model, outputs)
+    before = count_ops(graph_def)
+    if FLAGS.optimize:
+        graph_def = optimize(graph_def, outputs)
+    after = count_ops(graph_def)
+    for op in sorted(set(before) | set(after)):
+        print('%-24s %6d %6d' % (op, before[op], after[op]))
+    print('%d nodes -> %d nodes' % (sum(before.values()), sum(after.values())))
+    with open(output, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    print('saved to %s.' % output)
+    if FLAGS.check_size > 0:
+        print('max abs diff: %g' % check(FLAGS.model, output, FLAGS.check_size))
+    pass
+
+if __name__ == '__main__':
+    tf.app.run()
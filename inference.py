@@ -0,0 +1,183 @@
+import os
+import glob
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.framework import meta_graph
+import cpp
+
+IMAGE_EXTS = ['.png', '.jpg', '.jpeg', '.tif', '.tiff', '.bmp']
+
+def load_graph (path):
+    # (graph_def, saver_def) of a checkpoint, or of a frozen graph
+    # written by export.py, which has no saver_def
+    if path.endswith('.pb'):
+        graph_def = tf.GraphDef()
+        with open(path, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        return graph_def, None
+    mg = meta_graph.read_meta_graph_file(path + '.meta')
+    return mg.graph_def, mg.saver_def
+
+def input_dtype (graph_def):
+    # float32, or uint8 for models trained with --uint8
+    for node in graph_def.node:
+        if node.name == 'images':
+            return tf.as_dtype(node.attr['dtype'].type)
+    return tf.float32
+
+class Model:
+    # path is a checkpoint, or a frozen graph written by export.py;
+    # X is cast to the input type of the model if needed
+    def __init__ (self, X, is_training, path, name):
+        graph_def, saver_def = load_graph(path)
+        dtype = input_dtype(graph_def)
+        if X.dtype != dtype:
+            X = tf.cast(X, dtype)
+        input_map = {'images:0': X}
+        if saver_def:
+            input_map['is_training:0'] = is_training
+        # in frozen graphs is_training is already fixed to False
+        self.logits, self.params = tf.import_graph_def(graph_def, name=name,
+                    input_map=input_map,
+                    return_elements=['logits:0', 'params:0'])
+        self.prob = tf.squeeze(tf.slice(tf.nn.softmax(self.logits), [0,0,0,1], [-1,-1,-1,1]), 3)
+        if saver_def:
+            self.saver = tf.train.Saver(saver_def=saver_def, name=name)
+            self.loader = lambda sess: self.saver.restore(sess, path)
+        else:
+            self.loader = lambda sess: None
+        pass
+    pass
+
+def session_config (xla=False, budget=None):
+    # budget: optional threads.ThreadBudget
+    config = tf.ConfigProto()
+    config.gpu_options.allow_growth=True
+    if budget:
+        budget.configure(config)
+    if xla:
+        # JIT compile clusters of the graph with XLA
+        config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+    return config
+
+def precision_path (path, precision):
+    # where quantize.py saves the int8/fp16 version of a frozen graph
+    if path.endswith('.pb'):
+        path = path[:-len('.pb')]
+    return '%s.%s.pb' % (path, precision)
+
+def crop_to_stride (image, stride):
+    H, W = image.shape[:2]
+    H = H // stride * stride
+    W = W // stride * stride
+    return image[:H, :W, :]
+
+def list_images (spec):
+    if os.path.isdir(spec):
+        paths = [os.path.join(spec, f) for f in os.listdir(spec)]
+        return sorted([p for p in paths if os.path.splitext(p)[1].lower() in IMAGE_EXTS])
+    if any(c in spec for c in '*?['):
+        return sorted(glob.glob(spec))
+    if os.path.splitext(spec)[1] in ['.txt', '.list']:
+        with open(spec, 'r') as f:
+            return [l.strip() for l in f if l.strip()]
+    assert os.path.exists(spec)
+    return [spec]
+
+def decode_proposals (prob, params, stride, th, x0=0, y0=0):
+    # prob:     H * W
+    # params:   H * W * k, dx, dy, w, h for boxes, dx, dy, r for circles
+    # the anchor of cell (row, col) is at (x0 + col * stride, y0 + row * stride)
+    # returns N * 5 float32: x1, y1, x2, y2, score for cells with prob >= th
+    rows, cols = np.nonzero(prob >= th)
+    p = params[rows, cols]
+    cx = x0 + cols * stride + p[:, 0]
+    cy = y0 + rows * stride + p[:, 1]
+    if p.shape[1] == 3:
+        hw = hh = p[:, 2]
+    else:
+        hw = p[:, 2] / 2
+        hh = p[:, 3] / 2
+    return np.stack([cx - hw, cy - hh, cx + hw, cy + hh, prob[rows, cols]], axis=1).astype(np.float32)
+
+def nms (boxes, th, max_boxes=1000000):
+    # boxes: N * 5 as from decode_proposals
+    if boxes.shape[0] == 0:
+        return boxes
+    scores = np.ascontiguousarray(boxes[:, 4])
+    sel = cpp.NMS(max_boxes, 0).apply(scores, np.ascontiguousarray(boxes[:, :4]),
+                    np.zeros(boxes.shape[0], dtype=np.int32), -np.inf, th)[0]
+    return boxes[sel]
+
+# one row per proposal; image indexes the list of image paths
+PROPOSAL_DTYPE = np.dtype([('x1', np.float32), ('y1', np.float32),
+                           ('x2', np.float32), ('y2', np.float32),
+                           ('score', np.float32), ('image', np.int32)])
+
+def proposal_records (boxes, image):
+    # boxes: N * 5 as from decode_proposals
+    records = np.empty(boxes.shape[0], dtype=PROPOSAL_DTYPE)
+    for i, name in enumerate(PROPOSAL_DTYPE.names[:5]):
+        records[name] = boxes[:, i]
+    records['image'] = image
+    return records
+
+class ProposalWriter:
+    # Writes proposals of many images column by column:
+    #   <prefix>.00000.npz, <prefix>.00001.npz, ...
+    #           one array per PROPOSAL_DTYPE field, about chunk rows each
+    #   <prefix>.images.txt
+    #           image paths, line i is image i
+    def __init__ (self, prefix, chunk=1000000):
+        self.prefix = prefix
+        self.chunk = chunk
+        self.paths = []
+        self.parts = []
+        self.size = 0
+        self.chunks = 0
+        pass
+
+    def add (self, path, boxes):
+        self.parts.append(proposal_records(boxes, len(self.paths)))
+        self.paths.append(path)
+        self.size += boxes.shape[0]
+        if self.size >= self.chunk:
+            self.flush()
+        pass
+
+    def flush (self):
+        if self.size == 0:
+            return
+        records = np.concatenate(self.parts)
+        np.savez('%s.%05d.npz' % (self.prefix, self.chunks),
+                 **{name: records[name] for name in PROPOSAL_DTYPE.names})
+        self.parts = []
+        self.size = 0
+        self.chunks += 1
+        pass
+
+    def close (self):
+        self.flush()
+        with open(self.prefix + '.images.txt', 'w') as f:
+            for path in self.paths:
+                f.write(path + '\n')
+        pass
+    pass
+
+def load_proposals (prefix, columns=None):
+    # returns (records, paths) as written by ProposalWriter;
+    # columns limits the fields loaded
+    columns = columns or PROPOSAL_DTYPE.names
+    parts = []
+    for path in sorted(glob.glob(glob.escape(prefix) + '.[0-9][0-9][0-9][0-9][0-9].npz')):
+        with np.load(path) as chunk:
+            n = chunk[columns[0]].shape[0]
+            records = np.empty(n, dtype=[(name, PROPOSAL_DTYPE[name]) for name in columns])
+            for name in columns:
+                records[name] = chunk[name]
+            parts.append(records)
+    with open(prefix + '.images.txt', 'r') as f:
+        paths = [l.rstrip('\n') for l in f]
+    if not parts:
+        return np.empty(0, dtype=[(name, PROPOSAL_DTYPE[name]) for name in columns]), paths
+    return np.concatenate(parts), paths
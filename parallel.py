@@ -0,0 +1,97 @@
+import os
+import shutil
+import tempfile
+import multiprocessing
+import numpy as np
+import tensorflow as tf
+
+class AllReduce:
+    """Gradient averaging between local worker processes.
+
+    Create it in the parent before forking the workers; each worker calls
+    attach(rank).  Gradients are exchanged through a file in /dev/shm
+    mapped by all workers: every worker writes its flattened gradients
+    into its own row, then averages one slice of the columns into the
+    result row (reduce-scatter), then reads the whole result row
+    (all-gather).  Two barriers per step keep the rows from being
+    overwritten while still in use.
+    """
+    def __init__ (self, workers):
+        self.workers = workers
+        self.context = multiprocessing.get_context('fork')
+        self.barrier = self.context.Barrier(workers)
+        self.dir = tempfile.mkdtemp(prefix='box-allreduce-',
+                        dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+        self.rank = 0
+        self.buffer = None
+        pass
+
+    def attach (self, rank):
+        self.rank = rank
+        pass
+
+    def setup (self, size):
+        # all workers build the same graph, so agree on size
+        path = os.path.join(self.dir, 'gradients')
+        shape = (self.workers + 1, size)
+        if self.rank == 0:
+            self.buffer = np.memmap(path, dtype=np.float32, mode='w+', shape=shape)
+        self.barrier.wait()
+        if self.rank != 0:
+            self.buffer = np.memmap(path, dtype=np.float32, mode='r+', shape=shape)
+        self.bounds = np.linspace(0, size, self.workers + 1).astype(np.int64)
+        pass
+
+    def apply (self, grads):
+        # grads: flat float32 gradients of this worker, returns the mean
+        if self.buffer is None:
+            self.setup(grads.size)
+        rows = self.buffer[:self.workers]
+        result = self.buffer[self.workers]
+        rows[self.rank] = grads
+        self.barrier.wait()
+        begin, end = self.bounds[self.rank], self.bounds[self.rank + 1]
+        np.mean(rows[:, begin:end], axis=0, out=result[begin:end])
+        self.barrier.wait()
+        return np.array(result)
+
+    def transform_grads (self, grads_and_vars):
+        # transform_grads_fn for tf.contrib.training.create_train_op
+        pairs = [(grad, var) for grad, var in grads_and_vars if not grad is None]
+        sizes = [var.shape.num_elements() for _, var in pairs]
+        flat = tf.concat([tf.reshape(tf.convert_to_tensor(grad), (-1,)) for grad, _ in pairs], 0)
+        mean = tf.py_func(self.apply, [flat], tf.float32)
+        mean.set_shape(flat.shape)
+        averaged = [(tf.reshape(grad, var.shape), var) for grad, (_, var) in zip(tf.split(mean, sizes), pairs)]
+        return averaged + [(grad, var) for grad, var in grads_and_vars if grad is None]
+
+    def sync (self, sess, saver):
+        # copies variables of worker 0 to the others
+        path = os.path.join(self.dir, 'init')
+        if self.rank == 0:
+            saver.save(sess, path, write_meta_graph=False, write_state=False)
+        self.barrier.wait()
+        if self.rank != 0:
+            saver.restore(sess, path)
+        self.barrier.wait()
+        pass
+
+    def run (self, target):
+        # runs target(rank) in each of the worker processes; if one fails
+        # the others, likely stuck at a barrier, are terminated
+        procs = [self.context.Process(target=target, args=(rank,)) for rank in range(self.workers)]
+        for proc in procs:
+            proc.start()
+        try:
+            while any(proc.is_alive() for proc in procs):
+                for proc in procs:
+                    proc.join(1)
+                    if proc.exitcode:
+                        raise RuntimeError('worker %d exited with %d' % (procs.index(proc), proc.exitcode))
+        finally:
+            for proc in procs:
+                if proc.is_alive():
+                    proc.terminate()
+            shutil.rmtree(self.dir, ignore_errors=True)
+        pass
+    pass
@@ -5,37 +5,53 @@ os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 sys.path.insert(0, 'build/lib.linux-x86_64-3.5')
 sys.path.insert(0, '../picpac/build/lib.linux-x86_64-3.5')
 import time
+import collections
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 import numpy as np
 import cv2
 from skimage import measure
 # RESNET: import these for slim version of resnet
 import tensorflow as tf
-from tensorflow.python.framework import meta_graph
 import picpac
 import cpp
-
-class Model:
-    def __init__ (self, X, is_training, path, name):
-        mg = meta_graph.read_meta_graph_file(path + '.meta')
-        self.logits, self.params = tf.import_graph_def(mg.graph_def, name=name,
-                    input_map={'images:0': X, 'is_training:0': is_training},
-                    return_elements=['logits:0', 'params:0'])
-        self.prob = tf.squeeze(tf.slice(tf.nn.softmax(self.logits), [0,0,0,1], [-1,-1,-1,1]), 3)
-        self.saver = tf.train.Saver(saver_def=mg.saver_def, name=name)
-        self.loader = lambda sess: self.saver.restore(sess, path)
-        pass
-    pass
+from threads import ThreadBudget
+from inference import Model, session_config, precision_path, load_graph, input_dtype, list_images, crop_to_stride, decode_proposals, nms, ProposalWriter
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+try:
+    import openslide
+except ImportError:
+    openslide = None
 
 flags = tf.app.flags
 FLAGS = flags.FLAGS
 
-flags.DEFINE_string('model', None, '')
-flags.DEFINE_string('input', None, '')
+flags.DEFINE_string('model', None, 'checkpoint, or frozen graph (.pb) from export.py')
+flags.DEFINE_boolean('xla', False, 'compile with XLA JIT')
+flags.DEFINE_integer('cores', 0, 'cores shared by TF and the cpp OpenMP loops, 0 for defaults')
+flags.DEFINE_boolean('pin_cores', False, 'run on cores core_offset .. core_offset+cores-1 only')
+flags.DEFINE_integer('core_offset', 0, '')
+flags.DEFINE_string('precision', 'float', 'float, or int8/fp16 to load the graph written by quantize.py')
+flags.DEFINE_string('input', None, 'image, directory, glob pattern, or .txt/.list file of paths')
+flags.DEFINE_string('output', None, 'output directory, default is next to the input')
 flags.DEFINE_float('cth', 0.5, '')
 flags.DEFINE_float('th', 0.5, '')
 flags.DEFINE_integer('stride', 16, '')
 flags.DEFINE_string('shape', 'Circle', '')
+flags.DEFINE_integer('batch', 8, 'images of the same size are run in batches of this size')
+flags.DEFINE_integer('threads', 4, 'threads for reading and writing images')
+flags.DEFINE_integer('tile', 0, 'tile size for large images, 0 to run each image whole')
+flags.DEFINE_integer('overlap', 128, 'overlap between tiles')
+flags.DEFINE_boolean('tile_maps', False, 'also save stitched prob/params maps as .npy')
+flags.DEFINE_integer('max_boxes', 1000000, '')
+flags.DEFINE_string('proposals', None, 'prefix of proposal output, default is <output>/proposals')
+flags.DEFINE_integer('chunk', 1000000, 'proposals per output chunk')
+flags.DEFINE_boolean('visualize', False, 'also draw proposals into .prob.png files')
+
+SLIDE_EXTS = ['.svs', '.ndpi', '.mrxs', '.scn', '.vms', '.vmu']
 
 
 def save_prediction_image (path, image, prob, params):
@@ -48,32 +64,209 @@ def save_prediction_image (path, image, prob, params):
     assert H // Hm == W // Wm
     prop = getattr(picpac, FLAGS.shape + 'Proposal')(H//Hm, FLAGS.cth, FLAGS.th)
     vis = np.copy(image).astype(np.float32)
-    x = prop.apply(prob, params, vis)
-
+    prop.apply(prob, params, vis)
     cv2.imwrite(path, vis)
-    print(x[:, 2] - x[:, 0])
-    print(x[:, 3] - x[:, 1])
     pass
 
+def predict_boxes (image, prob, params):
+    # proposals of one image, N * 5 as from decode_proposals
+    stride = image.shape[0] // prob.shape[0]
+    return nms(decode_proposals(prob, params, stride, FLAGS.cth), FLAGS.th, FLAGS.max_boxes)
+
+class ImageRegions:
+    # Reads regions of a large image.  Whole-slide formats (openslide),
+    # uncompressed tiff (tifffile) and .npy are read region by region or
+    # memory mapped; anything else is loaded whole with cv2.imread.
+    # Regions are returned as h * w * 3 BGR, like cv2.imread.
+    def __init__ (self, path):
+        self.slide = None
+        self.array = None
+        self.rgb = False
+        ext = os.path.splitext(path)[1].lower()
+        if openslide and ext in SLIDE_EXTS:
+            self.slide = openslide.OpenSlide(path)
+            self.W, self.H = self.slide.dimensions
+            return
+        if ext == '.npy':
+            self.array = np.load(path, mmap_mode='r')
+        elif tifffile and ext in ['.tif', '.tiff']:
+            try:
+                self.array = tifffile.memmap(path, mode='r')
+                self.rgb = True
+            except ValueError:  # compressed or tiled
+                pass
+        if self.array is None:
+            print('%s can not be memory mapped, loading the whole image' % path)
+            self.array = cv2.imread(path, cv2.IMREAD_COLOR)
+            assert not self.array is None
+        self.H, self.W = self.array.shape[:2]
+        pass
+
+    def read (self, x, y, w, h):
+        if self.slide:
+            region = np.array(self.slide.read_region((x, y), 0, (w, h)))
+            return cv2.cvtColor(region, cv2.COLOR_RGBA2BGR)
+        region = np.asarray(self.array[y:y+h, x:x+w])
+        if len(region.shape) == 2:
+            return cv2.cvtColor(region, cv2.COLOR_GRAY2BGR)
+        region = region[:, :, :3]
+        if self.rgb:
+            region = region[:, :, ::-1]
+        return np.ascontiguousarray(region)
+    pass
+
+def tile_layout (size, tile, overlap):
+    # tiles covering [0, size), the last one aligned to the end
+    # returns [(start, core_begin, core_end)]; cores partition [0, size)
+    # and cut overlaps in the middle, so every output cell comes from
+    # the tile where it is farthest from a tile edge
+    if size <= tile:
+        return [(0, 0, size)]
+    starts = list(range(0, size - tile, tile - overlap)) + [size - tile]
+    cuts = [0]
+    for a, b in zip(starts[:-1], starts[1:]):
+        cuts.append((a + tile + b) // 2 // FLAGS.stride * FLAGS.stride)
+    cuts.append(size)
+    return [(start, cuts[k], cuts[k+1]) for k, start in enumerate(starts)]
+
+def predict_tiled (sess, model, X, is_training, path):
+    # peak memory is bounded by the tile size: tiles are read region by
+    # region, prob/params maps go to memory mapped files, and only the
+    # proposals of each tile are kept
+    assert FLAGS.tile % FLAGS.stride == 0
+    assert FLAGS.overlap % FLAGS.stride == 0 and FLAGS.overlap < FLAGS.tile
+    regions = ImageRegions(path)
+    H = regions.H // FLAGS.stride * FLAGS.stride
+    W = regions.W // FLAGS.stride * FLAGS.stride
+    rows = tile_layout(H, FLAGS.tile, FLAGS.overlap)
+    cols = tile_layout(W, FLAGS.tile, FLAGS.overlap)
+    th = min(FLAGS.tile, H)
+    tw = min(FLAGS.tile, W)
+    maps = None
+    boxes = []
+    for y, cy1, cy2 in tqdm(rows, leave=False):
+        for x, cx1, cx2 in cols:
+            image = regions.read(x, y, tw, th)
+            batch = np.expand_dims(image, axis=0).astype(X.dtype.as_numpy_dtype, copy=False)
+            prob, params = sess.run([model.prob, model.params], feed_dict={X: batch, is_training: False})
+            prob, params = prob[0], params[0]
+            a = th // prob.shape[0]     # anchor stride
+            # core of this tile in map coordinates
+            r1, r2 = (cy1 - y) // a, (cy2 - y) // a
+            c1, c2 = (cx1 - x) // a, (cx2 - x) // a
+            if FLAGS.tile_maps:
+                if maps is None:
+                    base = output_path(path)
+                    maps = (np.lib.format.open_memmap(base + '.prob.npy', mode='w+', dtype=np.float32,
+                                shape=(H // a, W // a)),
+                            np.lib.format.open_memmap(base + '.params.npy', mode='w+', dtype=np.float32,
+                                shape=(H // a, W // a, params.shape[2])))
+                maps[0][cy1 // a:cy2 // a, cx1 // a:cx2 // a] = prob[r1:r2, c1:c2]
+                maps[1][cy1 // a:cy2 // a, cx1 // a:cx2 // a] = params[r1:r2, c1:c2]
+            boxes.append(decode_proposals(prob[r1:r2, c1:c2], params[r1:r2, c1:c2], a, FLAGS.cth,
+                                          x0=cx1, y0=cy1))
+    if maps:
+        for m in maps:
+            m.flush()
+    # boxes from neighboring tiles overlap along the seams
+    return nms(np.concatenate(boxes), FLAGS.th, FLAGS.max_boxes)
+
+def load_image (path):
+    image = cv2.imread(path, cv2.IMREAD_COLOR)
+    if image is None:
+        return None
+    return crop_to_stride(image, FLAGS.stride)
+
+def read_images (paths, pool, readahead):
+    # yields (path, image), decoding up to readahead images in the background
+    pending = collections.deque()
+    for path in paths:
+        pending.append((path, pool.submit(load_image, path)))
+        if len(pending) >= readahead:
+            path, future = pending.popleft()
+            yield path, future.result()
+    while pending:
+        path, future = pending.popleft()
+        yield path, future.result()
+    pass
+
+def group_images (images, batch):
+    # yields lists of up to batch (path, image) of the same shape
+    groups = collections.OrderedDict()
+    for path, image in images:
+        if image is None:
+            print('failed to load %s' % path)
+            continue
+        group = groups.setdefault(image.shape, [])
+        group.append((path, image))
+        if len(group) >= batch:
+            del groups[image.shape]
+            yield group
+    for group in groups.values():
+        yield group
+    pass
+
+def output_path (path, suffix=''):
+    if FLAGS.output:
+        return os.path.join(FLAGS.output, os.path.basename(path) + suffix)
+    return path + suffix
+
 def main (_):
-    assert os.path.exists(FLAGS.input)
-    X = tf.placeholder(tf.float32, shape=(None, None, None, 3), name="images")
+    paths = list_images(FLAGS.input)
+    if FLAGS.output:
+        try:
+            os.makedirs(FLAGS.output)
+        except:
+            pass
+    path = FLAGS.model
+    if FLAGS.precision != 'float':
+        path = precision_path(path, FLAGS.precision)
+    # uint8 models are fed decoded images as they are
+    X = tf.placeholder(input_dtype(load_graph(path)[0]), shape=(None, None, None, 3), name="images")
     is_training = tf.placeholder(tf.bool, name="is_training")
-    model = Model(X, is_training, FLAGS.model, 'xxx')
-    config = tf.ConfigProto()
-    config.gpu_options.allow_growth=True
-    with tf.Session(config=config) as sess:
+    model = Model(X, is_training, path, 'xxx')
+    budget = ThreadBudget(FLAGS.cores, FLAGS.pin_cores, FLAGS.core_offset)
+    budget.apply()
+    config = session_config(FLAGS.xla, budget)
+    writer = ProposalWriter(FLAGS.proposals or os.path.join(FLAGS.output or '.', 'proposals'), FLAGS.chunk)
+    with tf.Session(config=config) as sess, ThreadPoolExecutor(FLAGS.threads) as pool:
         model.loader(sess)
-        image = cv2.imread(FLAGS.input, cv2.IMREAD_COLOR)
-        H, W = image.shape[:2]
-        H = H // FLAGS.stride * FLAGS.stride
-        W = W // FLAGS.stride * FLAGS.stride
-        image = image[:H, :W, :]
-        batch = np.expand_dims(image, axis=0).astype(dtype=np.float32)
-        prob, params = sess.run([model.prob, model.params], feed_dict={X: batch, is_training: False})
-        save_prediction_image(FLAGS.input + '.prob.png', image, prob[0], params[0])
+        start_time = time.time()
+        if FLAGS.tile > 0:
+            for path in paths:
+                boxes = predict_tiled(sess, model, X, is_training, path)
+                writer.add(path, boxes)
+                print('%s: %d boxes' % (path, boxes.shape[0]))
+            writer.close()
+            print('%d images in %.3fs' % (len(paths), time.time() - start_time))
+            return
+        cnt = 0
+        pending = collections.deque()   # (path, boxes future), in input order
+        saving = collections.deque()
+        images = read_images(paths, pool, FLAGS.batch * FLAGS.threads * 2)
+        # reading, decoding and drawing run in the pool while sess.run is busy
+        for group in tqdm(group_images(images, FLAGS.batch), leave=False):
+            batch = np.stack([image for _, image in group]).astype(X.dtype.as_numpy_dtype, copy=False)
+            prob, params = sess.run([model.prob, model.params], feed_dict={X: batch, is_training: False})
+            for i, (path, image) in enumerate(group):
+                pending.append((path, pool.submit(predict_boxes, image, prob[i], params[i])))
+                if FLAGS.visualize:
+                    saving.append(pool.submit(save_prediction_image, output_path(path, '.prob.png'), image, prob[i], params[i]))
+            while pending and (pending[0][1].done() or len(pending) > FLAGS.batch * FLAGS.threads):
+                path, boxes = pending.popleft()
+                writer.add(path, boxes.result())
+            while saving and (saving[0].done() or len(saving) > FLAGS.batch * FLAGS.threads):
+                saving.popleft().result()
+            cnt += len(group)
+        while pending:
+            path, boxes = pending.popleft()
+            writer.add(path, boxes.result())
+        while saving:
+            saving.popleft().result()
+        writer.close()
+        stop = time.time()
+        print('%d images in %.3fs, %.2f images/s' % (cnt, stop - start_time, cnt / (stop - start_time)))
     pass
 
 if __name__ == '__main__':
     tf.app.run()
-
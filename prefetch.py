@@ -0,0 +1,100 @@
+import threading
+import queue
+import tensorflow as tf
+
+class Prefetcher:
+    """Produces samples in background threads.
+
+    Each of the workers owns a stream created by create_stream(i) and
+    keeps calling stream.next(), optionally followed by transform(sample),
+    putting results into a queue of at most depth samples.  next() takes
+    one sample from the queue.  An exception raised in a worker stops all
+    workers and is raised again by every later next(), so a failed stream
+    is not silently dropped.  close() stops the workers.
+    """
+    def __init__ (self, create_stream, workers=1, depth=8, transform=None):
+        assert workers >= 1
+        assert depth >= 1
+        self.queue = queue.Queue(depth)
+        self.transform = transform
+        self.stopped = threading.Event()
+        self.error = None
+        self.streams = [create_stream(i) for i in range(workers)]
+        self.threads = []
+        for stream in self.streams:
+            thread = threading.Thread(target=self.run, args=(stream,))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        pass
+
+    def run (self, stream):
+        try:
+            while not self.stopped.is_set():
+                sample = stream.next()
+                if self.transform:
+                    sample = self.transform(sample)
+                self.put(sample)
+        except Exception as e:
+            if self.error is None:
+                self.error = e
+            self.stopped.set()
+        pass
+
+    def put (self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+        pass
+
+    def next (self):
+        while True:
+            if self.error is not None:
+                raise self.error
+            try:
+                return self.queue.get(timeout=0.1)
+            except queue.Empty:
+                if self.stopped.is_set():
+                    raise StopIteration     # closed
+            pass
+
+    def __iter__ (self):
+        while True:
+            try:
+                sample = self.next()
+            except StopIteration:
+                return
+            yield sample
+
+    def size (self):
+        return self.streams[0].size()
+
+    def close (self):
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join()
+        pass
+    pass
+
+def create_inputs (specs, generator=None, depth=2):
+    """Create input tensors.
+
+    specs: list of (dtype, shape, name)
+    Without generator every input is a placeholder.  Otherwise inputs are
+    placeholder_with_default over a tf.data pipeline built from generator,
+    which must yield tuples matching specs; batches then reach the graph
+    without feed_dict copies, and feeding a tensor still overrides it
+    (e.g. for validation, or when a graph is imported for inference).
+    """
+    if generator is None:
+        return [tf.placeholder(dtype, shape=shape, name=name) for dtype, shape, name in specs]
+    dataset = tf.data.Dataset.from_generator(generator,
+                    tuple(dtype for dtype, _, _ in specs),
+                    tuple(tf.TensorShape(shape) for _, shape, _ in specs))
+    dataset = dataset.prefetch(depth)
+    defaults = dataset.make_one_shot_iterator().get_next()
+    return [tf.placeholder_with_default(default, shape=shape, name=name)
+            for default, (_, shape, name) in zip(defaults, specs)]
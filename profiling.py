@@ -0,0 +1,157 @@
+import os
+import json
+import time
+import threading
+import collections
+import numpy as np
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+def host_rss ():
+    # resident set size of this process in bytes, 0 if unknown
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (IOError, OSError):
+        return 0
+
+class NullPhase:
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *args):
+        return False
+    pass
+
+NULL_PHASE = NullPhase()
+
+class Phase:
+    def __init__ (self, timeline, name):
+        self.timeline = timeline
+        self.name = name
+        pass
+
+    def __enter__ (self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__ (self, *args):
+        self.timeline.record(self.name, self.start, time.perf_counter())
+        return False
+    pass
+
+class StepTimeline:
+    """Per-step timing of the training loop.
+
+    Wrap each part of a step in `with timeline.phase(name):` and host
+    callbacks run by tf.py_func with timeline.wrap(fn, name); end_step()
+    closes the step; time in wrapped callbacks is also part of the
+    sess.run that calls them.  Durations are summed per phase and step,
+    and kept with host RSS for the last window steps.  Every
+    summary_steps steps end_step() returns a one-line summary, and every
+    trace_steps steps run_options() asks for a full tf.RunMetadata trace
+    of sess.run, saved by add_run_metadata() as a Chrome trace.  Host
+    phases are written to <dir>/host.trace.json by close(); load either
+    in chrome://tracing.
+
+    With dir None every method is a no-op, phase() returns a shared
+    null context and wrap() returns fn itself.
+    """
+    def __init__ (self, dir=None, trace_steps=0, summary_steps=100, window=100, max_events=100000):
+        self.enabled = dir is not None
+        self.dir = dir
+        self.trace_steps = trace_steps
+        self.summary_steps = summary_steps
+        self.step = 0
+        if not self.enabled:
+            return
+        try:
+            os.makedirs(dir)
+        except OSError:
+            pass
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        self.current = collections.defaultdict(float)   # phase -> seconds in this step
+        self.step_start = self.origin
+        self.history = collections.deque(maxlen=window)  # (seconds, rss, {phase: seconds})
+        self.events = collections.deque(maxlen=max_events)
+        pass
+
+    def phase (self, name):
+        if not self.enabled:
+            return NULL_PHASE
+        return Phase(self, name)
+
+    def wrap (self, fn, name):
+        if not self.enabled:
+            return fn
+        def timed (*args):
+            with Phase(self, name):
+                return fn(*args)
+        return timed
+
+    def record (self, name, start, stop):
+        with self.lock:
+            self.current[name] += stop - start
+            self.events.append((name, threading.current_thread().ident, start, stop))
+        pass
+
+    def run_options (self):
+        # (options, run_metadata) to pass to sess.run, both None unless
+        # this step is traced
+        if not self.enabled or self.trace_steps <= 0 or self.step % self.trace_steps != 0:
+            return None, None
+        import tensorflow as tf
+        return tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), tf.RunMetadata()
+
+    def add_run_metadata (self, run_metadata):
+        if run_metadata is None:
+            return
+        from tensorflow.python.client import timeline
+        trace = timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format()
+        with open(os.path.join(self.dir, 'step-%d.trace.json' % self.step), 'w') as f:
+            f.write(trace)
+        pass
+
+    def end_step (self):
+        if not self.enabled:
+            return None
+        now = time.perf_counter()
+        with self.lock:
+            phases = dict(self.current)
+            self.current.clear()
+        self.history.append((now - self.step_start, host_rss(), phases))
+        self.events.append(('step', 0, self.step_start, now))
+        self.step_start = now
+        self.step += 1
+        if self.summary_steps > 0 and self.step % self.summary_steps == 0:
+            return self.summary()
+        return None
+
+    def summary (self):
+        # mean and p90 milliseconds of the recent steps, per phase
+        if not self.enabled or not self.history:
+            return ''
+        steps = np.array([h[0] for h in self.history]) * 1000
+        names = sorted(set(name for h in self.history for name in h[2]))
+        txt = ['profile s=%d step=%.1f/%.1fms' % (self.step, np.mean(steps), np.percentile(steps, 90))]
+        for name in names:
+            ms = np.array([h[2].get(name, 0) for h in self.history]) * 1000
+            txt.append('%s=%.1f/%.1fms' % (name, np.mean(ms), np.percentile(ms, 90)))
+        txt.append('rss=%.0fMB' % (self.history[-1][1] / 1048576.0))
+        return ' '.join(txt)
+
+    def close (self):
+        if not self.enabled:
+            return
+        tids = {}
+        events = []
+        for name, tid, start, stop in self.events:
+            events.append({'name': name, 'ph': 'X', 'pid': 0,
+                           'tid': tids.setdefault(tid, len(tids)),
+                           'ts': (start - self.origin) * 1e6,
+                           'dur': (stop - start) * 1e6})
+        with open(os.path.join(self.dir, 'host.trace.json'), 'w') as f:
+            json.dump({'traceEvents': events}, f)
+        pass
+    pass
@@ -1,5 +1,12 @@
+#include <cmath>
 #include <string>
 #include <vector>
+#include <map>
+#include <memory>
+#include <algorithm>
+#include <unordered_map>
+#include <atomic>
+#include <omp.h>
 #include <sstream>
 #include <iostream>
 #include <boost/ref.hpp>
@@ -19,6 +26,42 @@ namespace {
     using std::endl;
     using std::vector;
 
+    // Releases the GIL for its lifetime, so other Python threads (input
+    // prefetching, concurrent py_funcs) run during the computation.
+    // No Python or numpy object may be touched while it exists: arrays
+    // are validated and their pointers taken before, results are
+    // wrapped after.
+    class ReleaseGIL {
+        PyThreadState *state;
+    public:
+        ReleaseGIL (): state(PyEval_SaveThread()) {
+        }
+        ~ReleaseGIL () {
+            PyEval_RestoreThread(state);
+        }
+        ReleaseGIL (ReleaseGIL const &) = delete;
+        ReleaseGIL &operator = (ReleaseGIL const &) = delete;
+    };
+
+    // OpenMP team size of the parallel loops, 0 for the OpenMP default.
+    // A num_threads clause rather than omp_set_num_threads, which would
+    // only apply to the calling thread, while the loops mostly run in
+    // TF's py_func threads.
+    std::atomic<int> omp_threads(0);
+
+    int team_size () {
+        int n = omp_threads.load();
+        return n > 0 ? n : omp_get_max_threads();
+    }
+
+    void set_num_threads (int n) {
+        omp_threads.store(std::max(n, 0));
+    }
+
+    int get_num_threads () {
+        return team_size();
+    }
+
     float box_area (float const *b) {
         return (b[2] - b[0]) * (b[3] - b[1]);
     }
@@ -39,39 +82,252 @@ namespace {
                         std::max(b1[1], b2[1]),
                         std::min(b1[2], b2[2]),
                         std::min(b1[3], b2[3])};
+        // disjoint boxes: without this check two negative extents
+        // would multiply into a positive intersection area
+        if (!(ibox[2] > ibox[0] && ibox[3] > ibox[1])) return 0;
         float ia = box_area(ibox);
         float ua = box_area(b1) + box_area(b2) - ia;
         return ia / (ua + 1.0);
     }
 
+    // Uniform grid over the proposals of one image.
+    // Every box is registered in all the cells it touches, so a box
+    // with positive intersection with a query box is always found in
+    // one of the cells the query touches.
+    class BoxGrid {
+        float x0, y0;           // origin
+        float cell;             // cell size
+        int gw, gh;             // number of columns/rows
+        vector<int> offsets;    // cell c holds ids[offsets[c]] .. ids[offsets[c+1]-1]
+        vector<int> ids;
+
+        static bool valid (float const *b) {
+            // also false for NaN
+            return b[0] <= b[2] && b[1] <= b[3];
+        }
+
+        int col (float x) const {
+            int c = int(std::floor((x - x0) / cell));
+            return std::min(std::max(c, 0), gw - 1);
+        }
+
+        int row (float y) const {
+            int r = int(std::floor((y - y0) / cell));
+            return std::min(std::max(r, 0), gh - 1);
+        }
+
+    public:
+        // members: indices of rows in boxes that belong to this image
+        BoxGrid (char const *boxes, size_t stride, vector<int> const &members)
+            : x0(0), y0(0), cell(1), gw(1), gh(1) {
+            float x1 = 0, y1 = 0, x2 = 0, y2 = 0;
+            double size = 0;
+            int n = 0;
+            for (int j: members) {
+                float const *b = (float const *)(boxes + stride * j);
+                if (!valid(b)) continue;
+                if (n == 0) {
+                    x1 = b[0]; y1 = b[1]; x2 = b[2]; y2 = b[3];
+                }
+                else {
+                    x1 = std::min(x1, b[0]); y1 = std::min(y1, b[1]);
+                    x2 = std::max(x2, b[2]); y2 = std::max(y2, b[3]);
+                }
+                size += std::max(b[2] - b[0], b[3] - b[1]);
+                ++n;
+            }
+            if (n > 0) {
+                // cell about the size of an average box, so each box
+                // lands in a few cells; cap the number of cells at ~4n
+                cell = std::max(float(size / n), 1.0f);
+                float ew = x2 - x1, eh = y2 - y1;
+                float min_cell = std::sqrt(ew * eh / (4.0f * n + 16));
+                cell = std::max(cell, min_cell);
+                x0 = x1;
+                y0 = y1;
+                gw = std::min(int(ew / cell) + 1, 4 * n + 16);
+                gh = std::min(int(eh / cell) + 1, 4 * n + 16);
+            }
+            offsets.assign(gw * gh + 1, 0);
+            // two passes: count, then fill
+            for (int pass = 0; pass < 2; ++pass) {
+                if (pass == 1) {
+                    for (int c = 0; c < gw * gh; ++c) {
+                        offsets[c+1] += offsets[c];
+                    }
+                    ids.resize(offsets.back());
+                }
+                vector<int> next(offsets.begin(), offsets.end() - 1);
+                for (int j: members) {
+                    float const *b = (float const *)(boxes + stride * j);
+                    if (!valid(b)) continue;
+                    int c1 = col(b[0]), c2 = col(b[2]);
+                    int r1 = row(b[1]), r2 = row(b[3]);
+                    for (int r = r1; r <= r2; ++r) {
+                        for (int c = c1; c <= c2; ++c) {
+                            if (pass == 0) ++offsets[r * gw + c + 1];
+                            else ids[next[r * gw + c]++] = j;
+                        }
+                    }
+                }
+            }
+        }
+
+        // call fn(j) for every box that might overlap q
+        // a box may be reported more than once
+        template <typename F>
+        void query (float const *q, F fn) const {
+            if (!valid(q)) return;
+            int c1 = col(q[0]), c2 = col(q[2]);
+            int r1 = row(q[1]), r2 = row(q[3]);
+            for (int r = r1; r <= r2; ++r) {
+                for (int c = c1; c <= c2; ++c) {
+                    int cc = r * gw + c;
+                    for (int k = offsets[cc]; k < offsets[cc+1]; ++k) {
+                        fn(ids[k]);
+                    }
+                }
+            }
+        }
+    };
+
+    // struct-of-arrays copy of an n * 4 box array, so the inner
+    // loops of iou_matrix are plain unit-stride float loops
+    struct BoxArrays {
+        vector<float> x1, y1, x2, y2, area;
+
+        BoxArrays (char const *boxes, size_t stride, int n) {
+            x1.resize(n); y1.resize(n); x2.resize(n); y2.resize(n); area.resize(n);
+            for (int i = 0; i < n; ++i) {
+                float const *b = (float const *)(boxes + stride * i);
+                x1[i] = b[0]; y1[i] = b[1]; x2[i] = b[2]; y2[i] = b[3];
+                area[i] = box_area(b);
+            }
+        }
+    };
+
+    void check_boxes (np::ndarray boxes, int columns = 4) {
+        CHECK(boxes.get_dtype() == np::dtype::get_builtin<float>());
+        CHECK(boxes.get_nd() == 2);
+        if (columns == 4) CHECK(boxes.shape(1) == 4);
+        else CHECK(boxes.shape(1) >= columns);
+        // strides of arrays without rows can be anything, e.g. (0, 0)
+        if (boxes.shape(0) > 0) {
+            CHECK(boxes.strides(1) == sizeof(float));
+        }
+    }
+
+    int32_t const *check_box_ind (object box_ind, int n) {
+        if (box_ind.is_none()) return nullptr;
+        np::ndarray ind = extract<np::ndarray>(box_ind);
+        CHECK(ind.get_dtype() == np::dtype::get_builtin<int32_t>());
+        CHECK(ind.get_nd() == 1);
+        CHECK(ind.shape(0) == n);
+        if (n > 0) {
+            CHECK(ind.strides(0) == sizeof(int32_t));
+        }
+        return (int32_t const *)ind.get_data();
+    }
+
+    // pairwise iou_score of boxes_a and boxes_b, written to out (na * nb float32)
+    // If box_ind_a and box_ind_b are given, pairs from different images
+    // get 0.  If out is None a new array is allocated.
+    np::ndarray iou_matrix (np::ndarray boxes_a, np::ndarray boxes_b,
+                            object box_ind_a, object box_ind_b, object out_) {
+        check_boxes(boxes_a);
+        check_boxes(boxes_b);
+        int na = boxes_a.shape(0);
+        int nb = boxes_b.shape(0);
+        int32_t const *ind_a = check_box_ind(box_ind_a, na);
+        int32_t const *ind_b = check_box_ind(box_ind_b, nb);
+        CHECK((ind_a == nullptr) == (ind_b == nullptr));
+        np::ndarray out = out_.is_none()
+                ? np::empty(make_tuple(na, nb), np::dtype::get_builtin<float>())
+                : extract<np::ndarray>(out_)();
+        CHECK(out.get_dtype() == np::dtype::get_builtin<float>());
+        CHECK(out.get_nd() == 2);
+        CHECK(out.shape(0) == na);
+        CHECK(out.shape(1) == nb);
+        if (na == 0 || nb == 0) return out;
+        CHECK(out.strides(1) == sizeof(float));
+
+        char const *a_data = boxes_a.get_data(), *b_data = boxes_b.get_data();
+        size_t a_stride = boxes_a.strides(0), b_stride = boxes_b.strides(0);
+        char *out_data = out.get_data();
+        size_t out_stride = out.strides(0);
+
+        {
+            ReleaseGIL nogil;
+            BoxArrays a(a_data, a_stride, na), b(b_data, b_stride, nb);
+            float const *bx1 = b.x1.data(), *by1 = b.y1.data(), *bx2 = b.x2.data(), *by2 = b.y2.data(), *barea = b.area.data();
+#pragma omp parallel for schedule(static) num_threads(team_size())
+            for (int i = 0; i < na; ++i) {
+                float *row = (float *)(out_data + out_stride * i);
+                float ax1 = a.x1[i], ay1 = a.y1[i], ax2 = a.x2[i], ay2 = a.y2[i], aarea = a.area[i];
+                int32_t ind = ind_a ? ind_a[i] : 0;
+                // same arithmetic as iou_score
+#pragma omp simd
+                for (int j = 0; j < nb; ++j) {
+                    float iw = std::min(ax2, bx2[j]) - std::max(ax1, bx1[j]);
+                    float ih = std::min(ay2, by2[j]) - std::max(ay1, by1[j]);
+                    float ia = iw * ih;
+                    float ua = aarea + barea[j] - ia;
+                    float s = ia / (ua + 1.0);
+                    row[j] = (iw > 0 && ih > 0) ? s : 0;
+                }
+                if (ind_a) {
+                    for (int j = 0; j < nb; ++j) {
+                        if (ind_b[j] != ind) row[j] = 0;
+                    }
+                }
+            }
+        }
+        return out;
+    }
+
+    // (index, gt_index) pairs to a list of two int32 arrays
+    list wrap_match (vector<std::pair<int, int>> const &match) {
+        list r;
+        np::ndarray idx1 = np::zeros(make_tuple(match.size()), np::dtype::get_builtin<int32_t>());
+        np::ndarray idx2 = np::zeros(make_tuple(match.size()), np::dtype::get_builtin<int32_t>());
+
+        //np::ndarray cnt = np::zeros(mask_tuple(
+
+        int32_t *p1 = (int32_t *)idx1.get_data();
+        int32_t *p2 = (int32_t *)idx2.get_data();
+        for (auto const &p: match) {
+            *p1 = p.first;
+            *p2 = p.second;
+            ++p1;
+            ++p2;
+        }
+        r.append(idx1);
+        r.append(idx2);
+        return r;
+    }
+
     class GTMatcher {
         float iou_th;
-        int batch;
-    public:
-        GTMatcher (float th_, int batch_): iou_th(th_), batch(batch_) {
+
+        static void check (np::ndarray boxes, np::ndarray box_ind, np::ndarray gt_boxes) {
+            check_boxes(boxes);
+            check_box_ind(box_ind, boxes.shape(0));
+            check_boxes(gt_boxes, 7);
         }
 
-        list apply (np::ndarray boxes,
-                    np::ndarray box_ind_,
-                    np::ndarray gt_boxes) {
-            CHECK(boxes.get_nd() == 2);
-            CHECK(boxes.shape(1) == 4);
-            CHECK(gt_boxes.get_nd() == 2);
-            CHECK(gt_boxes.shape(1) >= 7);
+        // original algorithm, scans all proposals for each gt box
+        void match_reference (char const *boxes, size_t boxes_stride,
+                    int32_t const *box_ind, int nb,
+                    char const *gt_boxes, size_t gt_stride, int ng,
+                    vector<std::pair<int, int>> *match) const {
             // assign prediction to gt_boxes
             // algorithm:
             //      for each gt box pick the best match
-            int nb = boxes.shape(0);
-            int ng = gt_boxes.shape(0);
-            CHECK(nb == box_ind_.shape(0));
             vector<bool> used(nb, false);
 
-            vector<std::pair<int, int>> match;
-
-            int32_t const *box_ind = (int32_t const *)(box_ind_.get_data());
             for (int i = 0; i < ng; ++i) {
                 // i-th gt box
-                float const *gt = (float const *)(gt_boxes.get_data() + gt_boxes.strides(0) * i);
+                float const *gt = (float const *)(gt_boxes + gt_stride * i);
                 int ind = gt[0];
                 gt = gt + 3;    // the box parameters
                 float iou = iou_th;
@@ -79,7 +335,7 @@ namespace {
                 for (int j = 0; j < nb; ++j) {
                     if (box_ind[j] != ind) continue; // not the same image
                     if (used[j]) continue;
-                    float const *b = (float const *)(boxes.get_data() + boxes.strides(0) * j);
+                    float const *b = (float const *)(boxes + boxes_stride * j);
                     float s = iou_score(gt, b);
                     if (s > iou) {
                         iou = s;
@@ -87,86 +343,647 @@ namespace {
                     }
                 }
                 if (best >= 0) {
-                    /*
-                    float const *b = (float const *)(boxes.get_data() + boxes.strides(0) * best);
-                    std::cerr << "YYY " << iou << ' ' << b[0] << ' ' << b[1] << ' ' << b[2] << ' ' << b[3] << std::endl;
-                    float ia = box_iarea(gt, b);
-                    std::cerr << iou_score(gt, b) << "  " << ia << "    " << box_area(gt) << "    " << box_area(b) << std::endl;
-                    */
-                    match.emplace_back(best, i);
+                    match->emplace_back(best, i);
+                    used[best] = true;
+                }
+            }
+        }
+
+    public:
+        GTMatcher (float th_): iou_th(th_) {
+        }
+
+        // Same greedy assignment as match_reference, but only proposals
+        // overlapping the gt box are scored.  Proposals are bucketed by
+        // image and then by a uniform grid.
+        void match (char const *boxes, size_t boxes_stride,
+                    int32_t const *box_ind, int nb,
+                    char const *gt_boxes, size_t gt_stride, int ng,
+                    vector<std::pair<int, int>> *match) const {
+            if (!(iou_th >= 0)) {
+                // non-overlapping boxes score 0 and can be matched,
+                // pruning by overlap would not be exact
+                match_reference(boxes, boxes_stride, box_ind, nb, gt_boxes, gt_stride, ng, match);
+                return;
+            }
+            std::unordered_map<int, vector<int>> images;
+            for (int j = 0; j < nb; ++j) {
+                images[box_ind[j]].push_back(j);
+            }
+            // grids are built on demand, only for images with gt boxes
+            std::unordered_map<int, std::unique_ptr<BoxGrid>> grids;
+
+            vector<bool> used(nb, false);
+            vector<int> seen(nb, -1);   // last gt box that scored j
+            for (int i = 0; i < ng; ++i) {
+                float const *gt = (float const *)(gt_boxes + gt_stride * i);
+                int ind = gt[0];
+                gt = gt + 3;
+                auto it = images.find(ind);
+                if (it == images.end()) continue;
+                auto &grid = grids[ind];
+                if (!grid) {
+                    grid.reset(new BoxGrid(boxes, boxes_stride, it->second));
+                }
+                float iou = iou_th;
+                int best = -1;
+                grid->query(gt, [&](int j) {
+                    if (seen[j] == i) return;
+                    seen[j] = i;
+                    if (used[j]) return;
+                    float const *b = (float const *)(boxes + boxes_stride * j);
+                    float s = iou_score(gt, b);
+                    // ties go to the lowest index, as in the linear scan
+                    if (s > iou || (s == iou && best >= 0 && j < best)) {
+                        iou = s;
+                        best = j;
+                    }
+                });
+                if (best >= 0) {
+                    match->emplace_back(best, i);
                     used[best] = true;
                 }
             }
+        }
 
+        list apply (np::ndarray boxes,
+                    np::ndarray box_ind,
+                    np::ndarray gt_boxes) {
+            check(boxes, box_ind, gt_boxes);
+            char const *boxes_data = boxes.get_data();
+            size_t boxes_stride = boxes.strides(0);
+            int32_t const *ind = (int32_t const *)box_ind.get_data();
+            int nb = boxes.shape(0);
+            char const *gt_data = gt_boxes.get_data();
+            size_t gt_stride = gt_boxes.strides(0);
+            int ng = gt_boxes.shape(0);
+            vector<std::pair<int, int>> m;
+            {
+                ReleaseGIL nogil;
+                match(boxes_data, boxes_stride, ind, nb, gt_data, gt_stride, ng, &m);
+            }
+            return wrap_match(m);
+        }
+
+        list apply_reference (np::ndarray boxes,
+                    np::ndarray box_ind,
+                    np::ndarray gt_boxes) {
+            check(boxes, box_ind, gt_boxes);
+            char const *boxes_data = boxes.get_data();
+            size_t boxes_stride = boxes.strides(0);
+            int32_t const *ind = (int32_t const *)box_ind.get_data();
+            int nb = boxes.shape(0);
+            char const *gt_data = gt_boxes.get_data();
+            size_t gt_stride = gt_boxes.strides(0);
+            int ng = gt_boxes.shape(0);
+            vector<std::pair<int, int>> m;
+            {
+                ReleaseGIL nogil;
+                match_reference(boxes_data, boxes_stride, ind, nb, gt_data, gt_stride, ng, &m);
+            }
+            return wrap_match(m);
+        }
+    };
+
+    // IoU as tf.image.non_max_suppression computes it (no +1)
+    float nms_iou (float const *b1, float const *b2) {
+        float iw = std::min(b1[2], b2[2]) - std::max(b1[0], b2[0]);
+        float ih = std::min(b1[3], b2[3]) - std::max(b1[1], b2[1]);
+        if (!(iw > 0 && ih > 0)) return 0;
+        float ia = iw * ih;
+        float ua = box_area(b1) + box_area(b2) - ia;
+        if (!(ua > 0)) return 0;
+        return ia / ua;
+    }
+
+    // also accepts numpy scalars and 0-d arrays, which is what
+    // tf.py_func passes for scalar tensors
+    float as_float (object v) {
+        return extract<float>(object(handle<>(PyNumber_Float(v.ptr()))));
+    }
+
+    // threshold + per-image NMS + optional gt matching in one call,
+    // replaces boolean_mask/non_max_suppression/GTMatcher in the graph
+    class NMS {
+        int max_boxes;      // max boxes kept per image
+        GTMatcher matcher;
+
+        // greedy NMS of one image
+        // cand: indices of boxes above threshold, ascending
+        void suppress (float const *prob, char const *boxes, size_t stride,
+                       vector<int> *cand, float nms_th, vector<int> *keep) const {
+            // descending prob, ties keep index order
+            std::stable_sort(cand->begin(), cand->end(), [prob](int a, int b) {
+                return prob[a] > prob[b];
+            });
+            int m = cand->size();
+            if (m == 0) return;
+            if (!(nms_th >= 0)) {
+                // every pair is above a negative threshold
+                keep->push_back(cand->front());
+                return;
+            }
+            // sorted local copy, so the grid and the flags share indices
+            vector<float> local(m * 4);
+            vector<int> members(m);
+            for (int k = 0; k < m; ++k) {
+                float const *b = (float const *)(boxes + stride * (*cand)[k]);
+                std::copy(b, b + 4, &local[k * 4]);
+                members[k] = k;
+            }
+            BoxGrid grid((char const *)&local[0], 4 * sizeof(float), members);
+            vector<bool> suppressed(m, false);
+            for (int k = 0; k < m && int(keep->size()) < max_boxes; ++k) {
+                if (suppressed[k]) continue;
+                keep->push_back((*cand)[k]);
+                float const *b = &local[k * 4];
+                // a kept box suppresses all lower-scored overlapping boxes
+                grid.query(b, [&](int l) {
+                    if (l <= k || suppressed[l]) return;
+                    if (nms_iou(b, &local[l * 4]) > nms_th) suppressed[l] = true;
+                });
+            }
+        }
+
+    public:
+        NMS (int max_boxes_, float match_th): max_boxes(max_boxes_), matcher(match_th) {
+        }
+
+        // prob:        n       anchor probabilities
+        // boxes:       n * 4
+        // box_ind:     n       image index of each box
+        // gt_boxes:    optional, as in GTMatcher.apply
+        // returns [sel, index, gt_index]
+        //      sel:    indices of the boxes kept, grouped by image in
+        //              ascending order, by descending prob within image
+        //      index, gt_index: GTMatcher.apply(boxes[sel], box_ind[sel], gt_boxes),
+        //              empty if gt_boxes is None
+        list apply (np::ndarray prob,
+                    np::ndarray boxes,
+                    np::ndarray box_ind_,
+                    object anchor_th_,
+                    object nms_th_,
+                    object gt_boxes_) {
+            check_boxes(boxes);
+            int n = boxes.shape(0);
+            CHECK(prob.get_dtype() == np::dtype::get_builtin<float>());
+            CHECK(prob.get_nd() == 1);
+            CHECK(prob.shape(0) == n);
+            if (n > 0) {
+                CHECK(prob.strides(0) == sizeof(float));
+            }
+            int32_t const *box_ind = check_box_ind(box_ind_, n);
+            float anchor_th = as_float(anchor_th_);
+            float nms_th = as_float(nms_th_);
+            float const *p = (float const *)prob.get_data();
+            char const *boxes_data = boxes.get_data();
+            size_t boxes_stride = boxes.strides(0);
+            char const *gt_data = nullptr;
+            size_t gt_stride = 0;
+            int ng = 0;
+            if (!gt_boxes_.is_none()) {
+                np::ndarray gt_boxes = extract<np::ndarray>(gt_boxes_);
+                check_boxes(gt_boxes, 7);
+                gt_data = gt_boxes.get_data();
+                gt_stride = gt_boxes.strides(0);
+                ng = gt_boxes.shape(0);
+            }
+
+            vector<int> sel;
+            vector<std::pair<int, int>> match;
+            {
+                ReleaseGIL nogil;
+                std::map<int, vector<int>> images;  // ordered by image index
+                for (int j = 0; j < n; ++j) {
+                    if (p[j] >= anchor_th) images[box_ind[j]].push_back(j);
+                }
+                vector<vector<int> *> cands;
+                for (auto &img: images) cands.push_back(&img.second);
+                vector<vector<int>> keep(cands.size());
+#pragma omp parallel for schedule(dynamic) num_threads(team_size())
+                for (int k = 0; k < int(cands.size()); ++k) {
+                    suppress(p, boxes_data, boxes_stride, cands[k], nms_th, &keep[k]);
+                }
+
+                for (auto const &v: keep) sel.insert(sel.end(), v.begin(), v.end());
+
+                if (gt_data) {
+                    int m = sel.size();
+                    vector<float> sel_boxes(m * 4);
+                    vector<int32_t> sel_ind(m);
+                    for (int k = 0; k < m; ++k) {
+                        float const *b = (float const *)(boxes_data + boxes_stride * sel[k]);
+                        std::copy(b, b + 4, &sel_boxes[k * 4]);
+                        sel_ind[k] = box_ind[sel[k]];
+                    }
+                    matcher.match((char const *)sel_boxes.data(), 4 * sizeof(float), sel_ind.data(), m,
+                                  gt_data, gt_stride, ng, &match);
+                }
+            }
+
+            np::ndarray sel_ = np::empty(make_tuple(sel.size()), np::dtype::get_builtin<int32_t>());
+            std::copy(sel.begin(), sel.end(), (int32_t *)sel_.get_data());
+            list r = wrap_match(match);
+            r.insert(0, sel_);
+            return r;
+        }
+    };
+
+    // Streaming average precision at several IoU thresholds.
+    // Predicted boxes are matched to gt boxes of their image in
+    // descending score order, each to the unmatched gt box of highest
+    // IoU above the threshold (VOC/COCO style).  Matched and unmatched
+    // boxes are counted in histograms of bins score bins over [0, 1], so
+    // memory does not grow with the number of images; precision/recall
+    // curves and AP are computed from the histograms, exact up to the
+    // order of boxes within a bin.
+    class APAccumulator {
+        vector<float> ths;
+        int bins;
+        vector<vector<double>> tp, fp;  // ths.size() * bins
+        double n_gt;
+
+        int bin (float score) const {
+            int b = int(score * bins);
+            return std::min(std::max(b, 0), bins - 1);
+        }
+
+        // cumulative counts of boxes with score bin >= b, b descending
+        // and AP of threshold k
+        double curve (int k, vector<double> *precision, vector<double> *recall) const {
+            precision->resize(bins);
+            recall->resize(bins);
+            double t = 0, f = 0;
+            for (int b = bins - 1; b >= 0; --b) {
+                t += tp[k][b];
+                f += fp[k][b];
+                (*precision)[b] = (t + f) > 0 ? t / (t + f) : 1.0;
+                (*recall)[b] = n_gt > 0 ? t / n_gt : 0;
+            }
+            // area under the precision envelope, as train.average_precision
+            double ap = 0, best = 0, r = 0;
+            vector<double> envelope(bins);
+            for (int b = 0; b < bins; ++b) {
+                best = std::max(best, (*precision)[b]);
+                envelope[b] = best;
+            }
+            for (int b = bins - 1; b >= 0; --b) {
+                ap += ((*recall)[b] - r) * envelope[b];
+                r = (*recall)[b];
+            }
+            return ap;
+        }
+
+    public:
+        APAccumulator (list ths_, int bins_): bins(bins_), n_gt(0) {
+            CHECK(bins > 0);
+            for (int i = 0; i < len(ths_); ++i) {
+                ths.push_back(extract<float>(ths_[i]));
+                // non-overlapping boxes are never matched
+                CHECK(ths.back() >= 0);
+            }
+            CHECK(ths.size() > 0);
+            reset();
+        }
+
+        void reset () {
+            tp.assign(ths.size(), vector<double>(bins, 0));
+            fp.assign(ths.size(), vector<double>(bins, 0));
+            n_gt = 0;
+        }
+
+        // boxes:       n * 4
+        // scores:      n
+        // box_ind:     n       image index of each box
+        // gt_boxes:    m * 7   as in GTMatcher.apply, all gt boxes of
+        //                      the batch, also of images without boxes
+        void add (np::ndarray boxes, np::ndarray scores, np::ndarray box_ind_, np::ndarray gt_boxes) {
+            check_boxes(boxes);
+            check_boxes(gt_boxes, 7);
+            int n = boxes.shape(0);
+            CHECK(scores.get_dtype() == np::dtype::get_builtin<float>());
+            CHECK(scores.get_nd() == 1);
+            CHECK(scores.shape(0) == n);
+            if (n > 0) {
+                CHECK(scores.strides(0) == sizeof(float));
+            }
+            int32_t const *box_ind = check_box_ind(box_ind_, n);
+            float const *score = (float const *)scores.get_data();
+            char const *boxes_data = boxes.get_data();
+            size_t boxes_stride = boxes.strides(0);
+            char const *gt_data = gt_boxes.get_data();
+            size_t gt_stride = gt_boxes.strides(0);
+            int m = gt_boxes.shape(0);
+
+            // counted locally without the GIL and merged once it is
+            // held again, so concurrent calls do not race on tp and fp
+            vector<vector<double>> ltp(ths.size(), vector<double>(bins, 0));
+            vector<vector<double>> lfp(ths.size(), vector<double>(bins, 0));
+            {
+                ReleaseGIL nogil;
+                // gt boxes by image, indexed by a grid over their corners,
+                // which start at column 3
+                std::unordered_map<int, vector<int>> gts;
+                for (int i = 0; i < m; ++i) {
+                    float const *gt = (float const *)(gt_data + gt_stride * i);
+                    gts[int(gt[0])].push_back(i);
+                }
+                std::unordered_map<int, vector<int>> images;
+                for (int j = 0; j < n; ++j) {
+                    images[box_ind[j]].push_back(j);
+                }
+                char const *gt_corners = gt_data + 3 * sizeof(float);
+                // gt boxes already matched, per threshold
+                vector<vector<bool>> used(ths.size(), vector<bool>(m, false));
+                for (auto &img: images) {
+                    vector<int> &cand = img.second;
+                    std::stable_sort(cand.begin(), cand.end(), [score](int a, int b) {
+                        return score[a] > score[b];
+                    });
+                    auto it = gts.find(img.first);
+                    std::unique_ptr<BoxGrid> grid;
+                    if (it != gts.end()) grid.reset(new BoxGrid(gt_corners, gt_stride, it->second));
+                    for (unsigned k = 0; k < ths.size(); ++k) {
+                        for (int j: cand) {
+                            float const *b = (float const *)(boxes_data + boxes_stride * j);
+                            float iou = ths[k];
+                            int best = -1;
+                            if (grid) {
+                                grid->query(b, [&](int i) {
+                                    if (used[k][i]) return;
+                                    float s = iou_score(b, (float const *)(gt_corners + gt_stride * i));
+                                    if (s > iou || (s == iou && best >= 0 && i < best)) {
+                                        iou = s;
+                                        best = i;
+                                    }
+                                });
+                            }
+                            if (best >= 0) {
+                                used[k][best] = true;
+                                ltp[k][bin(score[j])] += 1;
+                            }
+                            else {
+                                lfp[k][bin(score[j])] += 1;
+                            }
+                        }
+                    }
+                }
+            }
+            n_gt += m;
+            for (unsigned k = 0; k < ths.size(); ++k) {
+                for (int b = 0; b < bins; ++b) {
+                    tp[k][b] += ltp[k][b];
+                    fp[k][b] += lfp[k][b];
+                }
+            }
+        }
+
+        // AP of each threshold
+        np::ndarray ap () const {
+            np::ndarray r = np::empty(make_tuple(ths.size()), np::dtype::get_builtin<double>());
+            vector<double> p, rc;
+            for (unsigned k = 0; k < ths.size(); ++k) {
+                ((double *)r.get_data())[k] = curve(k, &p, &rc);
+            }
+            return r;
+        }
+
+        // precision and recall of all boxes at each threshold
+        list totals () const {
+            np::ndarray precision = np::empty(make_tuple(ths.size()), np::dtype::get_builtin<double>());
+            np::ndarray recall = np::empty(make_tuple(ths.size()), np::dtype::get_builtin<double>());
+            for (unsigned k = 0; k < ths.size(); ++k) {
+                double t = 0, f = 0;
+                for (int b = 0; b < bins; ++b) {
+                    t += tp[k][b];
+                    f += fp[k][b];
+                }
+                ((double *)precision.get_data())[k] = t / std::max(t + f, 1.0);
+                ((double *)recall.get_data())[k] = t / std::max(n_gt, 1.0);
+            }
+            list r;
+            r.append(precision);
+            r.append(recall);
+            return r;
+        }
+
+        // [score, precision, recall] of threshold k, bins each: the
+        // precision and recall of boxes with at least score
+        list pr_curve (int k) const {
+            CHECK(k >= 0 && k < int(ths.size()));
+            vector<double> p, rc;
+            curve(k, &p, &rc);
+            np::ndarray score = np::empty(make_tuple(bins), np::dtype::get_builtin<double>());
+            np::ndarray precision = np::empty(make_tuple(bins), np::dtype::get_builtin<double>());
+            np::ndarray recall = np::empty(make_tuple(bins), np::dtype::get_builtin<double>());
+            for (int b = 0; b < bins; ++b) {
+                ((double *)score.get_data())[b] = double(b) / bins;
+                ((double *)precision.get_data())[b] = p[b];
+                ((double *)recall.get_data())[b] = rc[b];
+            }
             list r;
-            np::ndarray idx1 = np::zeros(make_tuple(match.size()), np::dtype::get_builtin<int32_t>());
-            np::ndarray idx2 = np::zeros(make_tuple(match.size()), np::dtype::get_builtin<int32_t>());
-            
-            //np::ndarray cnt = np::zeros(mask_tuple(
-
-            int32_t *p1 = (int32_t *)idx1.get_data();
-            int32_t *p2 = (int32_t *)idx2.get_data();
-            for (auto const &p: match) {
-                *p1 = p.first;
-                *p2 = p.second;
-                ++p1;
-                ++p2;
-            }
-            r.append(idx1);
-            r.append(idx2);
+            r.append(score);
+            r.append(precision);
+            r.append(recall);
             return r;
         }
     };
 
+    // source offsets and weights for resizing n pixels to m with
+    // bilinear interpolation, same sampling as cv::resize INTER_LINEAR
+    void linear_table (int n, int m, vector<int> *ofs, vector<float> *alpha) {
+        ofs->resize(m);
+        alpha->resize(m);
+        double scale = double(n) / m;
+        for (int d = 0; d < m; ++d) {
+            float f = float((d + 0.5) * scale - 0.5);
+            int s = int(std::floor(f));
+            f -= s;
+            if (s < 0) {
+                s = 0;
+                f = 0;
+            }
+            if (s >= n - 1) {
+                s = n - 1;
+                f = 0;
+            }
+            (*ofs)[d] = s;
+            (*alpha)[d] = f;
+        }
+    }
+
     class MaskExtractor {
         cv::Size sz;
+
+        // per-thread scratch space, reused across boxes
+        struct Scratch {
+            vector<int> xofs, yofs;
+            vector<float> xalpha, yalpha;
+            vector<float> rows[2];  // horizontally resampled source rows
+            int row_index[2];
+        };
+
+        // Resample the 0/1 mask (pixel == tag) of roi straight from the
+        // strided label image into mask, without materializing the roi.
+        template <typename T>
+        void resample (char const *image, size_t row_stride, size_t col_stride,
+                      cv::Rect const &roi, int tag,
+                      char *mask, size_t mask_stride, Scratch *s) const {
+            linear_table(roi.width, sz.width, &s->xofs, &s->xalpha);
+            linear_table(roi.height, sz.height, &s->yofs, &s->yalpha);
+            s->row_index[0] = s->row_index[1] = -1;
+            for (int k = 0; k < 2; ++k) s->rows[k].resize(sz.width);
+
+            auto hresize = [&](int y, float *out) {
+                char const *row = image + (roi.y + y) * row_stride + roi.x * col_stride;
+                for (int dx = 0; dx < sz.width; ++dx) {
+                    int x0 = s->xofs[dx];
+                    int x1 = std::min(x0 + 1, roi.width - 1);
+                    float v0 = *(T const *)(row + x0 * col_stride) == tag ? 1.0 : 0.0;
+                    float v1 = *(T const *)(row + x1 * col_stride) == tag ? 1.0 : 0.0;
+                    float a = s->xalpha[dx];
+                    out[dx] = v0 * (1 - a) + v1 * a;
+                }
+            };
+            // the two most recently resampled rows are kept,
+            // consecutive output rows mostly share their source rows
+            auto source_row = [&](int y) -> float const * {
+                for (int k = 0; k < 2; ++k) {
+                    if (s->row_index[k] == y) return &s->rows[k][0];
+                }
+                int k = (s->row_index[0] < s->row_index[1]) ? 0 : 1;
+                hresize(y, &s->rows[k][0]);
+                s->row_index[k] = y;
+                return &s->rows[k][0];
+            };
+            for (int dy = 0; dy < sz.height; ++dy) {
+                int y0 = s->yofs[dy];
+                int y1 = std::min(y0 + 1, roi.height - 1);
+                float b = s->yalpha[dy];
+                float const *r0 = source_row(y0);
+                float const *r1 = source_row(y1);
+                float *out = (float *)(mask + dy * mask_stride);
+                for (int dx = 0; dx < sz.width; ++dx) {
+                    out[dx] = r0[dx] * (1 - b) + r1[dx] * b;
+                }
+            }
+        }
+
+        // raw view of a 4-d array, usable without the GIL
+        struct Array4 {
+            char *data;
+            size_t strides[4];
+
+            Array4 (np::ndarray a): data(a.get_data()) {
+                for (int k = 0; k < 4; ++k) strides[k] = a.strides(k);
+            }
+        };
+
+        // box i of boxes and gt_boxes as an roi of image index, with tag
+        static cv::Rect box_roi (char const *gt_boxes, size_t gt_stride,
+                                 char const *boxes, size_t boxes_stride,
+                                 int i, int *index, int *tag) {
+            float const *gt_box = (float const *)(gt_boxes + i * gt_stride);
+            float const *box = (float const *)(boxes + i * boxes_stride);
+            *index = int(gt_box[0]);
+            *tag = int(gt_box[2]);
+            int x1 = int(round(box[0]));
+            int y1 = int(round(box[1]));
+            int x2 = int(round(box[2]));
+            int y2 = int(round(box[3]));
+            return cv::Rect(x1, y1, x2-x1+1, y2-y1+1);
+        }
+
+        template <typename T>
+        void extract_all (Array4 const &images, int n,
+                          char const *gt_boxes, size_t gt_stride,
+                          char const *boxes, size_t boxes_stride,
+                          Array4 const &masks) const {
+#pragma omp parallel num_threads(team_size())
+            {
+                Scratch scratch;
+#pragma omp for
+                for (int i = 0; i < n; ++i) {
+                    int index, tag;
+                    cv::Rect roi = box_roi(gt_boxes, gt_stride, boxes, boxes_stride, i, &index, &tag);
+                    resample<T>(images.data + index * images.strides[0],
+                                images.strides[1], images.strides[2],
+                                roi, tag,
+                                masks.data + i * masks.strides[0], masks.strides[1],
+                                &scratch);
+                }
+            }
+        }
+
     public:
         MaskExtractor (int width, int height): sz(width, height) {
         }
 
+        // images:      B * H * W * 1 label images, float32/int32/uint16/uint8
+        // masks:       optional n * height * width * 1 float32 output,
+        //              allocated if None; pass the same buffer every
+        //              step to avoid reallocating
         np::ndarray apply (np::ndarray images,
                     np::ndarray gt_boxes,
-                    np::ndarray boxes) {
+                    np::ndarray boxes,
+                    object masks_) {
             CHECK(images.get_nd() == 4);
-            CHECK(gt_boxes.get_nd() == 2);
-            CHECK(boxes.get_nd() == 2);
-            CHECK(gt_boxes.shape(1) >= 3);
-            CHECK(boxes.shape(1) == 4);
+            check_boxes(gt_boxes, 3);
+            check_boxes(boxes);
             CHECK(gt_boxes.shape(0) == boxes.shape(0));
             int n = gt_boxes.shape(0);
+            int B = images.shape(0);
             int H = images.shape(1);
             int W = images.shape(2);
             int C = images.shape(3);
             CHECK(C == 1);
+            char const *gt_data = gt_boxes.get_data();
+            size_t gt_stride = gt_boxes.strides(0);
+            char const *boxes_data = boxes.get_data();
+            size_t boxes_stride = boxes.strides(0);
+            for (int i = 0; i < n; ++i) {
+                int index, tag;
+                cv::Rect roi = box_roi(gt_data, gt_stride, boxes_data, boxes_stride, i, &index, &tag);
+                CHECK(index >= 0 && index < B);
+                CHECK(roi.width > 0 && roi.height > 0);
+                CHECK(roi.x >= 0);
+                CHECK(roi.y >= 0);
+                CHECK(roi.x + roi.width <= W);
+                CHECK(roi.y + roi.height <= H);
+            }
 
-            np::ndarray masks = np::zeros(make_tuple(n, sz.height, sz.width, 1), np::dtype::get_builtin<float>());
+            np::ndarray masks = masks_.is_none()
+                    ? np::empty(make_tuple(n, sz.height, sz.width, 1), np::dtype::get_builtin<float>())
+                    : extract<np::ndarray>(masks_)();
+            CHECK(masks.get_dtype() == np::dtype::get_builtin<float>());
+            CHECK(masks.get_nd() == 4);
+            CHECK(masks.shape(0) == n);
+            CHECK(masks.shape(1) == sz.height);
+            CHECK(masks.shape(2) == sz.width);
+            CHECK(masks.shape(3) == 1);
+            if (n == 0) return masks;
+            CHECK(masks.strides(2) == sizeof(float));
 
-#pragma omp parallel for
-            for (int i = 0; i < n; ++i) {
-                float *gt_box = (float *)(gt_boxes.get_data() + i * gt_boxes.strides(0));
-                float *box = (float *)(boxes.get_data() + i * boxes.strides(0));
-                int index(gt_box[0]);
-                int tag(gt_box[2]);
-                cv::Mat image(H, W, CV_32F, images.get_data() + index * images.strides(0));
-                float *mask_begin =  (float *)(masks.get_data() + i * masks.strides(0));
-                cv::Mat mask(sz, CV_32F, mask_begin);
-
-                int x1 = int(round(box[0]));
-                int y1 = int(round(box[1]));
-                int x2 = int(round(box[2]));
-                int y2 = int(round(box[3]));
-                CHECK(x1 >= 0);
-                CHECK(y1 >= 0);
-                CHECK(x2 < W);
-                CHECK(y2 < H);
-                cv::Rect roi(x1, y1, x2-x1+1, y2-y1+1);
-                //std::cerr << "XXX " << roi.x << ' ' << roi.y << ' ' << roi.width << ' ' << roi.height << std::endl;
-                cv::Mat from = image(roi).clone();
-                for (float *p = from.ptr<float>(0); p < from.ptr<float>(from.rows); ++p) {
-                    if (p[0] == tag) p[0] = 1.0;
-                    else p[0] = 0.0;
-                }
-                cv::resize(from, mask, mask.size(), 0, 0);
+            np::dtype dtype = images.get_dtype();
+            Array4 images_(images), masks_data(masks);
+            if (dtype == np::dtype::get_builtin<float>()) {
+                ReleaseGIL nogil;
+                extract_all<float>(images_, n, gt_data, gt_stride, boxes_data, boxes_stride, masks_data);
+            }
+            else if (dtype == np::dtype::get_builtin<int32_t>()) {
+                ReleaseGIL nogil;
+                extract_all<int32_t>(images_, n, gt_data, gt_stride, boxes_data, boxes_stride, masks_data);
+            }
+            else if (dtype == np::dtype::get_builtin<uint16_t>()) {
+                ReleaseGIL nogil;
+                extract_all<uint16_t>(images_, n, gt_data, gt_stride, boxes_data, boxes_stride, masks_data);
+            }
+            else if (dtype == np::dtype::get_builtin<uint8_t>()) {
+                ReleaseGIL nogil;
+                extract_all<uint8_t>(images_, n, gt_data, gt_stride, boxes_data, boxes_stride, masks_data);
+            }
+            else {
+                CHECK(0) << "unsupported label image type";
             }
             return masks;
         }
@@ -176,11 +993,25 @@ namespace {
 BOOST_PYTHON_MODULE(cpp)
 {
     np::initialize();
+    def("set_num_threads", set_num_threads, "OpenMP threads of the parallel loops, 0 for the default");
+    def("get_num_threads", get_num_threads);
+    def("iou_matrix", iou_matrix, (arg("boxes_a"), arg("boxes_b"), arg("box_ind_a") = object(), arg("box_ind_b") = object(), arg("out") = object()));
     class_<GTMatcher>("GTMatcher", init<float>())
         .def("apply", &GTMatcher::apply)
+        .def("apply_reference", &GTMatcher::apply_reference)
+    ;
+    class_<NMS>("NMS", init<int, float>())
+        .def("apply", &NMS::apply, (arg("prob"), arg("boxes"), arg("box_ind"), arg("anchor_th"), arg("nms_th"), arg("gt_boxes") = object()))
+    ;
+    class_<APAccumulator>("APAccumulator", init<list, int>((arg("iou_ths"), arg("bins") = 1000)))
+        .def("add", &APAccumulator::add, (arg("boxes"), arg("scores"), arg("box_ind"), arg("gt_boxes")))
+        .def("reset", &APAccumulator::reset)
+        .def("ap", &APAccumulator::ap)
+        .def("totals", &APAccumulator::totals)
+        .def("pr_curve", &APAccumulator::pr_curve)
     ;
     class_<MaskExtractor>("MaskExtractor", init<int, int>())
-        .def("apply", &MaskExtractor::apply)
+        .def("apply", &MaskExtractor::apply, (arg("images"), arg("gt_boxes"), arg("boxes"), arg("masks") = object()))
     ;
 }
 
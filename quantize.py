@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# Post-training quantization of a frozen graph from export.py:
+#
+#   ./quantize.py --graph model/100.pb --db train.db --val_db val.db [--mode int8]
+#
+# int8:  convolutions and matmuls run as eight-bit ops; activation
+#        ranges are calibrated on --calibration batches of --db
+# fp16:  weights are stored as float16 and cast back when loaded
+#
+# Writes model/100.int8.pb (or .fp16.pb), which predict-anchors.py loads
+# with --precision int8, and reports AP/precision/recall on --val_db and
+# run time per image of the original and the quantized graph.
+import os
+import time
+import numpy as np
+import tensorflow as tf
+from tensorflow.core.framework import attr_value_pb2
+from tensorflow.tools.graph_transforms import TransformGraph
+import train
+import cpp
+from inference import Model, session_config, decode_proposals, nms, precision_path
+
+flags = tf.app.flags
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('graph', None, 'frozen graph from export.py')
+flags.DEFINE_string('mode', 'int8', 'int8 or fp16')
+flags.DEFINE_integer('calibration', 20, 'batches of db used to calibrate activation ranges')
+flags.DEFINE_integer('fp16_min_size', 1024, 'fp16: only constants with at least this many elements')
+
+INPUTS = ['images']
+OUTPUTS = ['logits', 'params']
+
+def load_graph_def (path):
+    graph_def = tf.GraphDef()
+    with open(path, 'rb') as f:
+        graph_def.ParseFromString(f.read())
+    return graph_def
+
+def calibrate (graph_def, stream, batches):
+    # min and max of every RequantizationRange over the batches, in the
+    # log format read by freeze_requantization_ranges
+    names = [node.name for node in graph_def.node if node.op == 'RequantizationRange']
+    if not names:
+        return ''
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(graph_def, name='')
+        ranges = [(graph.get_tensor_by_name(name + ':0'), graph.get_tensor_by_name(name + ':1')) for name in names]
+        images = graph.get_tensor_by_name(INPUTS[0] + ':0')
+        lo = np.full(len(names), np.inf)
+        hi = np.full(len(names), -np.inf)
+        with tf.Session(graph=graph, config=session_config()) as sess:
+            stream.reset()
+            seen = 0
+            for _ in range(batches):
+                try:
+                    sample = stream.next()
+                except StopIteration:
+                    # the stream does not loop, the db has fewer batches
+                    break
+                r = np.array(sess.run(ranges, feed_dict={images: sample[1]}))
+                lo = np.minimum(lo, r[:, 0])
+                hi = np.maximum(hi, r[:, 1])
+                seen += 1
+            assert seen > 0, 'no calibration batches in the db'
+    return ''.join([';%s__print__;__requant_min_max:[%g][%g]\n' % x for x in zip(names, lo, hi)])
+
+def quantize_int8 (graph_def, stream):
+    graph_def = TransformGraph(graph_def, INPUTS, OUTPUTS, [
+                'add_default_attributes',
+                'strip_unused_nodes',
+                'fold_constants(ignore_errors=true)',
+                'fold_batch_norms',
+                'fold_old_batch_norms',
+                'quantize_weights',
+                'quantize_nodes',
+                'strip_unused_nodes',
+                'sort_by_execution_order'])
+    log = FLAGS.graph + '.ranges.txt'
+    with open(log, 'w') as f:
+        f.write(calibrate(graph_def, stream, FLAGS.calibration))
+    return TransformGraph(graph_def, INPUTS, OUTPUTS, [
+                'freeze_requantization_ranges(min_max_log_file="%s")' % log,
+                'strip_unused_nodes',
+                'sort_by_execution_order'])
+
+def quantize_fp16 (graph_def):
+    # large float32 constants become float16 constants plus a cast
+    # under the original name
+    out = tf.GraphDef()
+    out.versions.CopyFrom(graph_def.versions)
+    for node in graph_def.node:
+        if node.op == 'Const' and node.attr['dtype'].type == tf.float32.as_datatype_enum:
+            value = tf.make_ndarray(node.attr['value'].tensor)
+            if value.size >= FLAGS.fp16_min_size:
+                const = out.node.add()
+                const.op = 'Const'
+                const.name = node.name + '/fp16'
+                const.attr['dtype'].type = tf.float16.as_datatype_enum
+                const.attr['value'].CopyFrom(attr_value_pb2.AttrValue(tensor=tf.make_tensor_proto(value.astype(np.float16))))
+                cast = out.node.add()
+                cast.op = 'Cast'
+                cast.name = node.name
+                cast.input.append(const.name)
+                cast.attr['SrcT'].type = tf.float16.as_datatype_enum
+                cast.attr['DstT'].type = tf.float32.as_datatype_enum
+                continue
+        out.node.add().CopyFrom(node)
+    return out
+
+class Scorer:
+    # runs a frozen graph on validation batches, accumulates box AP,
+    # precision and recall (at the first of --eval_iou) and time
+    def __init__ (self, path, name):
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.X = tf.placeholder(tf.float32, shape=(None, None, None, 3), name="images")
+            is_training = tf.placeholder(tf.bool, name="is_training")
+            self.model = Model(self.X, is_training, path, name)
+        self.sess = tf.Session(graph=self.graph, config=session_config())
+        self.acc = cpp.APAccumulator(train.eval_ious()[:1], FLAGS.eval_bins)
+        self.time, self.images = 0, 0
+        pass
+
+    def apply (self, images, gt_boxes):
+        start_time = time.time()
+        prob, params = self.sess.run([self.model.prob, self.model.params], feed_dict={self.X: images})
+        self.time += time.time() - start_time
+        self.images += images.shape[0]
+        stride = images.shape[1] // prob.shape[1]
+        boxes, box_ind = [], []
+        for i in range(images.shape[0]):
+            b = nms(decode_proposals(prob[i], params[i], stride, FLAGS.anchor_th), FLAGS.nms_th, FLAGS.max_boxes)
+            boxes.append(b)
+            box_ind.append(np.full(b.shape[0], i, dtype=np.int32))
+        boxes = np.concatenate(boxes)
+        self.acc.add(np.ascontiguousarray(boxes[:, :4]), np.ascontiguousarray(boxes[:, 4]),
+                     np.concatenate(box_ind), np.ascontiguousarray(gt_boxes, dtype=np.float32))
+        return prob
+
+    def report (self):
+        precision, recall = self.acc.totals()
+        return {'ap': float(self.acc.ap()[0]),
+                'precision': float(precision[0]),
+                'recall': float(recall[0]),
+                'ms_per_image': 1000.0 * self.time / max(self.images, 1)}
+    pass
+
+def main (_):
+    assert FLAGS.graph and FLAGS.graph.endswith('.pb')
+    assert FLAGS.mode in ['int8', 'fp16']
+    graph_def = load_graph_def(FLAGS.graph)
+    if FLAGS.mode == 'int8':
+        assert FLAGS.db
+        graph_def = quantize_int8(graph_def, train.create_picpac_stream(FLAGS.db, False))
+    else:
+        graph_def = quantize_fp16(graph_def)
+    output = precision_path(FLAGS.graph, FLAGS.mode)
+    with open(output, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    print('saved to %s, %d -> %d bytes.' % (output, os.path.getsize(FLAGS.graph), os.path.getsize(output)))
+
+    if not FLAGS.val_db:
+        return
+    scorers = [Scorer(FLAGS.graph, 'float'), Scorer(output, FLAGS.mode)]
+    stream = train.create_val_stream(FLAGS.val_db)
+    diff, cells = 0.0, 0
+    for sample in stream:
+        images, gt_boxes = sample[1], sample[-1]
+        p0, p1 = [scorer.apply(images, gt_boxes) for scorer in scorers]
+        diff += np.sum(np.abs(p0 - p1))
+        cells += p0.size
+    r0, r1 = [scorer.report() for scorer in scorers]
+    for key in ['ap', 'precision', 'recall', 'ms_per_image']:
+        print('%-14s float=%.4f %s=%.4f delta=%+.4f' % (key, r0[key], FLAGS.mode, r1[key], r1[key] - r0[key]))
+    print('speedup        %.2fx' % (r0['ms_per_image'] / max(r1['ms_per_image'], 1e-9)))
+    print('prob mean abs diff %.5f' % (diff / max(cells, 1)))
+    pass
+
+if __name__ == '__main__':
+    tf.app.run()
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+import os
+import sys
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+sys.path.insert(0, 'build/lib.linux-x86_64-3.5')
+import io
+import time
+import json
+import socket
+import threading
+import collections
+import socketserver
+import http.client
+import http.server
+from urllib.parse import urlparse, parse_qs
+from concurrent.futures import Future, ThreadPoolExecutor
+import numpy as np
+import cv2
+import tensorflow as tf
+from threads import ThreadBudget
+from inference import Model, session_config, load_graph, input_dtype, list_images, crop_to_stride, decode_proposals, nms
+
+flags = tf.app.flags
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('model', None, 'checkpoint, or frozen graph (.pb) from export.py')
+flags.DEFINE_boolean('xla', False, 'compile with XLA JIT')
+flags.DEFINE_integer('cores', 0, 'cores shared by TF and the cpp OpenMP loops, 0 for defaults')
+flags.DEFINE_boolean('pin_cores', False, 'run on cores core_offset .. core_offset+cores-1 only')
+flags.DEFINE_integer('core_offset', 0, '')
+flags.DEFINE_float('cth', 0.5, '')
+flags.DEFINE_float('th', 0.5, '')
+flags.DEFINE_integer('stride', 16, '')
+flags.DEFINE_string('socket', None, 'listen on this unix socket instead of localhost:port')
+flags.DEFINE_integer('port', 8000, '')
+flags.DEFINE_integer('max_batch', 8, '')
+flags.DEFINE_float('max_delay', 5, 'max ms a request waits for others to fill a batch')
+flags.DEFINE_integer('max_boxes', 1000000, '')
+# load generator
+flags.DEFINE_integer('clients', 0, 'run as a load generator with this many concurrent clients')
+flags.DEFINE_integer('requests', 1000, 'total requests sent by the load generator')
+flags.DEFINE_string('input', None, 'images for the load generator, see predict-anchors.py')
+
+class Stats:
+    # latency of the most recent requests and a throughput window
+    def __init__ (self, window=10000):
+        self.lock = threading.Lock()
+        self.latency = collections.deque(maxlen=window)
+        self.done = collections.deque(maxlen=window)    # completion times
+        self.requests = 0
+        self.batches = 0
+        self.images = 0
+        pass
+
+    def add_batch (self, size):
+        with self.lock:
+            self.batches += 1
+            self.images += size
+        pass
+
+    def add_request (self, start, stop):
+        with self.lock:
+            self.requests += 1
+            self.latency.append(stop - start)
+            self.done.append(stop)
+        pass
+
+    def summary (self):
+        with self.lock:
+            latency = np.array(self.latency) * 1000
+            done = np.array(self.done)
+            r = {'requests': self.requests,
+                 'batches': self.batches,
+                 'mean_batch': self.images / max(self.batches, 1)}
+        if latency.size > 0:
+            r['p50_ms'] = float(np.percentile(latency, 50))
+            r['p99_ms'] = float(np.percentile(latency, 99))
+        if done.size > 1 and done[-1] > done[0]:
+            r['throughput'] = (done.size - 1) / float(done[-1] - done[0])
+        return r
+    pass
+
+class Batcher:
+    # Collects concurrent requests into batches.  A batch is run as soon
+    # as max_batch images are waiting, or max_delay after its first
+    # image arrived.  Images of different sizes go to different batches.
+    def __init__ (self, sess, model, X, is_training, stats):
+        self.sess = sess
+        self.model = model
+        self.X = X
+        self.is_training = is_training
+        self.stats = stats
+        self.cond = threading.Condition()
+        self.pending = collections.OrderedDict()  # shape -> [(arrival, image, future)]
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+        pass
+
+    def submit (self, image):
+        future = Future()
+        with self.cond:
+            self.pending.setdefault(image.shape, []).append((time.time(), image, future))
+            self.cond.notify()
+        return future
+
+    def take (self):
+        # blocks until some batch is ready, returns it
+        delay = FLAGS.max_delay / 1000.0
+        with self.cond:
+            while True:
+                now = time.time()
+                wait = None
+                for shape, queue in self.pending.items():
+                    if len(queue) >= FLAGS.max_batch or now - queue[0][0] >= delay:
+                        batch = queue[:FLAGS.max_batch]
+                        del queue[:FLAGS.max_batch]
+                        if not queue:
+                            del self.pending[shape]
+                        return batch
+                    left = queue[0][0] + delay - now
+                    wait = left if wait is None else min(wait, left)
+                self.cond.wait(wait)
+        pass
+
+    def run (self):
+        while True:
+            batch = self.take()
+            try:
+                images = np.stack([image for _, image, _ in batch]).astype(self.X.dtype.as_numpy_dtype, copy=False)
+                prob, params = self.sess.run([self.model.prob, self.model.params],
+                                    feed_dict={self.X: images, self.is_training: False})
+                self.stats.add_batch(len(batch))
+                for i, (_, _, future) in enumerate(batch):
+                    future.set_result((prob[i], params[i]))
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+        pass
+    pass
+
+class Handler (http.server.BaseHTTPRequestHandler):
+    # POST /predict     body is an encoded image, or {"path": ...} as JSON
+    #                   ?format=npy returns an N * 5 float32 .npy,
+    #                   otherwise JSON {"boxes": [[x1, y1, x2, y2, score], ...]}
+    # GET /stats        latency percentiles and throughput as JSON
+    server_version = 'box'
+    protocol_version = 'HTTP/1.1'
+
+    def address_string (self):
+        # unix sockets have no client address
+        return str(self.client_address[0]) if self.client_address else 'local'
+
+    def log_message (self, format, *args):
+        pass
+
+    def reply (self, code, body, content_type):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        pass
+
+    def do_GET (self):
+        if urlparse(self.path).path != '/stats':
+            self.reply(404, b'', 'text/plain')
+            return
+        self.reply(200, json.dumps(self.server.stats.summary()).encode('ascii'), 'application/json')
+        pass
+
+    def do_POST (self):
+        start = time.time()
+        url = urlparse(self.path)
+        if url.path != '/predict':
+            self.reply(404, b'', 'text/plain')
+            return
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers.get('Content-Type', '') == 'application/json':
+            try:
+                path = json.loads(body.decode('utf-8'))['path']
+                image = cv2.imread(path, cv2.IMREAD_COLOR)
+            except (ValueError, KeyError, TypeError, cv2.error):
+                # not JSON, no path or not a string
+                self.reply(400, b'bad request, expecting {"path": ...}', 'text/plain')
+                return
+        else:
+            image = cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            self.reply(400, b'bad image', 'text/plain')
+            return
+        image = crop_to_stride(image, FLAGS.stride)
+        try:
+            prob, params = self.server.batcher.submit(image).result()
+        except Exception as e:
+            # passed on by Batcher.run, e.g. a failed sess.run
+            self.reply(500, str(e).encode('utf-8', 'replace'), 'text/plain')
+            return
+        stride = image.shape[0] // prob.shape[0]
+        boxes = nms(decode_proposals(prob, params, stride, FLAGS.cth), FLAGS.th, FLAGS.max_boxes)
+        if parse_qs(url.query).get('format', ['json'])[0] == 'npy':
+            buf = io.BytesIO()
+            np.save(buf, boxes)
+            self.reply(200, buf.getvalue(), 'application/octet-stream')
+        else:
+            self.reply(200, json.dumps({'boxes': boxes.tolist()}).encode('ascii'), 'application/json')
+        self.server.stats.add_request(start, time.time())
+        pass
+    pass
+
+class TCPServer (socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+class UnixServer (socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class UnixHTTPConnection (http.client.HTTPConnection):
+    def __init__ (self, path):
+        http.client.HTTPConnection.__init__(self, 'localhost')
+        self.socket_path = path
+        pass
+
+    def connect (self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+        pass
+    pass
+
+def connect ():
+    if FLAGS.socket:
+        return UnixHTTPConnection(FLAGS.socket)
+    return http.client.HTTPConnection('localhost', FLAGS.port)
+
+def serve ():
+    # uint8 models are fed decoded images as they are
+    X = tf.placeholder(input_dtype(load_graph(FLAGS.model)[0]), shape=(None, None, None, 3), name="images")
+    is_training = tf.placeholder(tf.bool, name="is_training")
+    model = Model(X, is_training, FLAGS.model, 'xxx')
+    budget = ThreadBudget(FLAGS.cores, FLAGS.pin_cores, FLAGS.core_offset)
+    budget.apply()
+    config = session_config(FLAGS.xla, budget)
+    with tf.Session(config=config) as sess:
+        model.loader(sess)
+        if FLAGS.socket:
+            if os.path.exists(FLAGS.socket):
+                os.remove(FLAGS.socket)
+            server = UnixServer(FLAGS.socket, Handler)
+        else:
+            server = TCPServer(('localhost', FLAGS.port), Handler)
+        server.stats = Stats()
+        server.batcher = Batcher(sess, model, X, is_training, server.stats)
+        print('serving on %s' % (FLAGS.socket or 'localhost:%d' % FLAGS.port))
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+    pass
+
+def generate_load ():
+    # each client sends its share of requests one after another,
+    # images are encoded once up front
+    bodies = []
+    for path in list_images(FLAGS.input):
+        with open(path, 'rb') as f:
+            bodies.append(f.read())
+    assert len(bodies) > 0
+    latency = []
+    lock = threading.Lock()
+
+    def client (k):
+        conn = connect()
+        for i in range(k, FLAGS.requests, FLAGS.clients):
+            start = time.time()
+            conn.request('POST', '/predict?format=npy', bodies[i % len(bodies)],
+                         {'Content-Type': 'application/octet-stream'})
+            r = conn.getresponse()
+            r.read()
+            assert r.status == 200
+            with lock:
+                latency.append(time.time() - start)
+        pass
+
+    start = time.time()
+    with ThreadPoolExecutor(FLAGS.clients) as pool:
+        for f in [pool.submit(client, k) for k in range(FLAGS.clients)]:
+            f.result()
+    stop = time.time()
+    latency = np.array(latency) * 1000
+    print('client: %d requests in %.3fs, %.2f requests/s, p50=%.2fms p99=%.2fms' % (
+            latency.size, stop - start, latency.size / (stop - start),
+            np.percentile(latency, 50), np.percentile(latency, 99)))
+    conn = connect()
+    conn.request('GET', '/stats')
+    print('server: %s' % conn.getresponse().read().decode('ascii'))
+    pass
+
+def main (_):
+    if FLAGS.clients > 0:
+        generate_load()
+    else:
+        serve()
+    pass
+
+if __name__ == '__main__':
+    tf.app.run()
@@ -0,0 +1,39 @@
+import json
+import tensorflow as tf
+
+class StreamingMetrics:
+    """Batch-size weighted running means of scalar metrics, kept in the graph.
+
+    Run update together with train_op every step; it only touches local
+    variables and fetches nothing.  read(sess) returns the means and the
+    number of samples since the last read, and resets the accumulators.
+    """
+    def __init__ (self, metrics, batch_size, name='streaming_metrics'):
+        weight = tf.cast(batch_size, tf.float32)
+        with tf.variable_scope(name) as scope:
+            means = [tf.metrics.mean(metric, weights=weight) for metric in metrics]
+            self.samples = tf.Variable(0.0, trainable=False, name='samples',
+                                collections=[tf.GraphKeys.LOCAL_VARIABLES])
+            self.values = [value for value, _ in means]
+            self.update = tf.group(tf.assign_add(self.samples, weight), *[update for _, update in means])
+            self.reset = tf.variables_initializer(tf.get_collection(tf.GraphKeys.LOCAL_VARIABLES, scope.name))
+        pass
+
+    def read (self, sess):
+        values, samples = sess.run([self.values, self.samples])
+        sess.run(self.reset)
+        return values, samples
+    pass
+
+class JsonLog:
+    # one JSON object per line; a no-op without path
+    def __init__ (self, path=None):
+        self.f = open(path, 'a') if path else None
+        pass
+
+    def write (self, **fields):
+        if self.f:
+            self.f.write(json.dumps(fields) + '\n')
+            self.f.flush()
+        pass
+    pass
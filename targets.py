@@ -0,0 +1,20 @@
+import numpy as np
+import tensorflow as tf
+
+# Sparse params targets.  Only cells with non-zero params weight carry
+# a loss, so instead of the dense B * H * W * (priors * k) params and
+# B * H * W * priors weights those cells are sent as
+#   index:  N       int32, cell in B * H * W * priors order
+#   values: N * k   float32
+#   weight: N       float32
+
+def sparse_params (gt_params, gt_params_weight, k):
+    weight = gt_params_weight.reshape(-1)
+    index = np.flatnonzero(weight).astype(np.int32)
+    return index, gt_params.reshape(-1, k)[index], weight[index]
+
+def sparse_params_loss (params, index, values, weight, loss_fn):
+    # params: ? * k predictions of all cells, in the same order
+    # same value as the dense loss sum(loss_fn * weight) / (sum(weight) + 1)
+    pl = loss_fn(tf.gather(params, index), values) * weight
+    return tf.reduce_sum(pl) / (tf.reduce_sum(weight) + 1)
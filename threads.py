@@ -0,0 +1,70 @@
+import os
+import multiprocessing
+import cpp
+
+def available_cores ():
+    # cores this process may run on
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(multiprocessing.cpu_count()))
+
+class ThreadBudget:
+    """Splits a number of cores between the thread pools of a process.
+
+    cores:  0 leaves every pool at its default (usually one thread per
+            core for each of them); otherwise about a quarter of the
+            cores goes to picpac decoding, shared by streams streams,
+            the rest to TF's intra-op pool; the cpp OpenMP team is as
+            large as the intra-op pool, its loops run in py_funcs
+            between TF kernels rather than alongside them, and the
+            inter-op pool, which mostly waits, gets 2 threads.
+    pin:    also restrict the process to cores offset .. offset+cores-1
+            of the available ones, e.g. to give each job on a shared
+            node its own cores.
+
+    apply() pins and sizes the OpenMP team; call it before sessions or
+    streams are created, as threads inherit the affinity of their
+    creator.  configure(config) sets the pools of a tf.ConfigProto,
+    picpac(config) the threads of a picpac stream config.
+    """
+    def __init__ (self, cores=0, pin=False, offset=0, streams=1):
+        self.cores = cores
+        self.pinned = None
+        self.intra = self.inter = self.omp = self.decode = 0
+        if cores <= 0:
+            return
+        if pin:
+            available = available_cores()
+            assert offset + cores <= len(available), 'not enough cores to pin %d from %d' % (cores, offset)
+            self.pinned = available[offset:offset+cores]
+        self.decode = max(1, cores // 4 // streams)
+        self.intra = max(1, cores - self.decode * streams)
+        self.inter = 2 if cores >= 4 else 1
+        self.omp = self.intra
+        pass
+
+    def apply (self):
+        if self.pinned:
+            os.sched_setaffinity(0, self.pinned)
+        if self.cores > 0:
+            cpp.set_num_threads(self.omp)
+        pass
+
+    def configure (self, config):
+        if self.cores > 0:
+            config.intra_op_parallelism_threads = self.intra
+            config.inter_op_parallelism_threads = self.inter
+        return config
+
+    def picpac (self, config):
+        if self.cores > 0:
+            config['threads'] = self.decode
+        return config
+
+    def __str__ (self):
+        if self.cores <= 0:
+            return 'threads: defaults'
+        return 'threads: intra=%d inter=%d omp=%d picpac=%d%s' % (self.intra, self.inter, self.omp, self.decode,
+                ' pinned=%d-%d' % (self.pinned[0], self.pinned[-1]) if self.pinned else '')
+    pass
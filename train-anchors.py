@@ -5,6 +5,7 @@ os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'models/research/slim'))
 sys.path.insert(0, 'picpac/build/lib.linux-x86_64-3.5')
 import time
+import atexit
 import datetime
 import logging
 from tqdm import tqdm
@@ -13,6 +14,13 @@ import tensorflow as tf
 import tensorflow.contrib.slim as slim
 from nets import nets_factory, resnet_utils 
 import picpac
+from prefetch import Prefetcher, create_inputs
+from profiling import StepTimeline
+from streaming import StreamingMetrics, JsonLog
+from checkpoint import AsyncSaver
+from targets import sparse_params, sparse_params_loss
+from bucket import BucketBatcher, parse_sizes, padding_waste
+from threads import ThreadBudget
 
 class ShapeConfig:
     def __init__ (self, params=3, priors=1):
@@ -33,8 +41,9 @@ class ShapeConfig:
         return tf.reduce_sum(diff, axis=1)
     pass
 
-def create_net (ft, gt_anchors, gt_anchors_weight, gt_params, gt_params_weight, config):
+def create_net (ft, gt_anchors, gt_anchors_weight, gt_params, gt_params_weight, config, gt_params_index=None):
     # ft:           B * H' * W' * 3     input feature, H' W' is feature map size
+    # gt_params_index: if given, gt_params and gt_params_weight are sparse, see targets.py
     # gt_counts:    B                   number of boxes in each sample of the batch
     # gt_boxes:     ? * 4               boxes
     with tf.variable_scope('anchor_net'):
@@ -42,7 +51,7 @@ def create_net (ft, gt_anchors, gt_anchors_weight, gt_params, gt_params_weight,
         logits = config.predict_logits(ft)     # B * H' * W' * (M * 2)
         logits2 = tf.reshape(logits, (-1, 2))   # ? * 2
 
-        gt_anchors = tf.reshape(gt_anchors, (-1, ))
+        gt_anchors = tf.reshape(tf.cast(gt_anchors, tf.int32), (-1, ))
         gt_anchors_weight = tf.reshape(gt_anchors_weight, (-1,))
         xe = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=logits2, labels=gt_anchors)
         xe = xe * gt_anchors_weight
@@ -50,11 +59,14 @@ def create_net (ft, gt_anchors, gt_anchors_weight, gt_params, gt_params_weight,
 
         params = config.predict_params(ft)       # B * H' * W' * M * 4
         params2 = tf.reshape(params, (-1, config.params))     # ? * 4
-        gt_params = tf.reshape(gt_params, (-1, config.params))
-        gt_params_weight = tf.reshape(gt_params_weight, (-1,))
-        pl = config.params_loss(params2, gt_params)
-        pl = pl * gt_params_weight
-        pl = tf.reduce_sum(pl) / (tf.reduce_sum(gt_params_weight) + 1)
+        if gt_params_index is not None:
+            pl = sparse_params_loss(params2, gt_params_index, gt_params, gt_params_weight, config.params_loss)
+        else:
+            gt_params = tf.reshape(gt_params, (-1, config.params))
+            gt_params_weight = tf.reshape(gt_params_weight, (-1,))
+            pl = config.params_loss(params2, gt_params)
+            pl = pl * gt_params_weight
+            pl = tf.reduce_sum(pl) / (tf.reduce_sum(gt_params_weight) + 1)
 
     logits= tf.identity(logits, name='logits')
     params = tf.identity(params, name='params')
@@ -104,6 +116,7 @@ flags.DEFINE_string('mixin', None, 'mix-in training db')
 
 flags.DEFINE_integer('size', None, '') 
 flags.DEFINE_integer('batch', 1, 'Batch size.  ')
+flags.DEFINE_string('buckets', None, 'comma separated image sizes, e.g. 512,768,1024; pads images to these sizes to make batches')
 flags.DEFINE_integer('shift', 0, '')
 flags.DEFINE_integer('backbone_stride', 16, '')
 flags.DEFINE_integer('ft_filters', 256, '')
@@ -114,6 +127,8 @@ flags.DEFINE_string('model', None, 'model directory')
 flags.DEFINE_string('resume', None, 'resume training from this model')
 flags.DEFINE_string('finetune', None, '')
 flags.DEFINE_integer('max_to_keep', 100, '')
+flags.DEFINE_boolean('async_ckpt', False, 'write checkpoints in a background thread')
+flags.DEFINE_float('keep_ckpt_hours', 10000, 'with async_ckpt, also keep one checkpoint every this many hours')
 
 # optimizer settings
 flags.DEFINE_float('lr', 0.01, 'Initial learning rate.')
@@ -126,6 +141,18 @@ flags.DEFINE_integer('max_epochs', 20000, '')
 flags.DEFINE_integer('ckpt_epochs', 10, '')
 flags.DEFINE_integer('val_epochs', 10, '')
 flags.DEFINE_boolean('adam', False, '')
+flags.DEFINE_boolean('uint8', False, 'images and labels as narrow integers, converted on device')
+flags.DEFINE_boolean('sparse_targets', False, 'feed params targets of positive cells only')
+flags.DEFINE_integer('prefetch', 0, 'prefetch queue depth, 0 to read batches synchronously')
+flags.DEFINE_integer('prefetch_workers', 2, 'prefetch threads, each with its own stream')
+flags.DEFINE_integer('cores', 0, 'cores shared by TF, the cpp OpenMP loops and picpac, 0 for defaults')
+flags.DEFINE_boolean('pin_cores', False, 'run on cores core_offset .. core_offset+cores-1 only')
+flags.DEFINE_integer('core_offset', 0, '')
+flags.DEFINE_integer('log_steps', 20, 'read and log training metrics every this many steps')
+flags.DEFINE_string('metrics_log', None, 'JSONL metrics log, default is metrics.jsonl in the model directory')
+flags.DEFINE_string('profile', None, 'write step timing and traces to this directory')
+flags.DEFINE_integer('profile_trace_steps', 1000, 'full RunMetadata trace every this many steps, 0 for none')
+flags.DEFINE_integer('profile_summary_steps', 100, 'print a timing summary every this many steps')
 
 flags.DEFINE_float('pl_weight', 1.0/50, '')
 flags.DEFINE_float('re_weight', 0.1, '')
@@ -168,7 +195,7 @@ def setup_finetune (ckpt, exclusions):
             ignore_missing_vars=False), variables_to_train
 
 
-def create_picpac_stream (db_path, is_training):
+def create_picpac_stream (db_path, is_training, seed=None):
     assert os.path.exists(db_path)
     augments = []
     if is_training:
@@ -188,8 +215,8 @@ def create_picpac_stream (db_path, is_training):
               "annotate": True,
               "channels": 3,
               "stratify": is_training,
-              "dtype": "float32",
-              "batch": FLAGS.batch,
+              "dtype": "uint8" if FLAGS.uint8 else "float32",
+              "batch": 1 if FLAGS.buckets else FLAGS.batch,   # BucketBatcher makes batches
               "colorspace": COLORSPACE,
               "transforms": augments + [
                   {"type": "clip", "round": FLAGS.backbone_stride},
@@ -197,16 +224,40 @@ def create_picpac_stream (db_path, is_training):
                   {"type": "rasterize"},
                   ]
              }
+    if not seed is None:
+        picpac_config['seed'] = seed
     if is_training and not FLAGS.mixin is None:
         print("mixin support is incomplete in new picpac.")
     #    assert os.path.exists(FLAGS.mixin)
     #    picpac_config['mixin'] = FLAGS.mixin
     #    picpac_config['mixin_group_delta'] = 1
     #    pass
-    return picpac.ImageStream(picpac_config)
+    stream = picpac.ImageStream(BUDGET.picpac(picpac_config))
+    if FLAGS.buckets:
+        stream = BucketBatcher(stream, FLAGS.batch, parse_sizes(FLAGS.buckets, FLAGS.backbone_stride))
+    return stream
+
+def encode_sample (sample, params):
+    # with --uint8 gt_anchors are narrowed, with --sparse_targets
+    # gt_params and gt_params_weight become index, values and weight;
+    # applied before batches are queued and before they are fed
+    if not (FLAGS.uint8 or FLAGS.sparse_targets):
+        return sample
+    sample = list(sample)
+    if FLAGS.uint8:
+        sample[3] = sample[3].astype(np.uint8)
+    if FLAGS.sparse_targets:
+        sample[5:7] = sparse_params(sample[5], sample[6], params)
+    return tuple(sample)
+
+BUDGET = ThreadBudget()     # set by main()
 
 def main (_):
-    global PIXEL_MEANS
+    global PIXEL_MEANS, BUDGET
+    BUDGET = ThreadBudget(FLAGS.cores, FLAGS.pin_cores, FLAGS.core_offset,
+                          FLAGS.prefetch_workers if FLAGS.prefetch > 0 else 1)
+    BUDGET.apply()
+    print(BUDGET)
 
     logging.basicConfig(filename='train-%s-%s.log' % (FLAGS.backbone, datetime.datetime.now().strftime('%Y%m%d-%H%M%S')),level=logging.DEBUG, format='%(asctime)s %(message)s')
 
@@ -226,12 +277,49 @@ def main (_):
     elif FLAGS.shape == 'box':
         shape_config = ShapeConfig(4)
 
-    X = tf.placeholder(tf.float32, shape=(None, None, None, 3), name="images")
-    # ground truth labels
-    gt_anchors = tf.placeholder(tf.int32, shape=(None, None, None, shape_config.priors))
-    gt_anchors_weight = tf.placeholder(tf.float32, shape=(None, None, None, shape_config.priors))
-    gt_params = tf.placeholder(tf.float32, shape=(None, None, None, shape_config.priors * shape_config.params))
-    gt_params_weight = tf.placeholder(tf.float32, shape=(None, None, None, shape_config.priors))
+    stream = create_picpac_stream(FLAGS.db, True)
+    streams = [stream]
+    prefetcher = None
+    generator = None
+    if FLAGS.prefetch > 0:
+        # decode and augment in background threads, batches reach the
+        # graph through tf.data instead of feed_dict
+        prefetcher = Prefetcher(lambda i: stream if i == 0 else create_picpac_stream(FLAGS.db, True, seed=i),
+                                FLAGS.prefetch_workers, FLAGS.prefetch,
+                                transform=lambda sample: encode_sample(sample, shape_config.params))
+        streams = prefetcher.streams
+        # drop meta and gt_masks
+        generator = lambda: (sample[1:2] + sample[3:] for sample in prefetcher)
+
+    if FLAGS.sparse_targets:
+        params_specs = [(tf.int32, (None,), None),
+                        (tf.float32, (None, shape_config.params), None),
+                        (tf.float32, (None,), None)]
+    else:
+        params_specs = [(tf.float32, (None, None, None, shape_config.priors * shape_config.params), None),
+                        (tf.float32, (None, None, None, shape_config.priors), None)]
+    inputs = create_inputs([
+                (tf.uint8 if FLAGS.uint8 else tf.float32, (None, None, None, 3), "images"),
+                # ground truth labels
+                (tf.uint8 if FLAGS.uint8 else tf.int32, (None, None, None, shape_config.priors), None),
+                (tf.float32, (None, None, None, shape_config.priors), None)]
+                + params_specs, generator, FLAGS.prefetch)
+    X, targets = inputs[0], inputs[1:]      # targets in the order of the encoded sample
+    gt_anchors, gt_anchors_weight = targets[:2]
+    gt_params_index = None
+    if FLAGS.sparse_targets:
+        gt_params_index, gt_params, gt_params_weight = targets[2:]
+    else:
+        gt_params, gt_params_weight = targets[2:]
+
+    def feed_sample (feed_dict, sample):
+        # sample: picpac sample, gt_masks is not used
+        sample = encode_sample(sample, shape_config.params)
+        feed_dict.update(zip([X] + targets, sample[1:2] + sample[3:]))
+        return feed_dict
+    batch_size = tf.shape(X)[0]
+    timeline = StepTimeline(FLAGS.profile, FLAGS.profile_trace_steps, FLAGS.profile_summary_steps)
+    atexit.register(timeline.close)
 
     is_training = tf.placeholder(tf.bool, name="is_training")
 
@@ -250,11 +338,12 @@ def main (_):
     with slim.arg_scope([slim.conv2d, slim.conv2d_transpose, slim.max_pool2d], padding='SAME'), \
          slim.arg_scope([slim.conv2d, slim.conv2d_transpose], weights_regularizer=slim.l2_regularizer(2.5e-4), normalizer_fn=slim.batch_norm, normalizer_params={'decay': 0.9, 'epsilon': 5e-4, 'scale': False, 'is_training':is_training}), \
          slim.arg_scope([slim.batch_norm], is_training=is_training):
-        bb, _ = network_fn(X-PIXEL_MEANS, global_pool=False, output_stride=16)
+        # images may be uint8, converted here on the device
+        bb, _ = network_fn(tf.cast(X, tf.float32)-PIXEL_MEANS, global_pool=False, output_stride=16)
         assert FLAGS.backbone_stride % FLAGS.ft_stride == 0
         ss = FLAGS.backbone_stride // FLAGS.ft_stride
         ft = slim.conv2d_transpose(bb, FLAGS.ft_filters, ss*2, ss)
-        _, _, loss, metrics = create_net(ft, gt_anchors, gt_anchors_weight, gt_params, gt_params_weight, shape_config)
+        _, _, loss, metrics = create_net(ft, gt_anchors, gt_anchors_weight, gt_params, gt_params_weight, shape_config, gt_params_index)
 
     #network_fn = nets_factory.get_network_fn(FLAGS.backbone, num_classes=None,
     #            weight_decay=FLAGS.weight_decay, is_training=is_training)
@@ -284,9 +373,17 @@ def main (_):
         optimizer = tf.train.MomentumOptimizer(learning_rate=LR, momentum=0.9)
 
     train_op = slim.learning.create_train_op(loss, optimizer, global_step=global_step, variables_to_train=variables_to_train)
+    # training metrics are averaged in the graph and read every log_steps
+    streaming = StreamingMetrics(metrics, batch_size)
+    metrics_log = FLAGS.metrics_log
+    if metrics_log is None and FLAGS.model:
+        metrics_log = os.path.join(FLAGS.model, 'metrics.jsonl')
+    jsonl = JsonLog(metrics_log)
     saver = tf.train.Saver(max_to_keep=FLAGS.max_to_keep)
+    async_saver = None
+    if FLAGS.async_ckpt and FLAGS.model:
+        async_saver = AsyncSaver(saver, FLAGS.max_to_keep, FLAGS.keep_ckpt_hours)
 
-    stream = create_picpac_stream(FLAGS.db, True)
     # load validation db
     val_stream = None
     if FLAGS.val_db:
@@ -299,84 +396,109 @@ def main (_):
 
     ss_config = tf.ConfigProto()
     ss_config.gpu_options.allow_growth=True
-    with tf.Session(config=ss_config) as sess:
-        sess.run(tf.global_variables_initializer())
-        sess.run(tf.local_variables_initializer())
-        if init_finetune:
-            init_finetune(sess)
-        if FLAGS.resume:
-            saver.restore(sess, FLAGS.resume)
-
-        global_start_time = time.time()
-        epoch = 0
-        step = 0
-        while epoch < FLAGS.max_epochs:
-            start_time = time.time()
-            cnt, metrics_sum = 0, np.array([0] * len(metrics), dtype=np.float32)
-            progress = tqdm(range(epoch_steps), leave=False)
-            for _ in progress:
-                _, images, _, gt_anchors_, gt_anchors_weight_, gt_params_, gt_params_weight_ = stream.next()
-                feed_dict = {X: images,
-                             gt_anchors: gt_anchors_,
-                             gt_anchors_weight: gt_anchors_weight_,
-                             gt_params: gt_params_,
-                             gt_params_weight: gt_params_weight_,
-                             is_training: True}
-                mm, _ = sess.run([metrics, train_op], feed_dict=feed_dict)
-                metrics_sum += np.array(mm) * images.shape[0]
-                cnt += images.shape[0]
-                metrics_txt = format_metrics(metrics_sum/cnt)
-                progress.set_description(metrics_txt)
-                step += 1
-                pass
-            stop = time.time()
-            msg = 'train epoch=%d step=%d ' % (epoch, step)
-            msg += metrics_txt
-            msg += ' elapsed=%.3f time=%.3f ' % (stop - global_start_time, stop - start_time)
-            print_green(msg)
-            logging.info(msg)
-
-            epoch += 1
-
-            if (epoch % FLAGS.val_epochs == 0) and val_stream:
-                lr = sess.run(LR)
-                # evaluation
-                Ys, Ps = [], []
+    BUDGET.configure(ss_config)
+    try:
+        with tf.Session(config=ss_config) as sess:
+            sess.run(tf.global_variables_initializer())
+            sess.run(tf.local_variables_initializer())
+            if init_finetune:
+                init_finetune(sess)
+            if FLAGS.resume:
+                saver.restore(sess, FLAGS.resume)
+
+            global_start_time = time.time()
+            epoch = 0
+            step = 0
+            while epoch < FLAGS.max_epochs:
+                start_time = time.time()
                 cnt, metrics_sum = 0, np.array([0] * len(metrics), dtype=np.float32)
-                val_stream.reset()
-                progress = tqdm(val_stream, leave=False)
-                for _, images, _, gt_anchors_, gt_anchors_weight_, gt_params_, gt_params_weight_ in progress:
-                    feed_dict = {X: images,
-                             gt_anchors: gt_anchors_,
-                             gt_anchors_weight: gt_anchors_weight_,
-                             gt_params: gt_params_,
-                             gt_params_weight: gt_params_weight_,
-                             is_training: False}
-                    p, mm = sess.run([probs, metrics], feed_dict=feed_dict)
-                    metrics_sum += np.array(mm) * images.shape[0]
-                    cnt += images.shape[0]
-                    Ys.extend(list(meta.labels))
-                    Ps.extend(list(p))
-                    metrics_txt = format_metrics(metrics_sum/cnt)
-                    progress.set_description(metrics_txt)
+                epoch_start_step = step
+                progress = tqdm(range(epoch_steps), leave=False)
+                for _ in progress:
+                    feed_dict = {is_training: True}
+                    if generator is None:
+                        with timeline.phase('data'):
+                            sample = stream.next()
+                        with timeline.phase('feed'):
+                            feed_sample(feed_dict, sample)
+                    options, run_metadata = timeline.run_options()
+                    with timeline.phase('run'):
+                        sess.run([streaming.update, train_op], feed_dict=feed_dict,
+                                 options=options, run_metadata=run_metadata)
+                    timeline.add_run_metadata(run_metadata)
+                    step += 1
+                    if step % FLAGS.log_steps == 0 or step - epoch_start_step == epoch_steps:
+                        with timeline.phase('metrics'):
+                            mm, bs = streaming.read(sess)
+                            metrics_sum += np.array(mm) * bs
+                            cnt += bs
+                            metrics_txt = format_metrics(metrics_sum/cnt)
+                            sps = cnt / (time.time() - start_time)
+                            progress.set_description(metrics_txt + ' sps=%.1f' % sps)
+                            record = dict(zip(metric_names, [float(x) for x in mm]))
+                            jsonl.write(mode='train', epoch=epoch, step=step, samples=int(bs), sps=sps,
+                                        time=time.time(), **record)
+                    summary = timeline.end_step()
+                    if summary:
+                        progress.write(summary)
+                        logging.info(summary)
                     pass
-                assert cnt == val_stream.size()
-                avg = metrics_sum / cnt
-                if avg[0] > best:
-                    best = avg[0]
-                msg = 'valid epoch=%d step=%d ' % (epoch-1, step)
+                stop = time.time()
+                msg = 'train epoch=%d step=%d ' % (epoch, step)
                 msg += metrics_txt
-                msg += ' lr=%.4f best=%.3f' % (lr, best)
-                print_red(msg)
+                msg += ' elapsed=%.3f time=%.3f sps=%.1f ' % (stop - global_start_time, stop - start_time, cnt / (stop - start_time))
+                waste = padding_waste(streams)
+                if FLAGS.buckets:
+                    msg += 'waste=%.3f ' % waste
+                jsonl.write(mode='epoch', epoch=epoch, step=step, samples=int(cnt), sps=cnt / (stop - start_time),
+                            time=stop, waste=waste, **dict(zip(metric_names, [float(x) for x in metrics_sum/cnt])))
+                print_green(msg)
                 logging.info(msg)
-                #log.write('%d\t%s\t%.4f\n' % (epoch, '\t'.join(['%.4f' % x for x in avg]), best))
-            # model saving
-            if (epoch % FLAGS.ckpt_epochs == 0) and FLAGS.model:
-                ckpt_path = '%s/%d' % (FLAGS.model, epoch)
-                saver.save(sess, ckpt_path)
-                print('saved to %s.' % ckpt_path)
+
+                epoch += 1
+
+                if (epoch % FLAGS.val_epochs == 0) and val_stream:
+                    lr = sess.run(LR)
+                    # evaluation
+                    cnt, metrics_sum = 0, np.array([0] * len(metrics), dtype=np.float32)
+                    val_stream.reset()
+                    progress = tqdm(val_stream, leave=False)
+                    for sample in progress:
+                        images = sample[1]
+                        feed_dict = feed_sample({is_training: False}, sample)
+                        mm = sess.run(metrics, feed_dict=feed_dict)
+                        metrics_sum += np.array(mm) * images.shape[0]
+                        cnt += images.shape[0]
+                        metrics_txt = format_metrics(metrics_sum/cnt)
+                        progress.set_description(metrics_txt)
+                        pass
+                    assert cnt == val_stream.size()
+                    avg = metrics_sum / cnt
+                    if avg[0] > best:
+                        best = avg[0]
+                    msg = 'valid epoch=%d step=%d ' % (epoch-1, step)
+                    msg += metrics_txt
+                    msg += ' lr=%.4f best=%.3f' % (lr, best)
+                    print_red(msg)
+                    logging.info(msg)
+                    #log.write('%d\t%s\t%.4f\n' % (epoch, '\t'.join(['%.4f' % x for x in avg]), best))
+                # model saving
+                if (epoch % FLAGS.ckpt_epochs == 0) and FLAGS.model:
+                    ckpt_path = '%s/%d' % (FLAGS.model, epoch)
+                    with timeline.phase('checkpoint'):
+                        if async_saver:
+                            async_saver.save(sess, ckpt_path)
+                        else:
+                            saver.save(sess, ckpt_path)
+                    print('saved to %s.' % ckpt_path)
+                pass
+            if async_saver:
+                async_saver.close()
             pass
-        pass
+    finally:
+        # after the session, which may still be reading from it
+        if prefetcher:
+            prefetcher.close()
     pass
 
 if __name__ == '__main__':
@@ -6,6 +6,8 @@ sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'models
 sys.path.insert(0, 'build/lib.linux-x86_64-3.5')
 sys.path.insert(0, '../picpac/build/lib.linux-x86_64-3.5')
 import time
+import atexit
+import multiprocessing
 import datetime
 import logging
 from tqdm import tqdm
@@ -15,6 +17,15 @@ import tensorflow.contrib.slim as slim
 from nets import nets_factory, resnet_utils 
 import picpac
 import cpp
+from prefetch import Prefetcher, create_inputs
+from profiling import StepTimeline
+from streaming import StreamingMetrics, JsonLog
+from checkpoint import AsyncSaver
+from parallel import AllReduce
+from cache import CachedStream, cache_key
+from targets import sparse_params, sparse_params_loss
+from bucket import BucketBatcher, parse_sizes, padding_waste
+from threads import ThreadBudget
 
 def patch_arg_scopes ():
     def resnet_arg_scope (weight_decay=0.0001):
@@ -66,11 +77,13 @@ FLAGS = flags.FLAGS
 
 flags.DEFINE_string('db', None, 'training db')
 flags.DEFINE_string('val_db', None, 'validation db')
+flags.DEFINE_string('val_cache', None, 'keep decoded validation batches in this directory')
 flags.DEFINE_integer('classes', 2, 'number of classes')
 flags.DEFINE_string('mixin', None, 'mix-in training db')
 
 flags.DEFINE_integer('size', None, '') 
 flags.DEFINE_integer('batch', 1, 'Batch size.  ')
+flags.DEFINE_string('buckets', None, 'comma separated image sizes, e.g. 512,768,1024; pads images to these sizes to make batches')
 flags.DEFINE_integer('shift', 0, '')
 flags.DEFINE_integer('backbone_stride', 16, '')
 flags.DEFINE_integer('anchor_filters', 128, '')
@@ -81,12 +94,17 @@ flags.DEFINE_integer('mask_size', 128, '')
 flags.DEFINE_float('anchor_th', 0.5, '')
 flags.DEFINE_float('nms_th', 0.5, '')
 flags.DEFINE_float('match_th', 0.5, '')
+flags.DEFINE_integer('max_boxes', 10000, 'max boxes kept by nms per image')
+flags.DEFINE_string('eval_iou', '0.5,0.75', 'IoU thresholds of validation AP, precision and recall are at the first')
+flags.DEFINE_integer('eval_bins', 1000, 'score histogram bins of validation AP')
 
 flags.DEFINE_string('backbone', 'resnet_v2_50', 'architecture')
 flags.DEFINE_string('model', None, 'model directory')
 flags.DEFINE_string('resume', None, 'resume training from this model')
 flags.DEFINE_string('finetune', None, '')
 flags.DEFINE_integer('max_to_keep', 100, '')
+flags.DEFINE_boolean('async_ckpt', False, 'write checkpoints in a background thread')
+flags.DEFINE_float('keep_ckpt_hours', 10000, 'with async_ckpt, also keep one checkpoint every this many hours')
 
 # optimizer settings
 flags.DEFINE_float('lr', 0.01, 'Initial learning rate.')
@@ -99,6 +117,19 @@ flags.DEFINE_integer('max_epochs', 20000, '')
 flags.DEFINE_integer('ckpt_epochs', 10, '')
 flags.DEFINE_integer('val_epochs', 10, '')
 flags.DEFINE_boolean('adam', False, '')
+flags.DEFINE_boolean('uint8', False, 'images and labels as narrow integers, converted on device')
+flags.DEFINE_boolean('sparse_targets', False, 'feed params targets of positive cells only')
+flags.DEFINE_integer('workers', 1, 'data-parallel training processes, each takes batch samples per step')
+flags.DEFINE_integer('prefetch', 0, 'prefetch queue depth, 0 to read batches synchronously')
+flags.DEFINE_integer('prefetch_workers', 2, 'prefetch threads, each with its own stream')
+flags.DEFINE_integer('cores', 0, 'cores shared by TF, the cpp OpenMP loops and picpac, split between workers; 0 for defaults')
+flags.DEFINE_boolean('pin_cores', False, 'run on cores core_offset .. core_offset+cores-1 only')
+flags.DEFINE_integer('core_offset', 0, '')
+flags.DEFINE_integer('log_steps', 20, 'read and log training metrics every this many steps')
+flags.DEFINE_string('metrics_log', None, 'JSONL metrics log, default is metrics.jsonl in the model directory')
+flags.DEFINE_string('profile', None, 'write step timing and traces to this directory')
+flags.DEFINE_integer('profile_trace_steps', 1000, 'full RunMetadata trace every this many steps, 0 for none')
+flags.DEFINE_integer('profile_summary_steps', 100, 'print a timing summary every this many steps')
 
 flags.DEFINE_float('pl_weight', 1.0/50, '')
 flags.DEFINE_float('re_weight', 0.1, '')
@@ -109,73 +140,108 @@ VGG_PIXEL_MEANS = tf.constant([[[[103.94, 116.78, 123.68]]]])
 
 PRIORS = [1]    # placeholder
 
+BUDGET = ThreadBudget()     # set by train()
+
 class Inputs:
-    def __init__ (self):
-        self.X = tf.placeholder(tf.float32, shape=(None, None, None, 3), name="images")
+    # prefetcher: optional Prefetcher of picpac samples; if given images
+    # and ground truth come from a tf.data pipeline instead of feed_dict
+    # with --sparse_targets gt_params and gt_params_weight are replaced by
+    # gt_params_index, gt_params_values and gt_params_sparse_weight, see
+    # targets.py
+    def __init__ (self, prefetcher=None):
+        generator = None
+        if prefetcher:
+            generator = lambda: (sample[1:] for sample in prefetcher)  # drop meta
+        if FLAGS.sparse_targets:
+            params_specs = [(tf.int32, (None,), None),
+                            (tf.float32, (None, 4), None),
+                            (tf.float32, (None,), None)]
+        else:
+            params_specs = [(tf.float32, (None, None, None, len(PRIORS) * 4), None),
+                            (tf.float32, (None, None, None, len(PRIORS)), None)]
+        tensors = create_inputs([
+                    (tf.uint8 if FLAGS.uint8 else tf.float32, (None, None, None, 3), "images"),
+                    (tf.uint16 if FLAGS.uint8 else tf.int32, (None, None, None, 1), None),
+                    (tf.uint8 if FLAGS.uint8 else tf.int32, (None, None, None, len(PRIORS)), None),
+                    (tf.float32, (None, None, None, len(PRIORS)), None)]
+                    + params_specs +
+                    [(tf.float32, (None, None), None)], generator, FLAGS.prefetch)
+        # gt_xxx groundtruth
+        self.X, self.gt_masks, self.gt_anchors, self.gt_anchors_weight = tensors[:4]
+        if FLAGS.sparse_targets:
+            self.gt_params_index, self.gt_params_values, self.gt_params_sparse_weight = tensors[4:7]
+        else:
+            self.gt_params, self.gt_params_weight = tensors[4:6]
+        self.gt_boxes = tensors[-1]
         self.anchor_th = tf.placeholder(tf.float32, shape=(), name="anchor_th")
         self.nms_th = tf.placeholder(tf.float32, shape=(), name="nms_th")
-        # gt_xxx groundtruth
-        self.gt_masks = tf.placeholder(tf.int32, shape=(None, None, None, 1))
-        self.gt_anchors = tf.placeholder(tf.int32, shape=(None, None, None, len(PRIORS)))
-        self.gt_anchors_weight = tf.placeholder(tf.float32, shape=(None, None, None, len(PRIORS)))
-        self.gt_params = tf.placeholder(tf.float32, shape=(None, None, None, len(PRIORS) * 4))
-        self.gt_params_weight = tf.placeholder(tf.float32, shape=(None, None, None, len(PRIORS)))
-        self.gt_boxes = tf.placeholder(tf.float32, shape=(None, None))
         self.is_training = tf.placeholder(tf.bool, name="is_training")
+        self.batch_size = tf.shape(self.X)[0]
         pass
 
+    # picpac sample -> the layout of the input tensors (with meta);
+    # with --uint8 label arrays are narrowed, with --sparse_targets params
+    # targets are made sparse.  Applied by the prefetch workers before
+    # batches are queued, and by feed_dict.
+    @staticmethod
+    def encode (sample):
+        if not (FLAGS.uint8 or FLAGS.sparse_targets):
+            return sample
+        sample = list(sample)
+        if FLAGS.uint8:
+            sample[2] = sample[2].astype(np.uint16)     # gt_masks
+            sample[3] = sample[3].astype(np.uint8)      # gt_anchors
+        if FLAGS.sparse_targets:
+            sample[5:7] = sparse_params(sample[5], sample[6], 4)
+        return tuple(sample)
+
     # create feed_dict from a picpac sample
+    # sample is None when inputs come from the prefetcher
     def feed_dict (self, sample, is_training):
-        _, images, gt_masks_, gt_anchors_, gt_anchors_weight_, gt_params_, gt_params_weight_, gt_boxes_ = sample  # unpack picpac sample
-        return {self.X: images,
-                self.anchor_th: FLAGS.anchor_th,
-                self.nms_th: FLAGS.nms_th,
+        feed_dict = {self.anchor_th: FLAGS.anchor_th,
+                     self.nms_th: FLAGS.nms_th,
+                     self.is_training: is_training}
+        if sample is None:
+            return feed_dict
+        sample = self.encode(sample)
+        _, images, gt_masks_, gt_anchors_, gt_anchors_weight_ = sample[:5]  # unpack picpac sample
+        feed_dict.update({self.X: images,
                 self.gt_masks: gt_masks_,
                 self.gt_anchors: gt_anchors_,
                 self.gt_anchors_weight: gt_anchors_weight_,
-                self.gt_params: gt_params_,
-                self.gt_params_weight: gt_params_weight_,
-                self.gt_boxes: gt_boxes_,
-                self.is_training: is_training}
-        pass
+                self.gt_boxes: sample[-1]})
+        if FLAGS.sparse_targets:
+            feed_dict.update({self.gt_params_index: sample[5],
+                self.gt_params_values: sample[6],
+                self.gt_params_sparse_weight: sample[7]})
+        else:
+            feed_dict.update({self.gt_params: sample[5],
+                self.gt_params_weight: sample[6]})
+        return feed_dict
+
 
+def anchor_centers (H, W):
+    # (x0, y0) of every anchor of a H * W feature map, H * W * 1 * 2
+    # broadcasts against params of shape B * H * W * priors * 2
+    x0 = tf.cast(tf.range(W) * FLAGS.anchor_stride, tf.float32)
+    y0 = tf.cast(tf.range(H) * FLAGS.anchor_stride, tf.float32)
+    return tf.expand_dims(tf.stack(tf.meshgrid(x0, y0), axis=2), 2)
 
 def anchors2boxes (shape, anchor_params):
     # anchor parameters are: dx, dy, w, h
+    # in B * H * W * priors order, as reshaped from the feature map
     B = shape[0]
     H = shape[1]
     W = shape[2]
-    box_ind = tf_repeat(tf.range(B), [H * W * len(PRIORS)])
-    if True:    # generate array of box centers
-        x0 = tf.cast(tf.range(W) * FLAGS.anchor_stride, tf.float32)
-        y0 = tf.cast(tf.range(H) * FLAGS.anchor_stride, tf.float32)
-        x0, y0 = tf.meshgrid(x0, y0)
-        x0 = tf.reshape(x0, (-1,))
-        y0 = tf.reshape(y0, (-1,))
-        x0 = tf.tile(tf_repeat(x0, [len(PRIORS)]), [B])
-        y0 = tf.tile(tf_repeat(y0, [len(PRIORS)]), [B])
-    dx, dy, w, h = [tf.squeeze(x, axis=1) for x in tf.split(anchor_params, [1,1,1,1], 1)]
-
-    W = tf.cast(W, tf.float32)
-    H = tf.cast(H, tf.float32)
-
-    max_X = W-1
-    max_Y = H-1
-
-    w = tf.clip_by_value(w, 0, W)
-    h = tf.clip_by_value(h, 0, H)
-
-    x1 = x0 + dx - w/2
-    y1 = y0 + dy - h/2
-    x2 = x1 + w
-    y2 = y1 + h
-    x1 = tf.clip_by_value(x1, 0, max_X) 
-    y1 = tf.clip_by_value(y1, 0, max_Y)
-    x2 = tf.clip_by_value(x2, 0, max_X)
-    y2 = tf.clip_by_value(y2, 0, max_Y)
-
-    boxes = tf.stack([x1, y1, x2, y2], axis=1)
-    return boxes, box_ind
+    params = tf.reshape(anchor_params, (B, H, W, len(PRIORS), 4))
+    box_ind = tf.reshape(tf.expand_dims(tf.range(B), 1) + tf.zeros((1, H * W * len(PRIORS)), tf.int32), (-1,))
+
+    size = tf.cast(tf.stack([W, H]), tf.float32)    # w, h are clipped to this
+    wh = tf.minimum(tf.maximum(params[:, :, :, :, 2:], 0), size)
+    x1y1 = anchor_centers(H, W) + params[:, :, :, :, :2] - wh/2
+    boxes = tf.concat([x1y1, x1y1 + wh], axis=4)
+    boxes = tf.minimum(tf.maximum(boxes, 0), tf.tile(size - 1, [2]))
+    return tf.reshape(boxes, (-1, 4)), box_ind
 
 def normalize_boxes (shape, boxes):
     H = shape[1]
@@ -189,23 +255,35 @@ def normalize_boxes (shape, boxes):
     y2 = y2 / max_Y
     return tf.stack([x1, y1, x2, y2], axis=1)
 
-def shift_boxes (boxes, box_ind):
-    assert FLAGS.batch == 1
-    return boxes
-
 def xxx_print (array):
     print(array)
     return np.zeros([1], dtype=np.float32)
 
-def create_model (inputs, backbone_fn):
+class MaskBuffer:
+    # calls MaskExtractor with an output buffer that is reused across
+    # steps and only grows, instead of allocating new masks every step
+    def __init__ (self, extractor):
+        self.extractor = extractor
+        self.masks = np.zeros((0, FLAGS.mask_size, FLAGS.mask_size, 1), dtype=np.float32)
+        pass
+
+    def __call__ (self, images, gt_boxes, boxes):
+        n = boxes.shape[0]
+        if self.masks.shape[0] < n:
+            self.masks = np.zeros((n * 2,) + self.masks.shape[1:], dtype=np.float32)
+        return self.extractor.apply(images, gt_boxes, boxes, self.masks[:n])
+    pass
+
+def create_model (inputs, backbone_fn, timeline=StepTimeline()):
     #box_ft, mask_ft, gt_masks, gt_anchors, gt_anchors_weight, gt_params, gt_params_weight, gt_boxes, config):
     # ft:           B * H' * W' * 3     input feature, H' W' is feature map size
     # gt_counts:    B                   number of boxes in each sample of the batch
     # gt_boxes:     ? * 4               boxes
-    bb, _ = backbone_fn(inputs.X-PIXEL_MEANS, global_pool=False, output_stride=FLAGS.backbone_stride)
+    # images may be uint8, converted here on the device
+    bb, _ = backbone_fn(tf.cast(inputs.X, tf.float32)-PIXEL_MEANS, global_pool=False, output_stride=FLAGS.backbone_stride)
 
-    gt_matcher = cpp.GTMatcher(FLAGS.match_th)
-    mask_extractor = cpp.MaskExtractor(FLAGS.mask_size, FLAGS.mask_size)
+    nms = cpp.NMS(FLAGS.max_boxes, FLAGS.match_th)
+    mask_extractor = MaskBuffer(cpp.MaskExtractor(FLAGS.mask_size, FLAGS.mask_size))
 
     with tf.variable_scope('boxnet'):
 
@@ -223,7 +301,7 @@ def create_model (inputs, backbone_fn):
         # anchor probabilities
         anchor_prob = tf.squeeze(tf.slice(tf.nn.softmax(anchor_logits2), [0, 1], [-1, 1]), 1)
 
-        gt_anchors = tf.reshape(inputs.gt_anchors, (-1, ))
+        gt_anchors = tf.reshape(tf.cast(inputs.gt_anchors, tf.int32), (-1, ))
         gt_anchors_weight = tf.reshape(inputs.gt_anchors_weight, (-1,))
 
         # anchor cross-entropy
@@ -231,30 +309,30 @@ def create_model (inputs, backbone_fn):
         axe = axe * gt_anchors_weight
         axe = tf.reduce_sum(axe) / (tf.reduce_sum(gt_anchors_weight) + 1)
 
-        params = slim.conv2d(anchor_ft, 4 * len(PRIORS), 3, 1, activation_fn=None)
-        params = tf.reshape(params, (-1, 4))     # ? * 4
-        gt_params = tf.reshape(inputs.gt_params, (-1, 4))
-        gt_params_weight = tf.reshape(inputs.gt_params_weight, (-1,))
+        params_ft = slim.conv2d(anchor_ft, 4 * len(PRIORS), 3, 1, activation_fn=None)
+        params = tf.reshape(params_ft, (-1, 4))     # ? * 4
         # params loss
-        pl = params - gt_params
-        pl = pl * pl
-        pl = tf.reduce_sum(pl, axis=1) * gt_params_weight
-        pl = tf.reduce_sum(pl) / (tf.reduce_sum(gt_params_weight) + 1)
+        if FLAGS.sparse_targets:
+            pl = sparse_params_loss(params, inputs.gt_params_index, inputs.gt_params_values,
+                                    inputs.gt_params_sparse_weight,
+                                    lambda p, gt: tf.reduce_sum(tf.square(p - gt), axis=1))
+        else:
+            gt_params = tf.reshape(inputs.gt_params, (-1, 4))
+            gt_params_weight = tf.reshape(inputs.gt_params_weight, (-1,))
+            pl = params - gt_params
+            pl = pl * pl
+            pl = tf.reduce_sum(pl, axis=1) * gt_params_weight
+            pl = tf.reduce_sum(pl) / (tf.reduce_sum(gt_params_weight) + 1)
 
         # generate boxes from anchor params
         boxes, box_ind = anchors2boxes(tf.shape(anchor_ft), params)
 
-        sel = tf.greater_equal(anchor_prob, inputs.anchor_th)
-        # sel is a boolean mask
-
-        # select only boxes with prob > th for nms
-        anchor_prob = tf.boolean_mask(anchor_prob, sel)
-        boxes = tf.boolean_mask(boxes, sel)
-        box_ind = tf.boolean_mask(box_ind, sel)
-
-        sel = tf.image.non_max_suppression(shift_boxes(boxes, box_ind), anchor_prob, 10000, iou_threshold=inputs.nms_th)
+        # threshold by prob >= anchor_th, per-image nms and matching
+        # against gt_boxes, all in one host call
         # sel is a list of indices
+        sel, index, gt_index = tf.py_func(timeline.wrap(nms.apply, 'nms'), [anchor_prob, boxes, box_ind, inputs.anchor_th, inputs.nms_th, inputs.gt_boxes], [tf.int32, tf.int32, tf.int32])
 
+        scores = tf.gather(anchor_prob, sel)
         anchor_prob = None  # discard
         boxes = tf.gather(boxes, sel)
         box_ind = tf.gather(box_ind, sel)
@@ -262,8 +340,6 @@ def create_model (inputs, backbone_fn):
         boxes_predicted = boxes
         box_ind_predicted = box_ind
 
-        index, gt_index = tf.py_func(gt_matcher.apply, [boxes, box_ind, inputs.gt_boxes], [tf.int32, tf.int32])
-
         # % boxes found
         precision = tf.cast(tf.shape(gt_index)[0], tf.float32) / tf.cast(tf.shape(boxes)[0] + 1, tf.float32);
         recall = tf.cast(tf.shape(index)[0], tf.float32) / tf.cast(tf.shape(inputs.gt_boxes)[0] + 1, tf.float32);
@@ -279,7 +355,7 @@ def create_model (inputs, backbone_fn):
             mask_ft = tf.image.crop_and_resize(mask_ft, nboxes, box_ind, [FLAGS.mask_size, FLAGS.mask_size])
             mlogits = slim.conv2d(mask_ft, 2, 3, 1, activation_fn=None) 
 
-            gt_masks = tf.py_func(mask_extractor.apply, [inputs.gt_masks, gt_boxes, boxes], [tf.float32])
+            gt_masks = tf.py_func(timeline.wrap(mask_extractor, 'mask'), [inputs.gt_masks, gt_boxes, boxes], [tf.float32])
             gt_masks = tf.cast(tf.round(gt_masks), tf.int32)
             # mask cross entropy
             mxe = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=mlogits, labels=gt_masks)
@@ -287,9 +363,14 @@ def create_model (inputs, backbone_fn):
         else:
             mxe = tf.constant(0, tf.float32)
 
-    #tf.identity(logits, name='logits')
-    #tf.identity(params, name='params')
+    # B * H * W * (2 * priors) and B * H * W * (4 * priors), as expected
+    # by inference.Model and export.py
+    tf.identity(anchor_logits, name='logits')
+    tf.identity(params_ft, name='params')
     tf.identity(boxes_predicted, name='boxes')
+    tf.identity(scores, name='scores')
+    tf.identity(box_ind_predicted, name='box_ind')
+    tf.identity(index, name='matched')      # boxes matched to a gt box
     #tf.identity(mlogits, name='mlogits')
     axe = tf.identity(axe, name='ax') # cross-entropy
     mxe = tf.identity(mxe, name='mx') # cross-entropy
@@ -334,8 +415,49 @@ def setup_finetune (ckpt, exclusions):
             ignore_missing_vars=False), variables_to_train
 
 
-def create_picpac_stream (db_path, is_training):
-    assert os.path.exists(db_path)
+def build_model (inputs, timeline=StepTimeline()):
+    # backbone + box net with the training arg scopes
+    if not FLAGS.finetune:
+        patch_arg_scopes()
+
+    backbone_fn = nets_factory.get_network_fn(FLAGS.backbone, num_classes=None,
+                weight_decay=FLAGS.weight_decay, is_training=inputs.is_training)
+
+    with slim.arg_scope([slim.conv2d, slim.conv2d_transpose, slim.max_pool2d], padding='SAME'), \
+         slim.arg_scope([slim.conv2d, slim.conv2d_transpose], weights_regularizer=slim.l2_regularizer(2.5e-4), normalizer_fn=slim.batch_norm, normalizer_params={'decay': 0.9, 'epsilon': 5e-4, 'scale': False, 'is_training':inputs.is_training}), \
+         slim.arg_scope([slim.batch_norm], is_training=inputs.is_training):
+        return create_model(inputs, backbone_fn, timeline)
+
+def eval_ious ():
+    return [float(x) for x in FLAGS.eval_iou.split(',')]
+
+def validate (sess, inputs, stream, metrics):
+    # runs stream once; returns the sample weighted mean of metrics, box
+    # precision, recall and AP at the first of --eval_iou, and a dict of
+    # AP at each of them, e.g. {'ap50': .., 'ap75': ..}
+    # boxes are accumulated into cpp.APAccumulator, memory does not grow
+    # with the stream
+    graph = tf.get_default_graph()
+    fetches = [metrics, inputs.batch_size, inputs.gt_boxes,
+               graph.get_tensor_by_name('boxes:0'),
+               graph.get_tensor_by_name('scores:0'),
+               graph.get_tensor_by_name('box_ind:0')]
+    ious = eval_ious()
+    acc = cpp.APAccumulator(ious, FLAGS.eval_bins)
+    cnt, metrics_sum = 0, np.zeros(len(metrics), dtype=np.float64)
+    stream.reset()
+    for sample in tqdm(stream, leave=False):
+        mm, bs, gt_boxes, boxes, scores, box_ind = sess.run(fetches, feed_dict=inputs.feed_dict(sample, False))
+        metrics_sum += np.array(mm) * bs
+        cnt += bs
+        acc.add(boxes, scores, box_ind, gt_boxes)
+    assert cnt == stream.size()
+    precision, recall = acc.totals()
+    ap = acc.ap()
+    aps = dict(('ap%d' % round(th * 100), float(x)) for th, x in zip(ious, ap))
+    return metrics_sum / max(cnt, 1), float(precision[0]), float(recall[0]), float(ap[0]), aps
+
+def picpac_config (db_path, is_training, seed=None):
     augments = []
     if is_training:
         augments = [
@@ -354,8 +476,8 @@ def create_picpac_stream (db_path, is_training):
               "annotate": True,
               "channels": 3,
               "stratify": is_training,
-              "dtype": "float32",
-              "batch": FLAGS.batch,
+              "dtype": "uint8" if FLAGS.uint8 else "float32",
+              "batch": 1 if FLAGS.buckets else FLAGS.batch,   # BucketBatcher makes batches
               "colorspace": COLORSPACE,
               "transforms": augments + [
                   {"type": "clip", "round": FLAGS.backbone_stride},
@@ -364,18 +486,53 @@ def create_picpac_stream (db_path, is_training):
                   {"type": "rasterize"},
                   ]
              }
+    if not seed is None:
+        picpac_config['seed'] = seed
     if is_training and not FLAGS.mixin is None:
         print("mixin support is incomplete in new picpac.")
     #    assert os.path.exists(FLAGS.mixin)
     #    picpac_config['mixin'] = FLAGS.mixin
     #    picpac_config['mixin_group_delta'] = 1
     #    pass
-    return picpac.ImageStream(picpac_config)
+    return picpac_config
 
-def main (_):
-    global PIXEL_MEANS
+def create_picpac_stream (db_path, is_training, seed=None):
+    assert os.path.exists(db_path)
+    stream = picpac.ImageStream(BUDGET.picpac(picpac_config(db_path, is_training, seed)))
+    if FLAGS.buckets:
+        stream = BucketBatcher(stream, FLAGS.batch, parse_sizes(FLAGS.buckets, FLAGS.backbone_stride))
+    return stream
 
-    logging.basicConfig(filename='train-%s-%s.log' % (FLAGS.backbone, datetime.datetime.now().strftime('%Y%m%d-%H%M%S')),level=logging.DEBUG, format='%(asctime)s %(message)s')
+def create_val_stream (db_path):
+    # validation stream, cached in FLAGS.val_cache if given
+    assert os.path.exists(db_path)
+    if not FLAGS.val_cache:
+        return create_picpac_stream(db_path, False)
+    config = picpac_config(db_path, False)
+    config['buckets'] = FLAGS.buckets
+    config['bucket_batch'] = FLAGS.batch
+    return CachedStream(FLAGS.val_cache, cache_key(db_path, config),
+                        lambda: create_picpac_stream(db_path, False))
+
+def train (rank=0, allreduce=None):
+    # with allreduce this is one of the data-parallel workers; rank 0
+    # logs, validates and saves checkpoints
+    global PIXEL_MEANS, BUDGET
+    leader = rank == 0
+    workers = 1
+    if allreduce:
+        allreduce.attach(rank)
+        workers = allreduce.workers
+    # each worker gets its own share of the cores
+    cores = FLAGS.cores // workers
+    BUDGET = ThreadBudget(cores, FLAGS.pin_cores, FLAGS.core_offset + rank * cores,
+                          FLAGS.prefetch_workers if FLAGS.prefetch > 0 else 1)
+    BUDGET.apply()
+    if leader:
+        print(BUDGET)
+
+    if leader:
+        logging.basicConfig(filename='train-%s-%s.log' % (FLAGS.backbone, datetime.datetime.now().strftime('%Y%m%d-%H%M%S')),level=logging.DEBUG, format='%(asctime)s %(message)s')
 
     if FLAGS.model:
         try:
@@ -388,18 +545,20 @@ def main (_):
         COLORSPACE = 'RGB'
         PIXEL_MEANS = VGG_PIXEL_MEANS
 
-    inputs = Inputs()
-
-    if not FLAGS.finetune:
-        patch_arg_scopes()
-
-    backbone_fn = nets_factory.get_network_fn(FLAGS.backbone, num_classes=None,
-                weight_decay=FLAGS.weight_decay, is_training=inputs.is_training)
-
-    with slim.arg_scope([slim.conv2d, slim.conv2d_transpose, slim.max_pool2d], padding='SAME'), \
-         slim.arg_scope([slim.conv2d, slim.conv2d_transpose], weights_regularizer=slim.l2_regularizer(2.5e-4), normalizer_fn=slim.batch_norm, normalizer_params={'decay': 0.9, 'epsilon': 5e-4, 'scale': False, 'is_training':inputs.is_training}), \
-         slim.arg_scope([slim.batch_norm], is_training=inputs.is_training):
-        loss, metrics = create_model(inputs, backbone_fn)
+    # every stream, of every worker, shuffles with its own seed
+    seed0 = rank * FLAGS.prefetch_workers
+    stream = create_picpac_stream(FLAGS.db, True, seed=seed0 if allreduce else None)
+    prefetcher = None
+    if FLAGS.prefetch > 0:
+        # decode and augment in background threads, batches reach the
+        # graph through tf.data instead of feed_dict
+        prefetcher = Prefetcher(lambda i: stream if i == 0 else create_picpac_stream(FLAGS.db, True, seed=seed0+i),
+                                FLAGS.prefetch_workers, FLAGS.prefetch, transform=Inputs.encode)
+    inputs = Inputs(prefetcher)
+    timeline = StepTimeline(FLAGS.profile if leader else None, FLAGS.profile_trace_steps, FLAGS.profile_summary_steps)
+    atexit.register(timeline.close)
+
+    loss, metrics = build_model(inputs, timeline)
 
     metric_names = [x.name[:-2] for x in metrics]
 
@@ -419,89 +578,142 @@ def main (_):
     else:
         optimizer = tf.train.MomentumOptimizer(learning_rate=LR, momentum=0.9)
 
-    train_op = slim.learning.create_train_op(loss, optimizer, global_step=global_step, variables_to_train=variables_to_train)
+    if allreduce:
+        # same as slim's create_train_op, but gradients are averaged
+        # across workers before they are applied
+        train_op = tf.contrib.training.create_train_op(loss, optimizer, global_step=global_step,
+                        variables_to_train=variables_to_train, transform_grads_fn=allreduce.transform_grads)
+    else:
+        train_op = slim.learning.create_train_op(loss, optimizer, global_step=global_step, variables_to_train=variables_to_train)
+    # training metrics are averaged in the graph and read every log_steps
+    streaming = StreamingMetrics(metrics, inputs.batch_size)
+    metrics_log = FLAGS.metrics_log
+    if metrics_log is None and FLAGS.model:
+        metrics_log = os.path.join(FLAGS.model, 'metrics.jsonl')
+    jsonl = JsonLog(metrics_log if leader else None)
     saver = tf.train.Saver(max_to_keep=FLAGS.max_to_keep)
+    async_saver = None
+    if FLAGS.async_ckpt and FLAGS.model and leader:
+        async_saver = AsyncSaver(saver, FLAGS.max_to_keep, FLAGS.keep_ckpt_hours)
 
-    stream = create_picpac_stream(FLAGS.db, True)
     # load validation db
     val_stream = None
-    if FLAGS.val_db:
-        val_stream = create_picpac_stream(FLAGS.val_db, False)
+    if FLAGS.val_db and leader:
+        val_stream = create_val_stream(FLAGS.val_db)
 
     epoch_steps = FLAGS.epoch_steps
     if epoch_steps is None:
-        epoch_steps = (stream.size() + FLAGS.batch-1) // FLAGS.batch
+        epoch_steps = (stream.size() + FLAGS.batch * workers - 1) // (FLAGS.batch * workers)
     best = 0
 
     ss_config = tf.ConfigProto()
     ss_config.gpu_options.allow_growth=True
-    with tf.Session(config=ss_config) as sess:
-        sess.run(tf.global_variables_initializer())
-        sess.run(tf.local_variables_initializer())
-        if init_finetune:
-            init_finetune(sess)
-        if FLAGS.resume:
-            saver.restore(sess, FLAGS.resume)
-
-        global_start_time = time.time()
-        epoch = 0
-        step = 0
-        while epoch < FLAGS.max_epochs:
-            start_time = time.time()
-            cnt, metrics_sum = 0, np.array([0] * len(metrics), dtype=np.float32)
-            progress = tqdm(range(epoch_steps), leave=False)
-            for _ in progress:
-                sample = stream.next()
-                mm, _ = sess.run([metrics, train_op], feed_dict=inputs.feed_dict(sample, True))
-                bs = sample[1].shape[0]
-                metrics_sum += np.array(mm) * bs
-                cnt += bs
-                metrics_txt = format_metrics(metrics_sum/cnt)
-                progress.set_description(metrics_txt)
-                step += 1
-                pass
-            stop = time.time()
-            msg = 'train e=%d s=%d ' % (epoch, step)
-            msg += metrics_txt
-            msg += ' w=%.3f t=%.3f ' % (stop - global_start_time, stop - start_time)
-            print_green(msg)
-            logging.info(msg)
-
-            epoch += 1
-
-            if (epoch % FLAGS.val_epochs == 0) and val_stream:
-                lr = sess.run(LR)
-                # evaluation
-                Ys, Ps = [], []
+    if allreduce:
+        ss_config.intra_op_parallelism_threads = max(1, multiprocessing.cpu_count() // workers)
+    BUDGET.configure(ss_config)
+    try:
+        with tf.Session(config=ss_config) as sess:
+            sess.run(tf.global_variables_initializer())
+            sess.run(tf.local_variables_initializer())
+            if init_finetune:
+                init_finetune(sess)
+            if FLAGS.resume:
+                saver.restore(sess, FLAGS.resume)
+            if allreduce:
+                allreduce.sync(sess, saver)
+
+            global_start_time = time.time()
+            epoch = 0
+            step = 0
+            while epoch < FLAGS.max_epochs:
+                start_time = time.time()
                 cnt, metrics_sum = 0, np.array([0] * len(metrics), dtype=np.float32)
-                val_stream.reset()
-                progress = tqdm(val_stream, leave=False)
-                for sample in progress:
-                    p, mm = sess.run([probs, metrics], feed_dict=inputs.feed_dict(sample, False))
-                    metrics_sum += np.array(mm) * images.shape[0]
-                    cnt += images.shape[0]
-                    Ys.extend(list(meta.labels))
-                    Ps.extend(list(p))
-                    metrics_txt = format_metrics(metrics_sum/cnt)
-                    progress.set_description(metrics_txt)
+                epoch_start_step = step
+                progress = tqdm(range(epoch_steps), leave=False, disable=not leader)
+                for _ in progress:
+                    with timeline.phase('data'):
+                        sample = None if prefetcher else stream.next()
+                    with timeline.phase('feed'):
+                        feed_dict = inputs.feed_dict(sample, True)
+                    options, run_metadata = timeline.run_options()
+                    with timeline.phase('run'):
+                        sess.run([streaming.update, train_op], feed_dict=feed_dict,
+                                 options=options, run_metadata=run_metadata)
+                    timeline.add_run_metadata(run_metadata)
+                    step += 1
+                    if step % FLAGS.log_steps == 0 or step - epoch_start_step == epoch_steps:
+                        with timeline.phase('metrics'):
+                            mm, bs = streaming.read(sess)
+                            metrics_sum += np.array(mm) * bs
+                            cnt += bs
+                            metrics_txt = format_metrics(metrics_sum/cnt)
+                            sps = cnt * workers / (time.time() - start_time)
+                            progress.set_description(metrics_txt + ' sps=%.1f' % sps)
+                            record = dict(zip(metric_names, [float(x) for x in mm]))
+                            jsonl.write(mode='train', epoch=epoch, step=step, samples=int(bs * workers), sps=sps,
+                                        time=time.time(), **record)
+                    summary = timeline.end_step()
+                    if summary:
+                        progress.write(summary)
+                        logging.info(summary)
                     pass
-                assert cnt == val_stream.size()
-                avg = metrics_sum / cnt
-                if avg[0] > best:
-                    best = avg[0]
-                msg = 'valid epoch=%d step=%d ' % (epoch-1, step)
+                stop = time.time()
+                msg = 'train e=%d s=%d ' % (epoch, step)
                 msg += metrics_txt
-                msg += ' lr=%.4f best=%.3f' % (lr, best)
-                print_red(msg)
-                logging.info(msg)
-                #log.write('%d\t%s\t%.4f\n' % (epoch, '\t'.join(['%.4f' % x for x in avg]), best))
-            # model saving
-            if (epoch % FLAGS.ckpt_epochs == 0) and FLAGS.model:
-                ckpt_path = '%s/%d' % (FLAGS.model, epoch)
-                saver.save(sess, ckpt_path)
-                print('saved to %s.' % ckpt_path)
+                msg += ' w=%.3f t=%.3f sps=%.1f ' % (stop - global_start_time, stop - start_time, cnt * workers / (stop - start_time))
+                waste = padding_waste(prefetcher.streams if prefetcher else [stream])
+                if FLAGS.buckets:
+                    msg += 'waste=%.3f ' % waste
+                jsonl.write(mode='epoch', epoch=epoch, step=step, samples=int(cnt * workers), sps=cnt * workers / (stop - start_time),
+                            time=stop, waste=waste, **dict(zip(metric_names, [float(x) for x in metrics_sum/cnt])))
+                if leader:
+                    print_green(msg)
+                    logging.info(msg)
+
+                epoch += 1
+
+                if (epoch % FLAGS.val_epochs == 0) and val_stream:
+                    # evaluation; evaluate.py does this in another process
+                    lr = sess.run(LR)
+                    avg, precision, recall, ap, aps = validate(sess, inputs, val_stream, metrics)
+                    if ap > best:
+                        best = ap
+                    msg = 'valid epoch=%d step=%d ' % (epoch-1, step)
+                    msg += format_metrics(avg)
+                    msg += ' precision=%.3f recall=%.3f ap=%.3f lr=%.4f best=%.3f' % (precision, recall, ap, lr, best)
+                    record = dict(zip(metric_names, [float(x) for x in avg]))
+                    record.update(aps)
+                    jsonl.write(mode='valid', epoch=epoch-1, step=step, precision=precision, recall=recall, ap=ap, **record)
+                    print_red(msg)
+                    logging.info(msg)
+                    #log.write('%d\t%s\t%.4f\n' % (epoch, '\t'.join(['%.4f' % x for x in avg]), best))
+                # model saving
+                if (epoch % FLAGS.ckpt_epochs == 0) and FLAGS.model and leader:
+                    ckpt_path = '%s/%d' % (FLAGS.model, epoch)
+                    with timeline.phase('checkpoint'):
+                        if async_saver:
+                            async_saver.save(sess, ckpt_path)
+                        else:
+                            saver.save(sess, ckpt_path)
+                    print('saved to %s.' % ckpt_path)
+                pass
+            if async_saver:
+                async_saver.close()
             pass
-        pass
+    finally:
+        # after the session, which may still be reading from it
+        if prefetcher:
+            prefetcher.close()
+    pass
+
+def main (_):
+    if FLAGS.workers > 1:
+        # fork before any session exists; the gradient buffer is mapped
+        # once the workers know the model size
+        allreduce = AllReduce(FLAGS.workers)
+        allreduce.run(lambda rank: train(rank, allreduce))
+    else:
+        train()
     pass
 
 if __name__ == '__main__':